@@ -0,0 +1,214 @@
+'''Online sentiment anomaly alerts per query: EWMA control charts (and optionally CUSUM) over the scored stream'''
+import json
+import math
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from stats import normalize_query
+
+DIRECTIONS = ('down', 'up', 'both')
+
+
+@dataclass(frozen=True)
+class AlertConfig:
+    '''Dataclass for the alerting thresholds, by default alerting on drops of the VADER compound score'''
+    column: str = 'Sentiment_VADER'
+    # Weight of each tweet in the slow baseline mean and variance, and in the fast level it is compared with
+    baseline_alpha: float = 0.01
+    level_alpha: float = 0.1
+    # An alert opens when the level is threshold standard errors from the baseline, and closes inside clear
+    threshold: float = 3.0
+    clear: float = 1.0
+    warmup: int = 50
+    direction: str = 'down'
+    cusum: bool = False
+    cusum_slack: float = 0.5
+    cusum_limit: float = 8.0
+
+    def deviation(self, z):
+        '''Returns how far a z-score lies in the alerting direction'''
+        return {'down': -z, 'up': z, 'both': abs(z)}[self.direction]
+
+    @staticmethod
+    def from_env():
+        '''Returns the config set by Alert_Column, Alert_Threshold, Alert_Clear, Alert_Warmup, Alert_Direction
+        and Alert_Cusum, with the defaults for the rest'''
+        config = AlertConfig(column=os.getenv('Alert_Column', AlertConfig.column),
+                             threshold=float(os.getenv('Alert_Threshold', AlertConfig.threshold)),
+                             clear=float(os.getenv('Alert_Clear', AlertConfig.clear)),
+                             warmup=int(os.getenv('Alert_Warmup', AlertConfig.warmup)),
+                             direction=os.getenv('Alert_Direction', AlertConfig.direction),
+                             cusum=os.getenv('Alert_Cusum', '').lower() in ('1', 'true', 'yes'))
+        if config.direction not in DIRECTIONS:
+            raise ValueError(f'Unknown alert direction: {config.direction}')
+        if not 0 <= config.clear < config.threshold:
+            raise ValueError('Alert_Clear must be below Alert_Threshold')
+        return config
+
+
+class EwmaDetector:
+    '''Class for an EWMA control chart with hysteresis, plus an optional CUSUM of the standardized scores.
+
+    Each score updates a slow exponentially weighted baseline mean and variance, and a fast
+    level; the level's z-score is its distance from the baseline in units of the standard
+    error sigma * sqrt(a / (2 - a)) an EWMA of independent scores would have. Every update
+    is constant work, and a tweet with multiplicity w counts as w identical scores.
+    The baseline is held while an EWMA alert is open, so a lasting drop stays open.
+    '''
+
+    def __init__(self, count=0, mean=0.0, variance=0.0, level=0.0, cusum_low=0.0, cusum_high=0.0,
+                 active=None, peak=0.0):
+        self.count = count
+        self.mean = mean
+        self.variance = variance
+        self.level = level
+        self.cusum_low = cusum_low
+        self.cusum_high = cusum_high
+        # Detector ('ewma' or 'cusum') -> whether an alert is open
+        self.active = active or {}
+        self.peak = peak
+
+    def z(self, config):
+        std = math.sqrt(self.variance)
+        if not std:
+            return 0.0
+        return (self.level - self.mean) / (std * math.sqrt(config.level_alpha / (2 - config.level_alpha)))
+
+    def add(self, x, config, weight=1):
+        '''Add a score and return the (detector, 'open' or 'close', z-score) events it causes'''
+        events = []
+        if self.count == 0:
+            self.mean = self.level = x
+        else:
+            std = math.sqrt(self.variance)
+            if config.cusum and std:
+                r = (x - self.mean) / std
+                # Capped at twice the limit, so an alert closes soon after the scores recover
+                cap = 2 * config.cusum_limit
+                self.cusum_low = min(cap, max(0.0, self.cusum_low + weight * (-r - config.cusum_slack)))
+                self.cusum_high = min(cap, max(0.0, self.cusum_high + weight * (r - config.cusum_slack)))
+            # Until 1 / alpha tweets are in, the plain running mean and variance are used (no start-up bias)
+            share = weight / (self.count + weight)
+            level_weight = max(1 - (1 - config.level_alpha) ** weight, share)
+            self.level += level_weight * (x - self.level)
+            if not self.active.get('ewma'):
+                # Baseline update of West (1979): the variance is taken about the old and new means
+                baseline_weight = max(1 - (1 - config.baseline_alpha) ** weight, share)
+                diff = x - self.mean
+                increment = baseline_weight * diff
+                self.mean += increment
+                self.variance = (1 - baseline_weight) * (self.variance + diff * increment)
+        self.count += weight
+        if self.count < config.warmup:
+            return events
+        z = self.z(config)
+        deviation = config.deviation(z)
+        if self.active.get('ewma'):
+            self.peak = max(self.peak, deviation)
+            if deviation < config.clear:
+                self.active['ewma'] = False
+                events.append(('ewma', 'close', z))
+        elif deviation >= config.threshold:
+            self.active['ewma'] = True
+            self.peak = deviation
+            events.append(('ewma', 'open', z))
+        if config.cusum:
+            cusum = {'down': self.cusum_low, 'up': self.cusum_high,
+                     'both': max(self.cusum_low, self.cusum_high)}[config.direction]
+            if self.active.get('cusum'):
+                if cusum == 0:
+                    self.active['cusum'] = False
+                    events.append(('cusum', 'close', z))
+            elif cusum > config.cusum_limit:
+                self.active['cusum'] = True
+                events.append(('cusum', 'open', z))
+        return events
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'variance': self.variance, 'level': self.level,
+                'cusum_low': self.cusum_low, 'cusum_high': self.cusum_high, 'active': self.active,
+                'peak': self.peak}
+
+
+class QueryAlerts:
+    '''Class for the anomaly detector of one query, and the alerts it opens and closes'''
+
+    def __init__(self, query, config, detector=None):
+        self.query = normalize_query(query)
+        self.config = config
+        self.detector = detector or EwmaDetector()
+        self.events = []
+
+    def update(self, tweets):
+        '''Add scored tweets oldest first, collecting (detector, kind, z, time, baseline, level, peak z) events'''
+        column = self.config.column.lower()
+        # Searches return tweets newest first; the detector has to see them in time order, and tweets
+        # without a timestamp are stamped now, so they go last
+        for tweet in sorted(tweets, key=lambda t: (t.created_at is None, t.created_at or 0)):
+            value = getattr(tweet, column)
+            # Scores the scoring policy left pending are not counted
+            if value is None:
+                continue
+            for detector, kind, z in self.detector.add(value, self.config, tweet.multiplicity):
+                self.events.append((detector, kind, z, tweet.created_at or time.time(), self.detector.mean,
+                                    self.detector.level, self.detector.peak if detector == 'ewma' else None))
+        return self.events
+
+    @staticmethod
+    def create_table(conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS alert_state (Query TEXT, Column_Name TEXT, State TEXT, '
+                     'PRIMARY KEY (Query, Column_Name))')
+        conn.execute('CREATE TABLE IF NOT EXISTS alerts (Id INTEGER PRIMARY KEY, Query TEXT, Column_Name TEXT, '
+                     'Detector TEXT, Opened_At REAL, Closed_At REAL, Z REAL, Peak_Z REAL, Baseline REAL, '
+                     'Level REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS alerts_opened ON alerts (Opened_At)')
+
+    @staticmethod
+    def read(conn, query, config):
+        row = conn.execute('SELECT State FROM alert_state WHERE Query = ? AND Column_Name = ?',
+                           (normalize_query(query), config.column)).fetchone()
+        return QueryAlerts(query, config, EwmaDetector(**json.loads(row[0])) if row else None)
+
+    def write(self, conn):
+        conn.execute('INSERT OR REPLACE INTO alert_state (Query, Column_Name, State) VALUES (?, ?, ?)',
+                     (self.query, self.config.column, json.dumps(self.detector.to_dict())))
+        for detector, kind, z, at, baseline, level, peak in self.events:
+            if kind == 'open':
+                conn.execute('INSERT INTO alerts (Query, Column_Name, Detector, Opened_At, Z, Baseline, Level) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', (self.query, self.config.column, detector, at, z,
+                                                              baseline, level))
+            else:
+                conn.execute('UPDATE alerts SET Closed_At = ?, Peak_Z = ? WHERE Query = ? AND Column_Name = ? '
+                             'AND Detector = ? AND Closed_At IS NULL',
+                             (at, peak, self.query, self.config.column, detector))
+        self.events = []
+
+    @staticmethod
+    def record(query, tweets, db_path, config=None):
+        '''Feed scored tweets to the query's detector, storing the alerts they open or close, and return them'''
+        config = config or ALERT_CONFIG
+        with sqlite3.connect(db_path) as conn:
+            QueryAlerts.create_table(conn)
+            # Take the write lock before reading so concurrent batches of a query aren't lost
+            conn.execute('BEGIN IMMEDIATE')
+            alerts = QueryAlerts.read(conn, query, config)
+            events = list(alerts.update(tweets))
+            alerts.write(conn)
+        return events
+
+    @staticmethod
+    def recent(db_path, limit=10):
+        '''Returns the latest alerts as dicts, open ones first'''
+        with sqlite3.connect(db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            try:
+                rows = conn.execute('SELECT * FROM alerts ORDER BY Closed_At IS NOT NULL, Opened_At DESC LIMIT ?',
+                                    (limit,)).fetchall()
+            except sqlite3.OperationalError:
+                # Nothing has been recorded in this database yet
+                return []
+        return [dict(row) for row in rows]
+
+
+ALERT_CONFIG = AlertConfig.from_env()
@@ -0,0 +1,206 @@
+'''Resumable offline backfill of JSONL/CSV tweet archives into the database'''
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dedup import Deduplicator, text_hash
+from entities import weights as entity_weights
+from main import Database, Tweet
+
+# Tuned for bulk loading: WAL keeps the file consistent if the process dies, while
+# synchronous=OFF and a large cache avoid an fsync and page churn per transaction.
+LOAD_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=OFF',
+    'PRAGMA cache_size=-262144',
+    'PRAGMA temp_store=MEMORY',
+]
+
+
+def tweet_text(record):
+    '''Returns the text of an archived tweet (v2 {"data": ...}, v1.1 or flat export)'''
+    if 'data' in record and isinstance(record['data'], dict):
+        record = record['data']
+    return record.get('text') or record.get('full_text') or record.get('Text') or ''
+
+
+def tweet_created_at(record):
+    '''Returns the epoch seconds an archived tweet was created at (v2 or v1.1 format), or None'''
+    if 'data' in record and isinstance(record['data'], dict):
+        record = record['data']
+    created_at = record.get('created_at') or record.get('Created_At')
+    if not created_at:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%a %b %d %H:%M:%S %z %Y'):
+        try:
+            parsed = datetime.strptime(created_at, fmt)
+        except (TypeError, ValueError):
+            continue
+        return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+    try:
+        return float(created_at)
+    except ValueError:
+        return None
+
+
+def read_jsonl(f, offset):
+    '''Yield (end_offset, text, created_at) for each line of a JSONL archive opened in binary mode'''
+    # Counting the bytes read is far cheaper than a text-mode tell() per record
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            record = json.loads(line)
+            yield offset, tweet_text(record), tweet_created_at(record)
+
+
+def read_csv(f, header, offset):
+    '''Yield (end_offset, text, created_at) for each row of a CSV archive opened in binary mode'''
+    end = [offset]
+
+    def lines():
+        # The reader pulls only the lines of the row it is parsing, so end holds the row's end offset
+        for line in f:
+            end[0] += len(line)
+            yield line.decode('utf-8')
+
+    for row in csv.DictReader(lines(), fieldnames=header):
+        yield end[0], tweet_text(row), tweet_created_at(row)
+
+
+def read_chunks(path, offset=0, chunk_size=5000, file_format=None):
+    '''Yield (end_offset, texts, created_ats) chunks of an archive, starting at a byte offset'''
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, 'rb') as f:
+        header = None
+        if file_format == 'csv':
+            line = f.readline()
+            header = next(csv.reader([line.decode('utf-8')]))
+            offset = max(offset, len(line))
+        f.seek(offset)
+        records = read_csv(f, header, offset) if file_format == 'csv' else read_jsonl(f, offset)
+        texts, created, end = [], [], offset
+        for end, text, created_at in records:
+            texts.append(text)
+            created.append(created_at)
+            if len(texts) >= chunk_size:
+                yield end, texts, created
+                texts, created = [], []
+        if texts:
+            yield end, texts, created
+
+
+def score_chunk(chunk):
+    '''Clean and score one chunk in a pool worker'''
+    end, texts, created = chunk
+    tweets = [Tweet(text=text, created_at=created_at) for text, created_at in zip(texts, created)]
+    for tweet in tweets:
+        tweet.clean()
+    rows = []
+    for tweet in Deduplicator().dedupe(tweets):
+        tweet.analyze()
+        # Each row carries the tweet's entity weights after its ROW_COLUMNS values
+        rows.append((tweet.text, tweet.sentiment, tweet.sentiment_magnitude, tweet.sentiment_vader,
+                     tweet.multiplicity, text_hash(tweet.text), tweet.created_at, entity_weights(tweet)))
+    return end, len(texts), rows
+
+
+class Backfill:
+    '''Class for loading an archive with checkpointed, bulk transactions'''
+
+    def __init__(self, path, db_path=None, chunk_size=5000, commit_every=10, workers=None, file_format=None):
+        if Database.storage_format == 'compact':
+            # Rows and the checkpoint commit in one transaction on the plain tweets table, which the compact
+            # layout doesn't have
+            raise ValueError('Backfill needs the plain storage format; unset Storage_Format=compact to load archives')
+        self.path = path
+        self.source = os.path.realpath(path)
+        self.db_path = db_path or Database.db_path
+        self.chunk_size = chunk_size
+        self.commit_every = commit_every
+        self.workers = workers
+        self.file_format = file_format
+        self.rows = self.resumed_rows = self.chunks = 0
+        self.pending, self.pending_offset, self.pending_records = [], 0, 0
+        self.started = time.perf_counter()
+
+    def connect(self):
+        Database.create_table(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS backfill_progress (Source TEXT PRIMARY KEY, Offset INTEGER, Rows INTEGER)')
+        conn.commit()
+        return conn
+
+    def checkpoint(self, conn):
+        '''Returns the (offset, rows) already committed for this archive'''
+        row = conn.execute('SELECT Offset, Rows FROM backfill_progress WHERE Source = ?', (self.source,)).fetchone()
+        return row or (0, 0)
+
+    def commit(self, conn, rows, offset, records):
+        '''Insert rows and advance the checkpoint in one transaction'''
+        with conn:
+            Database.upsert_tweets(conn.cursor(), [row[:-1] for row in rows], [row[-1] for row in rows])
+            conn.execute('INSERT OR REPLACE INTO backfill_progress (Source, Offset, Rows) VALUES (?, ?, ?)',
+                         (self.source, offset, self.rows + records))
+        self.rows += records
+
+    def collect(self, conn, result):
+        '''Queue a scored chunk, committing every commit_every chunks'''
+        end, records, rows = result
+        self.pending.extend(rows)
+        self.pending_offset = end
+        self.pending_records += records
+        self.chunks += 1
+        if self.chunks % self.commit_every == 0:
+            self.commit(conn, self.pending, self.pending_offset, self.pending_records)
+            self.pending, self.pending_records = [], 0
+            print(f'{self.rows} rows loaded ({self.rate():,.0f} rows/s)')
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return (self.rows - self.resumed_rows) / elapsed if elapsed else 0.0
+
+    def run(self):
+        '''Load the archive from its last checkpoint and return rows per second'''
+        conn = self.connect()
+        offset, self.rows = self.checkpoint(conn)
+        if offset:
+            print(f'Resuming {self.path} at byte {offset} ({self.rows} rows already loaded)')
+        self.started, self.resumed_rows = time.perf_counter(), self.rows
+        self.pending, self.pending_offset, self.pending_records, self.chunks = [], offset, 0, 0
+        # Bound the chunks in flight so memory doesn't grow with the archive size
+        max_in_flight = 2 * (self.workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(self.workers) as pool:
+            in_flight = deque()
+            for chunk in read_chunks(self.path, offset, self.chunk_size, self.file_format):
+                in_flight.append(pool.submit(score_chunk, chunk))
+                if len(in_flight) >= max_in_flight:
+                    self.collect(conn, in_flight.popleft().result())
+            while in_flight:
+                self.collect(conn, in_flight.popleft().result())
+        if self.pending:
+            self.commit(conn, self.pending, self.pending_offset, self.pending_records)
+        conn.close()
+        rate = self.rate()
+        print(f'Done: {self.rows - self.resumed_rows} rows in {time.perf_counter() - self.started:.1f}s ({rate:,.0f} rows/s)')
+        return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('archive', help='JSONL or CSV tweet archive')
+    parser.add_argument('--db', default=Database.db_path)
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--commit-every', type=int, default=10, help='Chunks per transaction')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    Backfill(args.archive, args.db, args.chunk_size, args.commit_every, args.workers, args.format).run()
@@ -0,0 +1,69 @@
+'''TTL cache with single-flight coalescing of concurrent misses'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class Flight:
+    '''Class for one in-flight computation that concurrent callers wait on'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    '''Class for caching values for ttl seconds, sharing one computation between concurrent identical misses'''
+
+    def __init__(self, ttl=60.0, max_entries=256, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.hits = self.misses = self.coalesced = 0
+
+    def get(self, key, compute, cache_if=lambda value: True):
+        '''Returns the cached value for key, or the result of compute() shared with concurrent callers'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.hits += 1
+                return entry[1]
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                # Failed fetches are shared with the waiters but never cached
+                if flight.error is None and self.ttl > 0 and cache_if(flight.value):
+                    self.entries[key] = (self.clock() + self.ttl, flight.value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'entries': len(self.entries)}
@@ -0,0 +1,374 @@
+'''Optional compact storage: dictionary-compressed tweet text and scores quantized to small integers'''
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import zlib
+from collections import Counter
+from contextlib import closing
+import numpy as np
+import pandas as pd
+from storage import BATCH_SIZE, FETCH_SIZE, ROW_COLUMNS, SQLiteBackend, StorageBackend, check_column, check_identifier
+from storage import collapse, column_dtype, fetch_chunks
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC = 'zstd' if zstandard else 'zlib'
+
+# 'compact' stores tweets through CompactBackend. The features that read the plain tweets table directly are
+# off, as with Database_URL: search, entity counts, the time series and live mode return nothing (see
+# Database.plain), and backfill and rescoring refuse to run
+STORAGE_FORMAT = os.getenv('Storage_Format', 'plain')
+# Scores are stored as round(score * 10 ** precision): 4 digits fit scores in [-1, 1] in two bytes
+SCORE_PRECISION = int(os.getenv('Score_Precision', '4'))
+# zlib can refer back at most 32 KB, so a larger preset dictionary would go unused
+DICT_SIZE = 32 * 1024
+MIN_TRAINING_TEXTS = 100
+SCORE_COLUMNS = ['Sentiment', 'Sentiment_Magnitude', 'Sentiment_VADER']
+TABLE = 'tweets_compact'
+
+
+def train_zlib_dictionary(samples, size=DICT_SIZE):
+    '''Returns a zlib preset dictionary of the word n-grams that save the most bytes across the samples'''
+    counts = Counter()
+    for sample in samples:
+        words = sample.split(b' ')
+        for n in (8, 4, 2, 1):
+            counts.update(b' '.join(words[i:i + n]) for i in range(len(words) - n + 1))
+    # A string repeated in many samples saves about its length for every repeat
+    ranked = sorted((gram for gram, count in counts.items() if count > 1 and len(gram) > 3),
+                    key=lambda gram: counts[gram] * len(gram), reverse=True)
+    chosen, used = [], 0
+    for gram in ranked:
+        if used + len(gram) + 1 > size:
+            break
+        # Parts of strings already chosen add nothing (only the latest are checked, to keep training fast)
+        if any(gram in longer for longer in chosen[-64:]):
+            continue
+        chosen.append(gram)
+        used += len(gram) + 1
+    # zlib finds closer (later) matches more cheaply, so the most valuable strings go last
+    return b' '.join(reversed(chosen))
+
+
+class TextCodec:
+    '''Class for compressing tweet texts, with zstd when installed and raw deflate otherwise'''
+
+    def __init__(self, codec='zlib', dictionary=b'', level=6):
+        self.codec = codec
+        self.dictionary = dictionary
+        self.level = level
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('Texts compressed with zstd need the zstandard package to be read')
+            zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self.compressor = zstandard.ZstdCompressor(level=level, dict_data=zdict, write_checksum=False,
+                                                       write_content_size=False, write_dict_id=False)
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+        elif dictionary:
+            # Loading a 32 KB dictionary costs more than compressing a tweet, so it is loaded once and copied
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    @staticmethod
+    def train(texts, codec=None, size=DICT_SIZE):
+        '''Returns a codec with a dictionary trained on a sample of texts'''
+        codec = codec or CODEC
+        samples = [text.encode('utf-8') for text in texts if text]
+        if codec == 'zstd':
+            return TextCodec(codec, zstandard.train_dictionary(size, samples).as_bytes())
+        return TextCodec(codec, train_zlib_dictionary(samples, size))
+
+    def compress(self, text):
+        data = (text or '').encode('utf-8')
+        if self.codec == 'zstd':
+            return self.compressor.compress(data)
+        # Raw deflate: no header or checksum, which would be a tenth of a short tweet
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, blob):
+        if self.codec == 'zstd':
+            return self.decompressor.decompress(blob, max_output_size=1 << 20).decode('utf-8')
+        if self.dictionary:
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return (decompressor.decompress(blob) + decompressor.flush()).decode('utf-8')
+
+
+def quantize(value, scale):
+    return None if value is None else int(round(value * scale))
+
+
+class CompactBackend(StorageBackend):
+    '''Class for storing tweets in a SQLite file as compressed text and quantized scores.
+
+    Text is only decompressed by read_results, the path that displays or exports it; score
+    reads (read_columns) never touch it. The dictionary is trained on the first batch of at
+    least MIN_TRAINING_TEXTS tweets, and every row keeps the id of the dictionary it needs.
+    '''
+
+    def __init__(self, db_path, precision=SCORE_PRECISION, timeout=30.0):
+        self.db_path = db_path
+        self.precision = precision
+        self.timeout = timeout
+        self.codecs = {}
+        self.stored_precision = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+        if not self.stored_precision:
+            # The first database settings stick: changing Score_Precision later mustn't misread stored scores
+            try:
+                row = conn.execute('SELECT Precision FROM compact_dicts WHERE Id = 0').fetchone()
+            except sqlite3.OperationalError:
+                # No compact tables yet
+                row = None
+            if row:
+                self.precision, self.stored_precision = row[0], True
+        return conn
+
+    def create_table(self):
+        with self.connect() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} (Text BLOB, Sentiment INTEGER, '
+                         'Sentiment_Magnitude INTEGER, Sentiment_VADER INTEGER, Multiplicity INTEGER DEFAULT 1, '
+                         'Text_Hash TEXT, Created_At REAL, Dict_Id INTEGER)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{TABLE}_text_hash ON {TABLE} (Text_Hash)')
+            conn.execute('CREATE TABLE IF NOT EXISTS compact_dicts (Id INTEGER PRIMARY KEY, Codec TEXT, '
+                         'Dictionary BLOB, Precision INTEGER)')
+            # Dictionary 0 is none, for the tweets stored before one is trained
+            conn.execute('INSERT OR IGNORE INTO compact_dicts (Id, Codec, Dictionary, Precision) VALUES (0, ?, ?, ?)',
+                         (CODEC, b'', self.precision))
+            self.precision = conn.execute('SELECT Precision FROM compact_dicts WHERE Id = 0').fetchone()[0]
+            self.stored_precision = True
+
+    @property
+    def scale(self):
+        return 10 ** self.precision
+
+    def codec(self, conn, dict_id):
+        if dict_id not in self.codecs:
+            codec, dictionary = conn.execute('SELECT Codec, Dictionary FROM compact_dicts WHERE Id = ?',
+                                             (dict_id,)).fetchone()
+            self.codecs[dict_id] = TextCodec(codec, dictionary)
+        return self.codecs[dict_id]
+
+    def current_codec(self, conn, texts):
+        '''Returns (dictionary id, codec) to compress with, training the dictionary on texts if there is none'''
+        dict_id = conn.execute('SELECT MAX(Id) FROM compact_dicts').fetchone()[0]
+        if dict_id == 0 and len(texts) >= MIN_TRAINING_TEXTS:
+            codec = TextCodec.train(texts)
+            dict_id = conn.execute('INSERT INTO compact_dicts (Codec, Dictionary, Precision) VALUES (?, ?, ?)',
+                                   (codec.codec, codec.dictionary, self.precision)).lastrowid
+            self.codecs[dict_id] = codec
+        return dict_id, self.codec(conn, dict_id)
+
+    def upsert_tweets(self, rows, entities=None):
+        # Entity tables, like the full-text index, need the plain text layout
+        rows = collapse(rows)
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            hashes = [row[5] for row in rows]
+            existing = set()
+            for i in range(0, len(hashes), BATCH_SIZE):
+                chunk = hashes[i:i + BATCH_SIZE]
+                existing.update(row[0] for row in conn.execute(
+                    f'SELECT Text_Hash FROM {TABLE} WHERE Text_Hash IN ({",".join("?" * len(chunk))})', chunk))
+            conn.executemany(f'UPDATE {TABLE} SET Multiplicity = Multiplicity + ? WHERE rowid = '
+                             f'(SELECT rowid FROM {TABLE} WHERE Text_Hash = ? LIMIT 1)',
+                             [(row[4], row[5]) for row in rows if row[5] in existing])
+            new_rows = [row for row in rows if row[5] not in existing]
+            if not new_rows:
+                return
+            dict_id, codec = self.current_codec(conn, [row[0] for row in new_rows])
+            scale = self.scale
+            conn.executemany(
+                f'INSERT INTO {TABLE} ({", ".join(ROW_COLUMNS)}, Dict_Id) '
+                f'VALUES ({", ".join("?" * len(ROW_COLUMNS))}, ?)',
+                [(codec.compress(text), quantize(sentiment, scale), quantize(magnitude, scale),
+                  quantize(vader, scale), multiplicity, text_hash, created_at, dict_id)
+                 for text, sentiment, magnitude, vader, multiplicity, text_hash, created_at in new_rows])
+
+    def update_columns(self, columns, rows):
+        columns = [check_column(column) for column in columns]
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            scale = self.scale
+            conn.executemany(f'UPDATE {TABLE} SET {assignments} WHERE rowid = ?',
+                             ([quantize(value, scale) if column in SCORE_COLUMNS else value
+                               for column, value in zip(columns, row[1:])] + [row[0]] for row in rows))
+
+    def update_where(self, column, value, condition_column, condition_value):
+        column, condition_column = check_column(column), check_column(condition_column)
+        if column == 'Text':
+            raise ValueError('update_where sets numeric columns only; stored text is compressed')
+        scale = self.scale
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if condition_column == 'Text':
+                # Compressed text can't be compared in SQL, so the rows are matched as they decode
+                rowids = [rowid for rowid, text, dict_id in conn.execute(f'SELECT rowid, Text, Dict_Id FROM {TABLE}')
+                          if self.codec(conn, dict_id).decompress(text) == condition_value]
+            else:
+                if condition_column in SCORE_COLUMNS:
+                    condition_value = quantize(condition_value, scale)
+                rowids = [row[0] for row in conn.execute(
+                    f'SELECT rowid FROM {TABLE} WHERE {condition_column} = ?', (condition_value,))]
+            value = quantize(value, scale) if column in SCORE_COLUMNS else value
+            conn.executemany(f'UPDATE {TABLE} SET {column} = ? WHERE rowid = ?', [(value, rowid) for rowid in rowids])
+
+    def row_ids(self, hashes):
+        ids = {}
+        with closing(self.connect()) as conn:
+            for i in range(0, len(hashes), BATCH_SIZE):
+                chunk = hashes[i:i + BATCH_SIZE]
+                ids.update((text_hash, rowid) for rowid, text_hash in conn.execute(
+                    f'SELECT MIN(rowid), Text_Hash FROM {TABLE} WHERE Text_Hash IN ({",".join("?" * len(chunk))}) '
+                    'GROUP BY Text_Hash', chunk))
+        return ids
+
+    def decode(self, conn, columns, row, dict_id):
+        scale = self.scale
+        return tuple(self.codec(conn, dict_id).decompress(value) if column == 'Text'
+                     else (None if value is None else value / scale) if column in SCORE_COLUMNS else value
+                     for column, value in zip(columns, row))
+
+    def read_results(self, columns):
+        columns = [check_column(column) for column in columns]
+        with closing(self.connect()) as conn:
+            cursor = conn.execute(f'SELECT {", ".join(columns)}, Dict_Id FROM {TABLE} ORDER BY rowid')
+            return [self.decode(conn, columns, row[:-1], row[-1]) for rows in fetch_chunks(cursor) for row in rows]
+
+    def pending_rows(self, columns, limit=FETCH_SIZE):
+        pending = ' OR '.join(f'{check_column(column)} IS NULL' for column in columns)
+        with closing(self.connect()) as conn:
+            try:
+                rows = conn.execute(f'SELECT rowid, Text, Dict_Id FROM {TABLE} WHERE {pending} ORDER BY rowid '
+                                    'LIMIT ?', (limit,)).fetchall()
+            except sqlite3.OperationalError:
+                # No compact table yet
+                return []
+            return [(rowid, self.codec(conn, dict_id).decompress(text)) for rowid, text, dict_id in rows]
+
+    def read_frames(self, columns, chunk_size=FETCH_SIZE):
+        columns = [check_column(column) for column in columns]
+        with closing(self.connect()) as conn:
+            cursor = conn.execute(f'SELECT {", ".join(columns)}, Dict_Id FROM {TABLE} ORDER BY rowid')
+            for rows in fetch_chunks(cursor, chunk_size):
+                yield pd.DataFrame([self.decode(conn, columns, row[:-1], row[-1]) for row in rows], columns=columns)
+
+    def read_columns(self, columns, chunk_size=FETCH_SIZE):
+        '''Returns {column: NumPy array} of numeric columns, scores dequantized, without reading any text'''
+        columns = [check_column(column) for column in columns]
+        if 'Text' in columns:
+            raise ValueError('read_columns reads numeric columns only; read_results decompresses text')
+        with closing(self.connect()) as conn:
+            conn.execute('BEGIN')
+            count = conn.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0]
+            arrays = {column: np.empty(count, dtype=column_dtype(column)) for column in columns}
+            cursor = conn.execute(f'SELECT {", ".join(columns)} FROM {TABLE} ORDER BY rowid')
+            start = 0
+            for rows in fetch_chunks(cursor, chunk_size):
+                for i, column in enumerate(columns):
+                    arrays[column][start:start + len(rows)] = [row[i] for row in rows]
+                start += len(rows)
+            conn.rollback()
+        for column in SCORE_COLUMNS:
+            if column in arrays:
+                arrays[column] /= self.scale
+        return arrays
+
+    def clear_table(self, table_name):
+        with self.connect() as conn:
+            conn.execute(f'DELETE FROM {TABLE if table_name == "tweets" else check_identifier(table_name)}')
+
+
+def sample_rows(count=20000, seed=0):
+    '''Returns distinct ROW_COLUMNS rows, most of them variations on a few pieces of marketing copy'''
+    rng = random.Random(seed)
+    campaigns = [
+        'Limited time offer! Get 50% off the new {product} when you order today. Free shipping on all orders '
+        'over $25, use code {code} at checkout',
+        'Introducing the all new {product}: faster, lighter and built to last. Pre-order now and get a free case '
+        'with every purchase {code}',
+        "Don't miss our biggest sale of the year on {product}. Thousands of deals across every category, ends "
+        'Sunday {code}',
+    ]
+    products = ['phone', 'laptop', 'headphones', 'smartwatch', 'tablet', 'camera', 'speaker', 'console']
+    words = ['love', 'hate', 'battery', 'great', 'terrible', 'update', 'service', 'today', 'again', 'screen', 'really',
+             'never', 'best', 'worst', 'support', 'slow', 'fast', 'price', 'worth', 'broken']
+    rows = []
+    for i in range(count):
+        if rng.random() < 0.7:
+            text = rng.choice(campaigns).format(product=rng.choice(products), code=f'SAVE{rng.randint(10, 99)}{i}')
+        else:
+            text = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 20))) + f' {i}'
+        rows.append((text, rng.uniform(-1, 1), rng.uniform(0, 1), rng.uniform(-1, 1), 1, f'h{i}', 1.7e9 + i))
+    return rows
+
+
+def measure(backend, rows, batch_size=500):
+    '''Returns database bytes, inserts per second and rows read per second, with and without text'''
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        backend.upsert_tweets(rows[i:i + batch_size])
+    insert_seconds = time.perf_counter() - start
+    with closing(sqlite3.connect(backend.db_path)) as conn:
+        conn.execute('VACUUM')
+    start = time.perf_counter()
+    results = backend.read_results(['Text'] + SCORE_COLUMNS + ['Multiplicity'])
+    read_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    backend.read_columns(SCORE_COLUMNS)
+    score_seconds = time.perf_counter() - start
+    assert len(results) == len(rows)
+    return {'bytes': os.path.getsize(backend.db_path), 'insert': len(rows) / insert_seconds,
+            'read': len(rows) / read_seconds, 'read scores': len(rows) / score_seconds}
+
+
+def drop_text_indexes(db_path):
+    '''Drop the full-text index and entity tables (and their triggers), leaving the plain tweets table'''
+    with closing(sqlite3.connect(db_path)) as conn:
+        triggers = conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall()
+        for (name,) in triggers:
+            conn.execute(f'DROP TRIGGER {name}')
+        for name in ('tweets_fts', 'tweet_entities', 'entities'):
+            conn.execute(f'DROP TABLE IF EXISTS {name}')
+        conn.commit()
+
+
+def benchmark(count=20000, precision=SCORE_PRECISION):
+    '''Returns size, insert rate and read rates of the plain layout, with and without its text indexes, and of
+    the compact one'''
+    rows = sample_rows(count)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain = SQLiteBackend(os.path.join(tmp_dir, 'plain.db'))
+        bare = SQLiteBackend(os.path.join(tmp_dir, 'bare.db'))
+        compact = CompactBackend(os.path.join(tmp_dir, 'compact.db'), precision)
+        for backend in (plain, bare, compact):
+            backend.create_table()
+        drop_text_indexes(bare.db_path)
+        results['plain'] = measure(plain, rows)
+        results['plain, no text indexes'] = measure(bare, rows)
+        results[f'compact ({CODEC})'] = measure(compact, rows)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--precision', type=int, default=SCORE_PRECISION)
+    args = parser.parse_args()
+
+    for name, result in benchmark(args.rows, args.precision).items():
+        print(f"{name:<24} {result['bytes']:>12,} B  insert {result['insert']:>9,.0f} rows/s  "
+              f"read {result['read']:>9,.0f} rows/s  read scores {result['read scores']:>10,.0f} rows/s")
@@ -0,0 +1,105 @@
+'''Exact and near-duplicate detection for cleaned tweets (MinHash + LSH)'''
+import hashlib
+import os
+import zlib
+import numpy as np
+from entities import fold
+
+DEFAULT_THRESHOLD = float(os.getenv('Dedup_Threshold', '0.8'))
+
+
+def normalize(text):
+    '''Returns the form of a cleaned tweet that exact duplicates share'''
+    return ' '.join(text.lower().split())
+
+
+def text_hash(text):
+    '''Returns the exact-duplicate key of a cleaned tweet'''
+    return hashlib.blake2b(normalize(text).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def lsh_params(threshold, num_perm):
+    '''Returns the (bands, rows) split of num_perm whose LSH threshold is closest to threshold'''
+    candidates = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class MinHasher:
+    '''Class for computing MinHash signatures over character shingles'''
+
+    def __init__(self, num_perm=64, shingle_size=4, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # Multiply-shift hashing: uint64 arithmetic wraps, which is the modulus
+        self.a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        k = self.shingle_size
+        if len(text) <= k:
+            return {text}
+        return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+    def signature(self, text):
+        '''Returns the MinHash signature of normalized text'''
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in self.shingles(text)), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1)
+
+
+class Deduplicator:
+    '''Class for folding exact and near-duplicate tweets into canonical tweets with a multiplicity'''
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=64):
+        self.threshold = threshold
+        self.exact = {}
+        self.canonical = []
+        self.signatures = []
+        self.near = threshold < 1.0
+        if self.near:
+            self.hasher = MinHasher(num_perm)
+            self.bands, self.rows = lsh_params(threshold, num_perm)
+            self.buckets = [{} for _ in range(self.bands)]
+
+    def find(self, signature):
+        '''Returns the index of a canonical near-duplicate of the signature, if any'''
+        candidates = set()
+        for band, bucket in enumerate(self.buckets):
+            candidates.update(bucket.get(signature[band * self.rows:(band + 1) * self.rows].tobytes(), ()))
+        for index in sorted(candidates):
+            if np.mean(self.signatures[index] == signature) >= self.threshold:
+                return index
+        return None
+
+    def index(self, index, signature):
+        for band, bucket in enumerate(self.buckets):
+            bucket.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), []).append(index)
+
+    def add(self, tweet):
+        '''Returns True if the cleaned tweet is new, otherwise folds it into its canonical tweet'''
+        key = normalize(tweet.text)
+        if key in self.exact:
+            fold(self.canonical[self.exact[key]], tweet)
+            return False
+        if self.near:
+            signature = self.hasher.signature(key)
+            match = self.find(signature)
+            if match is not None:
+                self.exact[key] = match
+                fold(self.canonical[match], tweet)
+                return False
+            self.signatures.append(signature)
+            self.index(len(self.canonical), signature)
+        self.exact[key] = len(self.canonical)
+        self.canonical.append(tweet)
+        return True
+
+    def canonical_index(self, tweet):
+        '''Returns the index in canonical of the tweet an added tweet was folded into (or is)'''
+        return self.exact[normalize(tweet.text)]
+
+    def dedupe(self, tweets):
+        '''Returns the canonical tweets of the batch, each carrying its multiplicity'''
+        return [tweet for tweet in tweets if self.add(tweet)]
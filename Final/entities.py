@@ -0,0 +1,149 @@
+'''Hashtags, mentions and URLs extracted before cleaning, stored in normalized tables with running counts'''
+import re
+
+# The pieces Tweet.clean strips, in the same order, so a URL's #fragment isn't taken for a hashtag
+ENTITY_PATTERN = re.compile(r'(http\S+)|@(\w+)|#(\w+)')
+KINDS = ('url', 'mention', 'hashtag')
+# Entity means are kept of this score column
+SENTIMENT_COLUMN = 'Sentiment_VADER'
+# Pairs or hashes looked up per statement, below SQLite's bound variable limit
+LOOKUP_SIZE = 400
+
+
+def extract(text):
+    '''Returns the distinct (kind, value) entities of a raw tweet, hashtags and mentions lowercased'''
+    entities = []
+    for match in ENTITY_PATTERN.finditer(text or ''):
+        url, mention, hashtag = match.groups()
+        if url:
+            entity = ('url', url.rstrip('.,;:!?)\'"'))
+        elif mention:
+            entity = ('mention', mention.lower())
+        else:
+            entity = ('hashtag', hashtag.lower())
+        if entity not in entities:
+            entities.append(entity)
+    return tuple(entities)
+
+
+def weights(tweet):
+    '''Returns {(kind, value): weight} of a tweet's entities, each weighted by the copies that carried it'''
+    if tweet.entity_weights is not None:
+        return tweet.entity_weights
+    return {entity: tweet.multiplicity for entity in tweet.entities}
+
+
+def fold(canonical, tweet):
+    '''Add a duplicate tweet's multiplicity and entity weights to its canonical tweet'''
+    merged = dict(weights(canonical))
+    for entity, weight in weights(tweet).items():
+        merged[entity] = merged.get(entity, 0) + weight
+    canonical.entity_weights = merged
+    canonical.multiplicity += tweet.multiplicity
+
+
+def create_tables(cursor):
+    '''Create the entity tables, their indexes, and the triggers keeping each entity's counts current.
+
+    Each link carries the weight of the tweet copies that had the entity, as a stored row folds in
+    duplicates whose entities may differ. An entity's Tweets and sentiment sums change whenever a
+    link is added or its weight grows, a linked tweet's score changes (rescoring), or it is deleted.
+    '''
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS entities (
+            Id INTEGER PRIMARY KEY, Kind TEXT NOT NULL, Value TEXT NOT NULL,
+            Tweets INTEGER NOT NULL DEFAULT 0, Sentiment_Sum REAL NOT NULL DEFAULT 0,
+            Sentiment_Count INTEGER NOT NULL DEFAULT 0,
+            Mean_Sentiment REAL GENERATED ALWAYS AS (Sentiment_Sum / NULLIF(Sentiment_Count, 0)) VIRTUAL,
+            UNIQUE (Kind, Value));
+        CREATE INDEX IF NOT EXISTS idx_entities_kind_mean ON entities (Kind, Mean_Sentiment);
+        CREATE INDEX IF NOT EXISTS idx_entities_kind_tweets ON entities (Kind, Tweets);
+        CREATE TABLE IF NOT EXISTS tweet_entities (
+            Tweet_Id INTEGER NOT NULL, Entity_Id INTEGER NOT NULL, Weight INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (Tweet_Id, Entity_Id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_tweet_entities_entity ON tweet_entities (Entity_Id, Tweet_Id);
+    ''')
+    if 'Weight' not in {row[1] for row in cursor.execute('PRAGMA table_info(tweet_entities)')}:
+        # Links made before weights credited the whole row, so they keep its multiplicity
+        cursor.executescript('''
+            DROP TRIGGER IF EXISTS tweet_entities_insert;
+            DROP TRIGGER IF EXISTS tweets_entities_update;
+            DROP TRIGGER IF EXISTS tweets_entities_delete;
+            ALTER TABLE tweet_entities ADD COLUMN Weight INTEGER NOT NULL DEFAULT 1;
+            UPDATE tweet_entities SET Weight = COALESCE((SELECT Multiplicity FROM tweets WHERE rowid = Tweet_Id), 1);
+        ''')
+    score = f'(SELECT {SENTIMENT_COLUMN} FROM tweets WHERE rowid = new.Tweet_Id)'
+    link_weight = '(SELECT Weight FROM tweet_entities WHERE Tweet_Id = {}.rowid AND Entity_Id = entities.Id)'
+    new_weight, old_weight = link_weight.format('new'), link_weight.format('old')
+    cursor.executescript(f'''
+        CREATE TRIGGER IF NOT EXISTS tweet_entities_insert AFTER INSERT ON tweet_entities BEGIN
+            UPDATE entities SET
+                Tweets = Tweets + new.Weight,
+                Sentiment_Sum = Sentiment_Sum + COALESCE({score}, 0) * new.Weight,
+                Sentiment_Count = Sentiment_Count + ({score} IS NOT NULL) * new.Weight
+            WHERE Id = new.Entity_Id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tweet_entities_weight AFTER UPDATE OF Weight ON tweet_entities BEGIN
+            UPDATE entities SET
+                Tweets = Tweets + new.Weight - old.Weight,
+                Sentiment_Sum = Sentiment_Sum + COALESCE({score}, 0) * (new.Weight - old.Weight),
+                Sentiment_Count = Sentiment_Count + ({score} IS NOT NULL) * (new.Weight - old.Weight)
+            WHERE Id = new.Entity_Id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tweets_entities_update AFTER UPDATE OF {SENTIMENT_COLUMN} ON tweets BEGIN
+            UPDATE entities SET
+                Sentiment_Sum = Sentiment_Sum + (COALESCE(new.{SENTIMENT_COLUMN}, 0)
+                                                 - COALESCE(old.{SENTIMENT_COLUMN}, 0)) * {new_weight},
+                Sentiment_Count = Sentiment_Count + ((new.{SENTIMENT_COLUMN} IS NOT NULL)
+                                                     - (old.{SENTIMENT_COLUMN} IS NOT NULL)) * {new_weight}
+            WHERE Id IN (SELECT Entity_Id FROM tweet_entities WHERE Tweet_Id = new.rowid);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tweets_entities_delete AFTER DELETE ON tweets BEGIN
+            UPDATE entities SET
+                Tweets = Tweets - {old_weight},
+                Sentiment_Sum = Sentiment_Sum - COALESCE(old.{SENTIMENT_COLUMN}, 0) * {old_weight},
+                Sentiment_Count = Sentiment_Count - (old.{SENTIMENT_COLUMN} IS NOT NULL) * {old_weight}
+            WHERE Id IN (SELECT Entity_Id FROM tweet_entities WHERE Tweet_Id = old.rowid);
+            DELETE FROM tweet_entities WHERE Tweet_Id = old.rowid;
+        END;
+    ''')
+
+
+def record(cursor, hashes, entities):
+    '''Link stored tweets, given by text hash, to their {(kind, value): weight} entities, as part of the caller's
+    transaction; linking a tweet to an entity again adds to the link's weight'''
+    linked = [(text_hash, tweet_entities) for text_hash, tweet_entities in zip(hashes, entities) if tweet_entities]
+    if not linked:
+        return
+    distinct = list({entity for _, tweet_entities in linked for entity in tweet_entities})
+    cursor.executemany('INSERT OR IGNORE INTO entities (Kind, Value) VALUES (?, ?)', distinct)
+    entity_ids = {}
+    tweet_ids = {}
+    for i in range(0, len(distinct), LOOKUP_SIZE):
+        chunk = distinct[i:i + LOOKUP_SIZE]
+        cursor.execute('SELECT Id, Kind, Value FROM entities WHERE '
+                       + ' OR '.join(['(Kind = ? AND Value = ?)'] * len(chunk)),
+                       [part for entity in chunk for part in entity])
+        entity_ids.update(((kind, value), entity_id) for entity_id, kind, value in cursor.fetchall())
+    hashes = list({text_hash for text_hash, _ in linked})
+    for i in range(0, len(hashes), LOOKUP_SIZE):
+        chunk = hashes[i:i + LOOKUP_SIZE]
+        # Duplicates fold into the first stored row of a hash, as SQLiteBackend.upsert does
+        cursor.execute(f'SELECT MIN(rowid), Text_Hash FROM tweets WHERE Text_Hash IN ({",".join("?" * len(chunk))}) '
+                       'GROUP BY Text_Hash', chunk)
+        tweet_ids.update((text_hash, rowid) for rowid, text_hash in cursor.fetchall())
+    cursor.executemany('INSERT INTO tweet_entities (Tweet_Id, Entity_Id, Weight) VALUES (?, ?, ?) '
+                       'ON CONFLICT (Tweet_Id, Entity_Id) DO UPDATE SET Weight = Weight + excluded.Weight',
+                       [(tweet_ids[text_hash], entity_ids[entity], weight) for text_hash, tweet_entities in linked
+                        if text_hash in tweet_ids for entity, weight in tweet_entities.items()])
+
+
+def top(conn, kind='hashtag', limit=10, min_tweets=1, ascending=False):
+    '''Returns (value, tweets, mean sentiment) of the entities of a kind with the highest (or lowest) mean'''
+    if kind not in KINDS:
+        raise ValueError(f'Unknown entity kind: {kind}')
+    order = 'ASC' if ascending else 'DESC'
+    return conn.execute(
+        'SELECT Value, Tweets, Mean_Sentiment FROM entities INDEXED BY idx_entities_kind_mean '
+        f'WHERE Kind = ? AND Mean_Sentiment IS NOT NULL AND Tweets >= ? ORDER BY Mean_Sentiment {order} LIMIT ?',
+        (kind, min_tweets, limit)).fetchall()
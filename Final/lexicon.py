@@ -0,0 +1,194 @@
+'''Compiled lexicons: sorted keys plus score arrays, memory-mapped read-only so every process shares one copy'''
+import argparse
+import os
+import subprocess
+import sys
+import numpy as np
+
+# Build the lexicons with `python lexicon.py build`; scoring.py falls back to the dict lexicons without them
+LEXICON_DIR = os.getenv('Lexicon_Dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicons'))
+VADER_NAME = 'vader'
+PATTERN_NAME = 'pattern'
+# The negations and modifier test of textblob's English Sentiment
+PATTERN_NEGATIONS = ('no', 'not', "n't", 'never')
+
+
+class MappedLexicon:
+    '''Class for looking words up in a compiled lexicon by binary search over its sorted keys'''
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = np.load(f'{path}.keys.npy', mmap_mode='r')
+        self.scores = np.load(f'{path}.scores.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, words):
+        '''Returns the scores of each word, or None for words not in the lexicon'''
+        if not words or not len(self.keys):
+            return [None] * len(words)
+        probe = np.array([word.encode('utf-8') for word in words])
+        index = np.minimum(np.searchsorted(self.keys, probe), len(self.keys) - 1)
+        found = (self.keys[index] == probe).tolist()
+        return [row if hit else None for row, hit in zip(self.scores[index].tolist(), found)]
+
+
+class MappedVaderTable(MappedLexicon):
+    '''Class for FastVader's (valence or None, booster scalar, is negation) entries, read from a compiled lexicon'''
+
+    def entries(self, words):
+        entries = []
+        for word, row in zip(words, self.rows(words)):
+            if row is None:
+                entries.append((None, 0.0, "n't" in word))
+            else:
+                valence, booster, negation, scored = row
+                entries.append((valence if scored else None, booster, negation))
+        return entries
+
+
+class MappedPatternLexicon(MappedLexicon):
+    '''Class for pattern's English sentiment lexicon, read from a compiled lexicon.
+
+    Implements textblob's Sentiment.assessments for untagged (word, None) pairs, which is
+    how PatternScorer calls it, using each word's scores averaged over its tags.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path)
+        from textblob._text import EMOTICONS, PUNCTUATION
+        self.punctuation = PUNCTUATION
+        # The first emoticon group listing a (lowercase) emoticon sets its polarity
+        self.emoticons = {}
+        for (_, polarity), emoticons in EMOTICONS.items():
+            for emoticon in emoticons:
+                self.emoticons.setdefault(emoticon.lower(), polarity)
+
+    def assessments(self, words, negation=True):
+        '''Returns (chunk, polarity, subjectivity, None) tuples, as textblob's Sentiment.assessments'''
+        words = [word for word, _ in words]
+        rows = self.rows([word or '' for word in words])
+        a = []
+        m = n = None
+        for w, row in zip(words, rows):
+            if w is None:
+                continue
+            if row is not None:
+                p, s, i, adverb = row
+                if m is None:
+                    a.append([[w], p, s, i, 1])
+                else:
+                    a[-1][0].append(w)
+                    a[-1][1] = max(-1.0, min(p * a[-1][3], +1.0))
+                    a[-1][2] = max(-1.0, min(s * a[-1][3], +1.0))
+                    a[-1][3] = i
+                if n is not None:
+                    a[-1][0].insert(0, n)
+                    a[-1][3] = 1.0 / a[-1][3]
+                    a[-1][4] = -1
+                m = w if adverb else None
+                n = w if negation and w in PATTERN_NEGATIONS else None
+                continue
+            if negation and w in PATTERN_NEGATIONS:
+                n = w
+            elif n and len(w.strip("'")) > 1:
+                n = None
+            if n is not None and m is not None and m.endswith('ly'):
+                a[-1][0].append(n)
+                a[-1][4] = -1
+                n = None
+            elif m and len(w) > 2:
+                m = None
+            if w == '!' and a:
+                a[-1][0].append('!')
+                a[-1][1] = max(-1.0, min(a[-1][1] * 1.25, +1.0))
+            if w == '(!)':
+                a.append([[w], 0.0, 1.0, 1.0, 1])
+            if not w.isalpha() and len(w) <= 5 and w not in self.punctuation and w in self.emoticons:
+                a.append([[w], self.emoticons[w], 1.0, 1.0, 1])
+        return [(chunk, p * -0.5 if n < 0 else p, s, None) for chunk, p, s, _, n in a]
+
+
+def write_lexicon(path, records):
+    '''Write (key, scores...) records as path.keys.npy (sorted UTF-8 keys) and path.scores.npy (one row each)'''
+    records = sorted((key.encode('utf-8'), [float(score) for score in scores]) for key, *scores in records)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.save(f'{path}.keys.npy', np.array([key for key, _ in records]))
+    np.save(f'{path}.scores.npy', np.array([scores for _, scores in records], dtype=np.float64))
+    return [f'{path}.keys.npy', f'{path}.scores.npy']
+
+
+def build_vader(path):
+    '''Compile FastVader's lookup table of nltk's VADER lexicon, boosters and negations'''
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer, VaderConstants
+    lexicon = SentimentIntensityAnalyzer().lexicon
+    constants = VaderConstants()
+    negations = set(constants.NEGATE)
+    # Scores: valence, booster scalar, is negation, has a valence
+    return write_lexicon(path, [(word, lexicon.get(word, 0.0), constants.BOOSTER_DICT.get(word, 0.0),
+                                 word in negations or "n't" in word, word in lexicon)
+                                for word in set(lexicon) | set(constants.BOOSTER_DICT) | negations])
+
+
+def build_pattern(path):
+    '''Compile pattern's English sentiment lexicon, keeping each word's scores averaged over its tags'''
+    from textblob.en import sentiment
+    # Scores: polarity, subjectivity, intensity, has an adverb (modifier) sense
+    return write_lexicon(path, [(word, *tags[None], 'RB' in tags) for word, tags in sentiment.items() if None in tags])
+
+
+def build(directory=LEXICON_DIR):
+    '''Compile both lexicons into the directory and return the files written'''
+    return build_vader(os.path.join(directory, VADER_NAME)) + build_pattern(os.path.join(directory, PATTERN_NAME))
+
+
+def load(cls, name, directory=None):
+    '''Returns the compiled lexicon in the directory, or None if it hasn't been built'''
+    path = os.path.join(directory or LEXICON_DIR, name)
+    return cls(path) if os.path.exists(f'{path}.scores.npy') else None
+
+
+def load_vader_table(directory=None):
+    return load(MappedVaderTable, VADER_NAME, directory)
+
+
+def load_pattern_lexicon(directory=None):
+    return load(MappedPatternLexicon, PATTERN_NAME, directory)
+
+
+# Loads the scorers in a fresh interpreter and prints seconds taken and private (anonymous) memory added
+MEASURE_SCRIPT = '''
+import time
+def rss_anon():
+    with open('/proc/self/status') as f:
+        return int(next(line for line in f if line.startswith('RssAnon')).split()[1])
+import scoring
+before, start = rss_anon(), time.perf_counter()
+scoring.get_vader_analyzer('fast').score_tokens(['good'], 'good')
+scoring.get_pattern_scorer().score_tokens(['good'])
+print(time.perf_counter() - start, rss_anon() - before)
+'''
+
+
+def measure(directory):
+    '''Returns (seconds, private KB) to load both scorers in a new process, with Lexicon_Dir set to directory'''
+    env = dict(os.environ, Lexicon_Dir=directory)
+    output = subprocess.run([sys.executable, '-c', MEASURE_SCRIPT], env=env, capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return float(output[0]), int(output[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=['build', 'measure'])
+    parser.add_argument('--dir', default=LEXICON_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for path in build(args.dir):
+            print(f'Wrote {path} ({os.path.getsize(path):,} bytes)')
+    else:
+        for label, directory in (('dict lexicons', os.path.join(args.dir, 'missing')), ('mapped lexicons', args.dir)):
+            seconds, private_kb = measure(directory)
+            print(f'{label:<16} load {seconds * 1000:6.1f} ms  private memory +{private_kb:,} KB per process')
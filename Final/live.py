@@ -0,0 +1,64 @@
+'''Server-side cursors of what each live dashboard client has already received'''
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+
+LIVE_COLUMNS = ['Text', 'Sentiment', 'Sentiment_Magnitude', 'Sentiment_VADER', 'Multiplicity']
+
+
+class LiveFeed:
+    '''Class for handing each client only the tweets stored since its last poll'''
+
+    def __init__(self, max_clients=1000, batch_limit=500):
+        self.max_clients = max_clients
+        self.batch_limit = batch_limit
+        self.lock = threading.Lock()
+        self.cursors = OrderedDict()
+
+    @staticmethod
+    def position(conn):
+        '''Returns the (generation, last rowid) of the tweets table; a clear moves the generation'''
+        try:
+            generation = conn.execute('SELECT Generation FROM tweets_generation WHERE Id = 0').fetchone()
+            return generation[0] if generation else 0, conn.execute('SELECT MAX(rowid) FROM tweets').fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            return 0, 0
+
+    def set_cursor(self, client_id, cursor):
+        with self.lock:
+            self.cursors[client_id] = cursor
+            self.cursors.move_to_end(client_id)
+            while len(self.cursors) > self.max_clients:
+                self.cursors.popitem(last=False)
+
+    def register(self, db_path, client_id=None):
+        '''Returns a client id whose feed starts after the tweets stored so far'''
+        client_id = client_id or uuid.uuid4().hex
+        with sqlite3.connect(db_path) as conn:
+            self.set_cursor(client_id, LiveFeed.position(conn))
+        return client_id
+
+    def poll(self, client_id, db_path):
+        '''Returns the (Text, scores..., Multiplicity) rows stored since the client's last poll'''
+        with self.lock:
+            cursor = self.cursors.get(client_id)
+        if cursor is None:
+            # Evicted, or the server restarted: resume from now
+            self.register(db_path, client_id)
+            return []
+        generation, last_rowid = cursor
+        with sqlite3.connect(db_path) as conn:
+            # Read the generation and the rows from one snapshot
+            conn.execute('BEGIN')
+            current, _ = LiveFeed.position(conn)
+            if current != generation:
+                # The table was cleared, so rowids start over
+                generation, last_rowid = current, 0
+            rows = conn.execute(f'SELECT rowid, {", ".join(LIVE_COLUMNS)} FROM tweets WHERE rowid > ? '
+                                'ORDER BY rowid LIMIT ?', (last_rowid, self.batch_limit)).fetchall()
+            conn.rollback()
+        if rows:
+            last_rowid = rows[-1][0]
+        self.set_cursor(client_id, (generation, last_rowid))
+        return [row[1:] for row in rows]
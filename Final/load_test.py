@@ -0,0 +1,162 @@
+'''Load generator driving the dashboard callbacks through the Flask test client'''
+import argparse
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from cache import TTLCache
+import main
+from main import Database, TwitterAPI
+from mock_twitter import MockTwitterConfig, MockTwitterServer
+
+CALLBACK_URL = '/_dash-update-component'
+
+
+def update_results_payload(n_clicks, query, max_tweets):
+    '''Returns the request body Dash sends when "Update Database" is clicked'''
+    return {
+        'output': '..sentiment-histogram.figure...table-store.data...sentiment-table.page_size..',
+        'outputs': [{'id': 'sentiment-histogram', 'property': 'figure'},
+                    {'id': 'table-store', 'property': 'data'},
+                    {'id': 'sentiment-table', 'property': 'page_size'}],
+        'inputs': [{'id': 'update-database-button', 'property': 'n_clicks', 'value': n_clicks}],
+        'state': [{'id': 'input-query', 'property': 'value', 'value': query},
+                  {'id': 'input-max-tweets', 'property': 'value', 'value': max_tweets}],
+        'changedPropIds': ['update-database-button.n_clicks'],
+    }
+
+
+def export_data_payload(n_clicks):
+    '''Returns the request body Dash sends when "Export Data" is clicked'''
+    return {
+        'output': 'download-dataframe-csv.data',
+        'outputs': {'id': 'download-dataframe-csv', 'property': 'data'},
+        'inputs': [{'id': 'export-button', 'property': 'n_clicks', 'value': n_clicks}],
+        'changedPropIds': ['export-button.n_clicks'],
+    }
+
+
+def percentile(values, pct):
+    '''Returns the pct-th percentile of values using nearest-rank'''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+@dataclass
+class LoadTestReport:
+    '''Dataclass for the results of a load test run'''
+    duration: float = 0.0
+    latencies: dict = field(default_factory=dict)
+    errors: dict = field(default_factory=dict)
+
+    @property
+    def total_requests(self):
+        return sum(len(v) for v in self.latencies.values()) + sum(self.errors.values())
+
+    @property
+    def requests_per_second(self):
+        return self.total_requests / self.duration if self.duration else 0.0
+
+    def summary(self):
+        '''Returns the report as printable lines'''
+        lines = [f'{self.total_requests} requests in {self.duration:.2f}s '
+                 f'({self.requests_per_second:.1f} req/s)']
+        for name, values in self.latencies.items():
+            lines.append(f'{name}: n={len(values)} errors={self.errors.get(name, 0)} '
+                         f'p50={percentile(values, 50) * 1000:.1f}ms '
+                         f'p95={percentile(values, 95) * 1000:.1f}ms')
+        return lines
+
+
+class LoadTest:
+    '''Class for driving concurrent update_results and export_data callbacks'''
+
+    def __init__(self, queries=('football',), max_tweets=10, export_ratio=0.5):
+        self.queries = queries
+        self.max_tweets = max_tweets
+        self.export_ratio = export_ratio
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def client(self):
+        '''Returns a Flask test client for the calling thread'''
+        if not hasattr(self.local, 'client'):
+            self.local.client = main.app.server.test_client()
+        return self.local.client
+
+    def request(self, i, report):
+        '''Send the i-th request and record its latency'''
+        # Interleave the two callbacks so every prefix of the run keeps the export ratio
+        if int((i + 1) * self.export_ratio) > int(i * self.export_ratio):
+            name, payload = 'export_data', export_data_payload(i + 1)
+        else:
+            query = self.queries[i % len(self.queries)]
+            name, payload = 'update_results', update_results_payload(i + 1, query, self.max_tweets)
+        start = time.perf_counter()
+        response = self.client().post(CALLBACK_URL, json=payload)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            if response.status_code == 200:
+                report.latencies.setdefault(name, []).append(elapsed)
+            else:
+                report.latencies.setdefault(name, [])
+                report.errors[name] = report.errors.get(name, 0) + 1
+
+    def run(self, total_requests=100, concurrency=8):
+        '''Run the load test and return a LoadTestReport'''
+        # Warm up lazily-initialised libraries (plotly, textblob) before timing concurrent requests
+        self.request(0, LoadTestReport())
+        self.request(1, LoadTestReport())
+        report = LoadTestReport()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda i: self.request(i, report), range(total_requests)))
+        report.duration = time.perf_counter() - start
+        return report
+
+
+def run_against_mock(total_requests=100, concurrency=8, mock_config=None, cache_ttl=None, **kwargs):
+    '''Start the mock API and a scratch database, run the load test, and restore the settings'''
+    os.environ.setdefault('Key_Twitter', 'load-test-key')
+    os.environ.setdefault('Secret_Key_Twitter', 'load-test-secret')
+    server = MockTwitterServer(mock_config)
+    base_url, db_path = TwitterAPI.base_url, Database.db_path
+    caches = TwitterAPI.search_cache, TwitterAPI.token_cache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            # Fresh caches so tokens of earlier mock servers aren't reused; cache_ttl=0 measures uncached searches
+            TwitterAPI.search_cache = TTLCache(caches[0].ttl if cache_ttl is None else cache_ttl)
+            TwitterAPI.token_cache = TTLCache(caches[1].ttl)
+            TwitterAPI.base_url = server.start()
+            Database.db_path = os.path.join(tmp_dir, 'tweets.db')
+            Database.create_table()
+            return LoadTest(**kwargs).run(total_requests, concurrency)
+        finally:
+            server.stop()
+            TwitterAPI.base_url, Database.db_path = base_url, db_path
+            TwitterAPI.search_cache, TwitterAPI.token_cache = caches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-tweets', type=int, default=10)
+    parser.add_argument('--export-ratio', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock API calls that fail')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='Search cache TTL in seconds (0 disables it)')
+    args = parser.parse_args()
+
+    result = run_against_mock(
+        args.requests, args.concurrency,
+        MockTwitterConfig(latency=args.latency, error_rate=args.error_rate),
+        cache_ttl=args.cache_ttl, max_tweets=args.max_tweets, export_ratio=args.export_ratio)
+    for line in result.summary():
+        print(line)
@@ -0,0 +1,200 @@
+'''Local stand-in for the Twitter API, used for load testing the dashboard'''
+import json
+import random
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# Templates the fake tweets are built from, with the mentions, hashtags and links Tweet.clean strips
+TEMPLATES = [
+    'I love {query}, best purchase this year! #happy',
+    '@support my {query} stopped working again... really disappointed http://t.co/abc',
+    'Just saw the new {query} ad. Not bad at all',
+    'Why is {query} so expensive?? #ripoff',
+    '{query} customer service was amazing today @helpdesk',
+    'Honestly {query} is okay, nothing special https://t.co/xyz',
+    'Worst experience ever with {query}. Never again!!!',
+    'Can anyone recommend an alternative to {query}?',
+    'So happy with my {query} upgrade :) #winning',
+    '{query} is down AGAIN, this is terrible',
+]
+
+
+@dataclass
+class MockTwitterConfig:
+    '''Dataclass for configuring the mock Twitter API'''
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    rate_limit: int = 450
+    rate_limit_window: int = 900
+    corpus_size: int = 1000
+    seed: int = 0
+    stream_query: str = 'stream'
+    stream_rate: float = 50.0
+    stream_limit: int = 0
+    heartbeat: float = 1.0
+
+
+class MockTwitterServer:
+    '''Class serving the token, recent search and filtered stream endpoints from a generated corpus'''
+
+    def __init__(self, config=None):
+        self.config = config or MockTwitterConfig()
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.windows = {}
+        self.request_count = 0
+        self.server = None
+        self.thread = None
+        self.app = self.create_app()
+
+    def generate_tweets(self, query):
+        '''Returns the (deterministic) corpus of tweets matching the query, newest first'''
+        rng = random.Random(f'{self.config.seed}:{query}')
+        newest = datetime(2023, 10, 1, tzinfo=timezone.utc)
+        tweets = []
+        for i in range(self.config.corpus_size):
+            created_at = newest - timedelta(seconds=30 * i + rng.randint(0, 29))
+            tweets.append({
+                'id': str(1700000000000000000 - i),
+                'text': rng.choice(TEMPLATES).format(query=query),
+                'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            })
+        return tweets
+
+    def simulate_latency(self):
+        '''Sleep for the configured latency plus jitter'''
+        delay = self.config.latency + self.random.uniform(0, self.config.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def inject_error(self):
+        '''Returns an error response for the configured fraction of requests'''
+        with self.lock:
+            self.request_count += 1
+            failed = self.random.random() < self.config.error_rate
+        if failed:
+            return jsonify({'title': 'Service Unavailable', 'detail': 'Injected error'}), self.config.error_status
+        return None
+
+    def check_rate_limit(self, token):
+        '''Returns the rate-limit headers for the token, and whether the request is allowed'''
+        now = time.time()
+        with self.lock:
+            reset, used = self.windows.get(token, (now + self.config.rate_limit_window, 0))
+            if now >= reset:
+                reset, used = now + self.config.rate_limit_window, 0
+            allowed = used < self.config.rate_limit
+            if allowed:
+                used += 1
+            self.windows[token] = (reset, used)
+        headers = {
+            'x-rate-limit-limit': str(self.config.rate_limit),
+            'x-rate-limit-remaining': str(self.config.rate_limit - used),
+            'x-rate-limit-reset': str(int(reset)),
+        }
+        return headers, allowed
+
+    def create_app(self):
+        '''Returns the Flask app implementing the API endpoints'''
+        app = Flask(__name__)
+
+        @app.route('/oauth2/token', methods=['POST'])
+        def token():
+            self.simulate_latency()
+            error = self.inject_error()
+            if error:
+                return error
+            if not request.headers.get('Authorization', '').startswith('Basic '):
+                return jsonify({'errors': [{'code': 99, 'message': 'Unable to verify your credentials'}]}), 403
+            if request.form.get('grant_type') != 'client_credentials':
+                return jsonify({'errors': [{'code': 170, 'message': 'Missing required parameter: grant_type'}]}), 403
+            access_token = secrets.token_urlsafe(32)
+            with self.lock:
+                self.tokens.add(access_token)
+            return jsonify({'token_type': 'bearer', 'access_token': access_token})
+
+        @app.route('/2/tweets/search/recent', methods=['GET'])
+        def search_recent():
+            self.simulate_latency()
+            error = self.inject_error()
+            if error:
+                return error
+            token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+            if token not in self.tokens:
+                return jsonify({'title': 'Unauthorized', 'status': 401}), 401
+            headers, allowed = self.check_rate_limit(token)
+            if not allowed:
+                return jsonify({'title': 'Too Many Requests', 'status': 429}), 429, headers
+
+            query = request.args.get('query', '')
+            max_results = request.args.get('max_results', 10, type=int)
+            if not query or not 10 <= max_results <= 100:
+                return jsonify({'title': 'Invalid Request', 'status': 400}), 400, headers
+            offset = request.args.get('next_token', 0, type=int)
+            corpus = self.generate_tweets(query)
+            since_id = request.args.get('since_id', type=int)
+            if since_id:
+                corpus = [tweet for tweet in corpus if int(tweet['id']) > since_id]
+            page = corpus[offset:offset + max_results]
+            meta = {'result_count': len(page)}
+            if page:
+                meta['newest_id'], meta['oldest_id'] = page[0]['id'], page[-1]['id']
+            if offset + max_results < len(corpus):
+                meta['next_token'] = str(offset + max_results)
+            return jsonify({'data': page, 'meta': meta}) if page else jsonify({'meta': meta}), 200, headers
+
+        @app.route('/2/tweets/search/stream', methods=['GET'])
+        def search_stream():
+            error = self.inject_error()
+            if error:
+                return error
+            token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+            if token not in self.tokens:
+                return jsonify({'title': 'Unauthorized', 'status': 401}), 401
+            return Response(self.replay_stream(), mimetype='application/json')
+
+        return app
+
+    def replay_stream(self):
+        '''Yields the corpus as line-delimited JSON at stream_rate, stamped with the current time'''
+        corpus = self.generate_tweets(self.config.stream_query)
+        interval = 1.0 / self.config.stream_rate if self.config.stream_rate else 0.0
+        last_line = time.time()
+        for i in range(self.config.stream_limit or 2 ** 62):
+            if interval:
+                time.sleep(interval)
+            if time.time() - last_line > self.config.heartbeat:
+                yield '\r\n'
+            tweet = dict(corpus[i % len(corpus)])
+            tweet['created_at'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            last_line = time.time()
+            yield json.dumps({'data': tweet, 'matching_rules': [{'id': '1', 'tag': self.config.stream_query}]}) + '\r\n'
+
+    def start(self, host='127.0.0.1', port=0):
+        '''Serve the API from a background thread and return its base URL'''
+        # HTTP/1.1 so streamed responses are sent chunked instead of buffered until close
+        handler = type('MockRequestHandler', (WSGIRequestHandler,), {'protocol_version': 'HTTP/1.1'})
+        self.server = make_server(host, port, self.app, threaded=True, request_handler=handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f'http://{host}:{self.server.server_port}'
+
+    def stop(self):
+        '''Shut the background server down'''
+        if self.server:
+            self.server.shutdown()
+            self.thread.join()
+            self.server = None
+
+
+if __name__ == '__main__':
+    # Point the dashboard at this server with Base_URL_Twitter=http://127.0.0.1:5050
+    MockTwitterServer().app.run(port=5050, threaded=True)
@@ -0,0 +1,150 @@
+'''Compact callback payloads: fast JSON, columnar tables, rounded floats and compressed responses'''
+import argparse
+import gzip
+import json
+import os
+import random
+import time
+import pandas as pd
+import plotly.io as pio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PRECISION = int(os.getenv('Payload_Precision', '4'))
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/css', 'application/javascript', 'text/javascript'}
+
+# Expands a columnar table payload (row lists in "data", or column arrays in "arrays") into the
+# records a DataTable needs, in the browser
+EXPAND_COLUMNAR_JS = '''function(payload) {
+    if (!payload) { return window.dash_clientside.no_update; }
+    if (payload.arrays) {
+        var length = payload.arrays.length ? payload.arrays[0].length : 0;
+        var rows = [];
+        for (var r = 0; r < length; r++) {
+            var row = {};
+            payload.columns.forEach(function(column, i) { row[column] = payload.arrays[i][r]; });
+            rows.push(row);
+        }
+        return rows;
+    }
+    return payload.data.map(function(row) {
+        var record = {};
+        payload.columns.forEach(function(column, i) { record[column] = row[i]; });
+        return record;
+    });
+}'''
+
+
+def use_fast_json():
+    '''Serialize callback responses with orjson when it is installed'''
+    pio.json.config.default_engine = 'orjson' if orjson else 'json'
+
+
+def columnar(df, precision=PRECISION):
+    '''Returns a DataFrame as {"columns": [...], "data": [[...], ...]}, with floats rounded'''
+    rounded = df.round(precision) if precision is not None else df
+    return rounded.to_dict('split', index=False)
+
+
+def records(payload):
+    '''Returns the rows of a columnar payload as records'''
+    if 'arrays' in payload:
+        return [dict(zip(payload['columns'], row)) for row in zip(*payload['arrays'])]
+    return [dict(zip(payload['columns'], row)) for row in payload['data']]
+
+
+def accepted_encoding(accept_encoding):
+    '''Returns the best response encoding the client accepts, if any'''
+    accepted = {part.split(';')[0].strip() for part in accept_encoding.lower().split(',')}
+    if brotli and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level)
+
+
+def compress_responses(server, min_size=COMPRESS_MIN_SIZE, level=6):
+    '''Compress the Flask server's JSON, HTML and script responses with brotli or gzip'''
+    from flask import request
+
+    @server.after_request
+    def compress_response(response):
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+        if (encoding is None or response.direct_passthrough or response.status_code < 200
+                or response.status_code >= 300 or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESS_MIMETYPES):
+            return response
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        response.set_data(compress(body, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(response.get_data()))
+        response.vary.add('Accept-Encoding')
+        return response
+
+    return compress_response
+
+
+def sample_frame(rows=10000, seed=0):
+    '''Returns a table of rows shaped like the dashboard's sentiment table'''
+    rng = random.Random(seed)
+    words = ['love', 'hate', 'phone', 'battery', 'great', 'terrible', 'update', 'service', 'today', 'again']
+    return pd.DataFrame({
+        'Text': [' '.join(rng.choice(words) for _ in range(rng.randint(5, 20))) for _ in range(rows)],
+        'Sentiment': [rng.uniform(-1, 1) for _ in range(rows)],
+        'Sentiment_Magnitude': [rng.uniform(0, 1) for _ in range(rows)],
+        'Sentiment_VADER': [rng.uniform(-1, 1) for _ in range(rows)],
+        'Multiplicity': [rng.randint(1, 3) for _ in range(rows)],
+    })
+
+
+def timed(encode, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = encode()
+    return body, (time.perf_counter() - start) / repeat
+
+
+def benchmark(rows=10000, repeat=5, precision=PRECISION):
+    '''Returns bytes, compressed bytes and serialization time of a table payload, before and after'''
+    df = sample_frame(rows)
+    encodings = {
+        'records + json': lambda: json.dumps(df.to_dict('records')).encode('utf-8'),
+        'split + json': lambda: json.dumps(columnar(df, None)).encode('utf-8'),
+        f'split + round({precision}) + json': lambda: json.dumps(columnar(df, precision)).encode('utf-8'),
+    }
+    if orjson:
+        encodings['records + orjson'] = lambda: orjson.dumps(df.to_dict('records'))
+        encodings[f'split + round({precision}) + orjson'] = lambda: orjson.dumps(columnar(df, precision))
+    results = {}
+    for name, encode in encodings.items():
+        body, seconds = timed(encode, repeat)
+        results[name] = {'bytes': len(body), 'gzip': len(gzip.compress(body, 6)),
+                         'br': len(brotli.compress(body, quality=6)) if brotli else None, 'ms': seconds * 1000}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--precision', type=int, default=PRECISION)
+    args = parser.parse_args()
+
+    for name, result in benchmark(args.rows, precision=args.precision).items():
+        br = f"{result['br']:>9,}" if result['br'] else '        -'
+        print(f"{name:<32} {result['bytes']:>10,} B  gzip {result['gzip']:>9,} B  br {br} B  {result['ms']:7.1f} ms")
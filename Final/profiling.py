@@ -0,0 +1,265 @@
+'''On-demand profiling of Dash callbacks, armed through an authenticated admin route'''
+import cProfile
+import functools
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+# Profiling routes answer 404 unless Admin_Token is set; requests authenticate with "Authorization: Bearer <token>"
+ADMIN_TOKEN = os.getenv('Admin_Token')
+SAMPLE_INTERVAL = 0.005
+MAX_REPORTS = 20
+TRACEMALLOC_TOP = 25
+REPORT_FILES = {'pstats': ('application/octet-stream', 'pstats'), 'collapsed': ('text/plain', 'collapsed.txt'),
+                'tracemalloc': ('text/plain', 'tracemalloc.txt')}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    '''Class for sampling a thread's stack at a fixed interval into collapsed-stack counts'''
+
+    def __init__(self, thread_id, root, interval=SAMPLE_INTERVAL, counts=None):
+        self.thread_id = thread_id
+        # Frames at and above root (the server and dispatch machinery) are left out of the stacks
+        self.root = root
+        self.interval = interval
+        self.counts = Counter() if counts is None else counts
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+
+class ProfileReport:
+    '''Class for the merged profile of the armed runs of one callback'''
+
+    def __init__(self, report_id, callback, runs, trace_memory, interval):
+        self.id = report_id
+        self.callback = callback
+        self.runs = runs
+        self.trace_memory = trace_memory
+        self.interval = interval
+        self.armed_at = time.time()
+        self.running = self.completed = 0
+        self.seconds = []
+        self.stats = None
+        self.stacks = Counter()
+        self.allocations = []
+        self.lock = threading.Lock()
+
+    def add(self, profile, seconds, allocations):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.seconds.append(seconds)
+            if allocations is not None:
+                self.allocations.append(allocations)
+            self.completed += 1
+
+    def files(self):
+        '''Returns the report's downloads: binary pstats, collapsed stacks and tracemalloc diffs'''
+        with self.lock:
+            files = {'collapsed': ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())}
+            if self.stats is not None:
+                files['pstats'] = dump_stats(self.stats)
+            if self.trace_memory:
+                files['tracemalloc'] = '\n\n'.join(
+                    f'Run {i + 1}:\n' + '\n'.join(str(stat) for stat in diff)
+                    for i, diff in enumerate(self.allocations))
+            return files
+
+    def summary(self):
+        with self.lock:
+            top = []
+            if self.stats is not None:
+                text = io.StringIO()
+                stats = pstats.Stats(stream=text)
+                stats.add(self.stats)
+                stats.sort_stats('cumulative').print_stats(10)
+                top = text.getvalue().splitlines()
+            return {'id': self.id, 'callback': self.callback, 'runs': self.runs, 'completed': self.completed,
+                    'seconds': self.seconds, 'tracemalloc': self.trace_memory, 'armed_at': self.armed_at,
+                    'samples': sum(self.stacks.values()), 'top': top}
+
+
+def dump_stats(stats):
+    '''Returns the stats in the marshal format of Stats.dump_stats, which pstats and snakeviz load'''
+    return marshal.dumps(stats.stats)
+
+
+class CallbackProfiler:
+    '''Class for profiling the next runs of a Dash callback by swapping it in app.callback_map while armed'''
+
+    def __init__(self, app, max_reports=MAX_REPORTS):
+        self.app = app
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.reports = deque(maxlen=max_reports)
+        # callback_map key -> (original callback, report) while armed
+        self.armed = {}
+        self.started_tracing = False
+        self.token = None
+
+    def callback_keys(self, name):
+        '''Returns the callback_map keys of the callback with this function name (or key)'''
+        return [key for key, entry in self.app.callback_map.items()
+                if entry.get('callback') and (key == name or entry['callback'].__name__ == name)]
+
+    def callback_names(self):
+        return sorted({entry['callback'].__name__ for entry in self.app.callback_map.values()
+                       if entry.get('callback')})
+
+    def arm(self, name, runs=1, trace_memory=False, interval=SAMPLE_INTERVAL):
+        '''Profile the next runs of the callback, returning the report they are collected into'''
+        keys = self.callback_keys(name)
+        if not keys:
+            raise KeyError(f'Unknown callback: {name}')
+        if runs < 1:
+            raise ValueError('runs must be at least 1')
+        with self.lock:
+            if any(key in self.armed for key in keys):
+                raise ValueError(f'{name} is already armed')
+            report = ProfileReport(next(self.ids), name, runs, trace_memory, interval)
+            self.reports.append(report)
+            for key in keys:
+                original = self.app.callback_map[key]['callback']
+                self.armed[key] = (original, report)
+                self.app.callback_map[key]['callback'] = self.wrap(key, original, report)
+            if trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+        return report
+
+    def disarm(self, key):
+        with self.lock:
+            original, _ = self.armed.pop(key, (None, None))
+            if original is not None:
+                self.app.callback_map[key]['callback'] = original
+            if self.started_tracing and not any(armed.trace_memory for _, armed in self.armed.values()):
+                tracemalloc.stop()
+                self.started_tracing = False
+
+    def disarm_all(self):
+        for key in list(self.armed):
+            self.disarm(key)
+
+    def claim(self, report):
+        '''Counts a run against the report, returning False once its runs are used up'''
+        with self.lock:
+            if report.completed + report.running >= report.runs:
+                return False
+            report.running += 1
+            return True
+
+    def wrap(self, key, original, report):
+        @functools.wraps(original)
+        def profiled(*args, **kwargs):
+            if not self.claim(report):
+                return original(*args, **kwargs)
+            snapshot = tracemalloc.take_snapshot() if report.trace_memory and tracemalloc.is_tracing() else None
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                with StackSampler(threading.get_ident(), sys._getframe(), report.interval, report.stacks):
+                    return profile.runcall(original, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                allocations = None
+                if snapshot is not None:
+                    allocations = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:TRACEMALLOC_TOP]
+                report.add(profile, seconds, allocations)
+                with self.lock:
+                    report.running -= 1
+                if report.completed >= report.runs:
+                    self.disarm(key)
+        return profiled
+
+    def report(self, report_id):
+        return next((report for report in self.reports if report.id == report_id), None)
+
+    def status(self):
+        with self.lock:
+            armed = {report.callback: report.runs - report.completed for _, report in self.armed.values()}
+        return {'callbacks': self.callback_names(), 'armed': armed,
+                'reports': [report.summary() for report in self.reports]}
+
+    def install(self, server, token=ADMIN_TOKEN, prefix='/admin/profile'):
+        '''Add the authenticated routes for arming callbacks and downloading reports to the Flask server'''
+        from flask import Response, abort, jsonify, request
+
+        self.token = token
+
+        def authorize():
+            if not self.token:
+                abort(404)
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+            if not hmac.compare_digest(supplied.encode(), self.token.encode()):
+                abort(401)
+
+        @server.route(prefix, methods=['GET'], endpoint='profile_status')
+        def profile_status():
+            authorize()
+            return jsonify(self.status())
+
+        @server.route(prefix, methods=['POST'], endpoint='profile_arm')
+        def profile_arm():
+            authorize()
+            params = request.get_json(silent=True) or request.form
+            try:
+                report = self.arm(params.get('callback', ''), int(params.get('runs', 1)),
+                                  str(params.get('tracemalloc', '')).lower() in ('1', 'true', 'yes'),
+                                  float(params.get('interval', SAMPLE_INTERVAL)))
+            except KeyError as exc:
+                return jsonify({'error': exc.args[0], 'callbacks': self.callback_names()}), 404
+            except ValueError as exc:
+                return jsonify({'error': str(exc)}), 400
+            return jsonify(report.summary()), 201
+
+        @server.route(prefix, methods=['DELETE'], endpoint='profile_disarm')
+        def profile_disarm():
+            authorize()
+            self.disarm_all()
+            return jsonify(self.status())
+
+        @server.route(f'{prefix}/<int:report_id>/<kind>', methods=['GET'], endpoint='profile_download')
+        def profile_download(report_id, kind):
+            authorize()
+            report = self.report(report_id)
+            files = report.files() if report else {}
+            if kind not in files:
+                abort(404)
+            mimetype, suffix = REPORT_FILES[kind]
+            return Response(files[kind], mimetype=mimetype, headers={
+                'Content-Disposition': f'attachment; filename={report.callback}-{report.id}.{suffix}'})
+
+        return self
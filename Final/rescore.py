@@ -0,0 +1,138 @@
+'''Resumable in-place rescoring of the stored tweets, in rowid chunks scored in parallel'''
+import argparse
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from main import SCORE_COLUMNS, Database, Tweet
+from scoring import FULL_SCORING
+from storage import SQLiteBackend, check_column
+
+
+def score_rows(chunk):
+    '''Score one chunk of (rowid, Text) rows in a pool worker, returning (rowid, scores...) rows'''
+    last_rowid, rows, columns = chunk
+    scored = []
+    for rowid, text in rows:
+        # Stored text is already cleaned; cleaning it again would collapse its spacing
+        tweet = Tweet(text=text or '')
+        tweet.analyze(FULL_SCORING)
+        scored.append((rowid, *(getattr(tweet, column.lower()) for column in columns)))
+    return last_rowid, scored
+
+
+class Rescore:
+    '''Class for rewriting score columns of the tweets table with checkpointed, bulk transactions'''
+
+    def __init__(self, db_path=None, job='rescore', columns=None, chunk_size=5000, workers=None, pending=False):
+        if Database.storage_format == 'compact':
+            # Scores are rewritten in the plain tweets table, which the compact layout doesn't have
+            raise ValueError('Rescore needs the plain storage format; unset Storage_Format=compact to rescore')
+        self.db_path = db_path or Database.db_path
+        self.job = job
+        # Only rescore rows with a column left pending (NULL) by a cheaper scoring policy
+        self.pending = pending
+        self.columns = [check_column(column) for column in columns or SCORE_COLUMNS]
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.rows = self.resumed_rows = 0
+        self.started = time.perf_counter()
+
+    def connect(self):
+        Database.create_table(self.db_path)
+        conn = SQLiteBackend(self.db_path).connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS rescore_progress (Job TEXT PRIMARY KEY, Last_Rowid INTEGER, Rows INTEGER)')
+        conn.commit()
+        return conn
+
+    def checkpoint(self, conn):
+        '''Returns the (last rowid, rows) already rescored by this job'''
+        row = conn.execute('SELECT Last_Rowid, Rows FROM rescore_progress WHERE Job = ?', (self.job,)).fetchone()
+        return row or (0, 0)
+
+    def reset(self):
+        '''Forget the job's progress, so the next run starts from the first row'''
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM rescore_progress WHERE Job = ?', (self.job,))
+        conn.close()
+
+    def read_chunks(self, last_rowid):
+        '''Yield (last_rowid, rows, columns) chunks of the table after last_rowid'''
+        where = 'rowid > ?'
+        if self.pending:
+            where += f' AND ({" OR ".join(f"{column} IS NULL" for column in self.columns)})'
+        with sqlite3.connect(self.db_path) as conn:
+            while True:
+                rows = conn.execute(f'SELECT rowid, Text FROM tweets WHERE {where} ORDER BY rowid LIMIT ?',
+                                    (last_rowid, self.chunk_size)).fetchall()
+                if not rows:
+                    return
+                last_rowid = rows[-1][0]
+                yield last_rowid, rows, self.columns
+
+    def commit(self, conn, scored, last_rowid):
+        '''Write the scores back and advance the checkpoint in one transaction'''
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            SQLiteBackend.bulk_update(conn.cursor(), self.columns, scored)
+            if not self.pending:
+                conn.execute('INSERT OR REPLACE INTO rescore_progress (Job, Last_Rowid, Rows) VALUES (?, ?, ?)',
+                             (self.job, last_rowid, self.rows + len(scored)))
+        self.rows += len(scored)
+
+    def collect(self, conn, result):
+        last_rowid, scored = result
+        self.commit(conn, scored, last_rowid)
+        print(f'{self.rows} rows rescored ({self.rate():,.0f} rows/s)')
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return (self.rows - self.resumed_rows) / elapsed if elapsed else 0.0
+
+    def run(self):
+        '''Rescore the rows after the job's checkpoint and return rows per second'''
+        conn = self.connect()
+        # Filled rows are no longer pending, so a pending run needs no checkpoint to resume
+        last_rowid, self.rows = (0, 0) if self.pending else self.checkpoint(conn)
+        if last_rowid:
+            print(f'Resuming {self.job} after rowid {last_rowid} ({self.rows} rows already rescored)')
+        self.started, self.resumed_rows = time.perf_counter(), self.rows
+        # Chunks are committed in rowid order, so the checkpoint never skips an unwritten chunk
+        max_in_flight = 2 * (self.workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(self.workers) as pool:
+            in_flight = deque()
+            for chunk in self.read_chunks(last_rowid):
+                in_flight.append(pool.submit(score_rows, chunk))
+                if len(in_flight) >= max_in_flight:
+                    self.collect(conn, in_flight.popleft().result())
+            while in_flight:
+                self.collect(conn, in_flight.popleft().result())
+        # Finished: the next run (e.g. after changing the analyzers) rescores every row again
+        with conn:
+            conn.execute('DELETE FROM rescore_progress WHERE Job = ?', (self.job,))
+        conn.close()
+        rate = self.rate()
+        print(f'Done: {self.rows - self.resumed_rows} rows rescored in {time.perf_counter() - self.started:.1f}s '
+              f'({rate:,.0f} rows/s)')
+        return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default=Database.db_path)
+    parser.add_argument('--job', default='rescore', help='Name the progress checkpoint is kept under')
+    parser.add_argument('--columns', nargs='+', choices=SCORE_COLUMNS, default=SCORE_COLUMNS)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--restart', action='store_true', help='Rescore from the first row')
+    parser.add_argument('--pending', action='store_true', help='Only fill the columns left pending by Scoring_Columns '
+                                                               'or Scoring_Cheap_First')
+    args = parser.parse_args()
+
+    rescore = Rescore(args.db, args.job, args.columns, args.chunk_size, args.workers, args.pending)
+    if args.restart:
+        rescore.reset()
+    rescore.run()
@@ -0,0 +1,273 @@
+'''Scheduled refreshes of tracked queries, sharing the API request budget fairly by priority'''
+import argparse
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from main import Database, TwitterAPI, parse_created_at
+from stream import store_batch
+
+# Recent search allows 450 requests per 15 minutes with app authentication
+DEFAULT_BUDGET = 450
+DEFAULT_WINDOW = 900.0
+
+
+@dataclass
+class TrackedQuery:
+    '''Dataclass for a tracked query and its refresh state'''
+    query: str
+    interval: float = 300.0
+    priority: float = 1.0
+    max_tweets: int = 100
+    since_id: str = None
+    next_token: str = None
+    newest_id: str = None
+    next_due: float = 0.0
+    last_refresh: float = None
+    newest_created_at: float = None
+    virtual_time: float = 0.0
+    refreshes: int = 0
+    tweets: int = 0
+    errors: int = 0
+
+    def lag(self, now):
+        '''Returns the seconds since the last successful refresh (or None), and how long the refresh is overdue'''
+        staleness = now - self.last_refresh if self.last_refresh is not None else None
+        return staleness, max(0.0, now - self.next_due)
+
+
+@dataclass
+class SchedulerConfig:
+    '''Dataclass for configuring the scheduler, usually loaded from a JSON file'''
+    queries: list = field(default_factory=list)
+    budget: int = DEFAULT_BUDGET
+    window: float = DEFAULT_WINDOW
+    burst: int = 10
+    jitter: float = 0.1
+    tick: float = 1.0
+    report_every: float = 60.0
+
+    @staticmethod
+    def load(path):
+        '''Returns the config in a JSON file of {"queries": [{"query", "interval", "priority", ...}], "budget", ...}'''
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        queries = [TrackedQuery(**{'query': item} if isinstance(item, str) else item)
+                   for item in data.pop('queries', [])]
+        for query in queries:
+            if query.interval <= 0 or query.priority <= 0:
+                raise ValueError(f'Interval and priority of {query.query!r} must be positive')
+        return SchedulerConfig(queries=queries, **data)
+
+
+class TokenBucket:
+    '''Class for a token bucket refilled at rate tokens per second, up to capacity'''
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        '''Spend a token if one is available'''
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        '''Returns the seconds until a token is available'''
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class QueryScheduler:
+    '''Class for refreshing due queries in weighted fair order under a shared request budget'''
+
+    def __init__(self, config, db_path=None, clock=time.time, sleep=time.sleep, seed=None):
+        self.config = config
+        self.db_path = db_path or Database.db_path
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.bucket = TokenBucket(config.budget / config.window, config.burst, clock)
+        self.queries = {query.query: query for query in config.queries}
+        # Start-time fair queueing: the due query with the earliest virtual start time goes next, and each
+        # refresh advances its virtual time by 1 / priority, so scarce requests are shared in proportion to
+        # priority; a query that was idle restarts from the virtual clock instead of saving up credit
+        self.virtual_clock = 0.0
+        self.stopped = threading.Event()
+        self.bearer_token = None
+        self.last_report = clock()
+        now = clock()
+        # Pick up where the last run left off, so restarts fetch incrementally too
+        with self.connect() as conn:
+            saved = {row[0]: row[1:] for row in conn.execute(
+                'SELECT Query, Since_Id, Last_Refresh, Newest_Created_At, Refreshes, Tweets, Errors, Next_Token, '
+                'Newest_Id FROM tracked_queries')}
+        for query in self.queries.values():
+            if query.query in saved:
+                (query.since_id, query.last_refresh, query.newest_created_at, query.refreshes,
+                 query.tweets, query.errors, query.next_token, query.newest_id) = saved[query.query]
+            # Spread the first refreshes over a jitter window instead of firing them all at once
+            query.next_due = now + self.random.uniform(0, config.jitter * query.interval)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('CREATE TABLE IF NOT EXISTS tracked_queries (Query TEXT PRIMARY KEY, Since_Id TEXT, '
+                     'Last_Refresh REAL, Newest_Created_At REAL, Refreshes INTEGER, Tweets INTEGER, Errors INTEGER)')
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(tracked_queries)')}
+        for column in ('Next_Token', 'Newest_Id'):
+            if column not in existing:
+                conn.execute(f'ALTER TABLE tracked_queries ADD COLUMN {column} TEXT')
+        return conn
+
+    def save(self, query):
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO tracked_queries (Query, Since_Id, Last_Refresh, Newest_Created_At, '
+                         'Refreshes, Tweets, Errors, Next_Token, Newest_Id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (query.query, query.since_id, query.last_refresh, query.newest_created_at,
+                          query.refreshes, query.tweets, query.errors, query.next_token, query.newest_id))
+
+    def next_interval(self, query):
+        '''Returns the query's interval, jittered so refreshes of equal intervals drift apart'''
+        return query.interval * (1 + self.random.uniform(-self.config.jitter, self.config.jitter))
+
+    def token(self):
+        if self.bearer_token is None:
+            encoded_keys = TwitterAPI.encode_api_keys(os.getenv('Key_Twitter'), os.getenv('Secret_Key_Twitter'))
+            self.bearer_token = TwitterAPI.get_bearer_token(encoded_keys)
+        return self.bearer_token
+
+    def refresh(self, query):
+        '''Fetch the query's tweets newer than its since_id, a page per request the budget allows, and store them'''
+        now = self.clock()
+        query.next_due = now + self.next_interval(query)
+        self.virtual_clock = self.start_time(query)
+        query.virtual_time = self.virtual_clock + 1 / query.priority
+        items = []
+        page = TwitterAPI.fetch_page(self.token(), query.query, query.max_tweets, query.since_id, query.next_token)
+        while page is not None:
+            batch, query.next_token = page
+            if batch:
+                items.extend(batch)
+                ids = [item['id'] for item in batch if item.get('id')] + ([query.newest_id] if query.newest_id else [])
+                query.newest_id = max(ids, key=int, default=None)
+                created = [parse_created_at(item['created_at']) for item in batch if item.get('created_at')]
+                if query.newest_created_at is not None:
+                    created.append(query.newest_created_at)
+                query.newest_created_at = max(created, default=None)
+            # A first refresh only takes the newest page; later ones page back until they reach since_id
+            if query.since_id is None or query.next_token is None or not self.bucket.take():
+                break
+            page = TwitterAPI.fetch_page(self.token(), query.query, query.max_tweets, query.since_id, query.next_token)
+        if items:
+            # Stored once, so the pages are deduplicated together and the detector sees them in time order
+            store_batch(items, query.query, self.db_path)
+        if query.since_id is None:
+            query.next_token = None
+        # Results come newest first, so since_id only moves on once every page down to it was fetched;
+        # until then the next refresh resumes from next_token
+        if query.next_token is None and query.newest_id is not None:
+            query.since_id, query.newest_id = query.newest_id, None
+        if page is None:
+            # A revoked token is cleared from the cache by fetch_page; fetch a fresh one next time
+            self.bearer_token = None
+            query.errors += 1
+        else:
+            query.refreshes += 1
+            query.last_refresh = now
+        query.tweets += len(items)
+        self.save(query)
+        return items
+
+    def start_time(self, query):
+        return max(query.virtual_time, self.virtual_clock)
+
+    def due(self, now):
+        return [query for query in self.queries.values() if query.next_due <= now]
+
+    def run_once(self):
+        '''Refresh the due queries the budget allows, fairest first, and return them'''
+        refreshed = []
+        due = self.due(self.clock())
+        while due and self.bucket.take():
+            query = min(due, key=lambda q: (self.start_time(q), q.next_due))
+            due.remove(query)
+            self.refresh(query)
+            refreshed.append(query)
+        return refreshed
+
+    def wait_time(self):
+        '''Returns the seconds until the next refresh can run'''
+        now = self.clock()
+        until_due = min((query.next_due - now for query in self.queries.values()), default=self.config.tick)
+        if until_due <= 0:
+            return min(self.bucket.wait_time(), self.config.tick)
+        return min(until_due, self.config.tick)
+
+    def status(self):
+        '''Returns each query's refresh counts and lag: seconds since its last refresh, and seconds overdue'''
+        now = self.clock()
+        status = {}
+        for query in self.queries.values():
+            staleness, overdue = query.lag(now)
+            status[query.query] = {
+                'interval': query.interval, 'priority': query.priority, 'staleness': staleness, 'overdue': overdue,
+                'newest_tweet_age': now - query.newest_created_at if query.newest_created_at else None,
+                'refreshes': query.refreshes, 'tweets': query.tweets, 'errors': query.errors}
+        return status
+
+    def report(self):
+        for name, query_status in self.status().items():
+            staleness = query_status['staleness']
+            print(f"{name}: {query_status['refreshes']} refreshes, {query_status['tweets']} tweets, "
+                  f"{query_status['errors']} errors, last refresh "
+                  f"{'never' if staleness is None else f'{staleness:.0f}s ago'}, overdue {query_status['overdue']:.0f}s")
+
+    def run(self, max_refreshes=None):
+        '''Refresh tracked queries until stopped (or after max_refreshes)'''
+        Database.create_table(self.db_path)
+        refreshes = 0
+        while not self.stopped.is_set():
+            refreshes += len(self.run_once())
+            if max_refreshes is not None and refreshes >= max_refreshes:
+                break
+            if self.config.report_every and self.clock() - self.last_report >= self.config.report_every:
+                self.report()
+                self.last_report = self.clock()
+            self.sleep(self.wait_time())
+        return refreshes
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', default='tracked_queries.json')
+    parser.add_argument('--db', default=Database.db_path)
+    parser.add_argument('--max-refreshes', type=int, default=None)
+    parser.add_argument('--status', action='store_true', help='Print the lag of each tracked query and exit')
+    args = parser.parse_args()
+
+    scheduler = QueryScheduler(SchedulerConfig.load(args.config), args.db)
+    if args.status:
+        scheduler.report()
+    else:
+        try:
+            scheduler.run(args.max_refreshes)
+        except KeyboardInterrupt:
+            pass
+        scheduler.report()
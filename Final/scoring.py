@@ -0,0 +1,400 @@
+'''Sentiment scorers used by the scoring path in main.py'''
+import math
+import os
+import random
+import re
+import string
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from nltk.sentiment.vader import SentimentIntensityAnalyzer, VaderConstants
+from textblob.en import sentiment as pattern_sentiment
+from textblob._text import EMOTICONS
+from lexicon import load_pattern_lexicon, load_vader_table
+
+PUNCTUATION_CHARS = frozenset(string.punctuation)
+# Score columns filled by each scorer. Per tweet, Pattern costs about twice as much as FastVader, while
+# nltk's VADER costs several times as much as Pattern, so only FastVader is the cheap scorer
+PATTERN_COLUMNS = ('Sentiment', 'Sentiment_Magnitude')
+VADER_COLUMNS = ('Sentiment_VADER',)
+
+# Emoticons made only of word characters are the only ones that can survive Tweet.clean ('XD', 'o_O')
+WORD_EMOTICONS = re.compile(r'(%s)($|\s)' % '|'.join(
+    r' ?'.join(re.escape(c) for c in e) for v in EMOTICONS.values() for e in v if re.fullmatch(r'\w+', e)))
+
+
+def tokenize(text):
+    '''Returns the shared token stream for a cleaned tweet, consumed by both scorers'''
+    return text.split()
+
+
+class VaderTable(dict):
+    '''Dict of FastVader's lookup table entries'''
+
+    def entries(self, words):
+        '''Returns the (valence, booster, negation) entry for each lowercase token'''
+        get = self.get
+        return [get(word) or (None, 0.0, "n't" in word) for word in words]
+
+
+class FastVader:
+    '''VADER scorer with the lexicon, booster and negation sets precompiled into one lookup table.
+
+    Reproduces nltk's SentimentIntensityAnalyzer.polarity_scores exactly (including its
+    quirks, such as scoring repeated tokens in the context of their first occurrence),
+    but does a single dict lookup per token instead of rebuilding per-text structures.
+    '''
+
+    def __init__(self, lexicon=None, table=None):
+        constants = VaderConstants()
+        self.boosters = constants.BOOSTER_DICT
+        self.idioms = constants.SPECIAL_CASE_IDIOMS
+        self.negations = frozenset(constants.NEGATE)
+        self.punctuation = frozenset(constants.PUNC_LIST)
+        self.remove_punctuation = constants.REGEX_REMOVE_PUNCTUATION
+        # lowercase token -> (valence or None, booster scalar, is negation); a compiled table
+        # (see lexicon.py) is shared between processes instead of built in each
+        if table is None:
+            if lexicon is None:
+                lexicon = SentimentIntensityAnalyzer().lexicon
+            table = VaderTable()
+            for word in set(lexicon) | set(self.boosters) | self.negations:
+                table[word] = (lexicon.get(word), self.boosters.get(word, 0.0), self.is_negation(word))
+        self.table = table
+
+    def is_negation(self, word):
+        return word in self.negations or "n't" in word
+
+    def lookup(self, word):
+        '''Returns the (valence, booster, negation) entry for a lowercase token'''
+        return self.table.entries([word])[0]
+
+    def words(self, text, tokens=None):
+        '''Returns VADER's words-and-emoticons for text, with edge punctuation stripped'''
+        words = [w for w in (text.split() if tokens is None else tokens) if len(w) > 1]
+        words_only = None
+        for i, word in enumerate(words):
+            if word[0] in PUNCTUATION_CHARS or word[-1] in PUNCTUATION_CHARS:
+                if words_only is None:
+                    words_only = {w for w in self.remove_punctuation.sub('', text).split() if len(w) > 1}
+                words[i] = self.strip_punctuation(word, words_only)
+        return words
+
+    def strip_punctuation(self, word, words_only):
+        '''Strips one leading or trailing PUNC_LIST mark when the remainder is a known word'''
+        end = len(word)
+        while end > 0 and word[end - 1] in PUNCTUATION_CHARS:
+            end -= 1
+        if word[end:] in self.punctuation and word[:end] in words_only:
+            return word[:end]
+        start = 0
+        while start < len(word) and word[start] in PUNCTUATION_CHARS:
+            start += 1
+        if word[:start] in self.punctuation and word[start:] in words_only:
+            return word[start:]
+        return word
+
+    def valences(self, words):
+        '''Returns the per-word valences for a list of VADER words'''
+        n = len(words)
+        lower = [w.lower() for w in words]
+        entries = self.table.entries(lower)
+        allcaps = sum(1 for w in words if w.isupper())
+        is_cap_diff = 0 < n - allcaps < n
+        first_index = {}
+        for idx, word in enumerate(words):
+            first_index.setdefault(word, idx)
+
+        sentiments = []
+        for word in words:
+            i = first_index[word]
+            valence, booster, _ = entries[i]
+            if booster or (lower[i] == 'kind' and i < n - 1 and lower[i + 1] == 'of'):
+                sentiments.append(0)
+                continue
+            if valence is None:
+                sentiments.append(0)
+                continue
+            if is_cap_diff and word.isupper():
+                valence += 0.733 if valence > 0 else -0.733
+            for start_i in range(3):
+                j = i - (start_i + 1)
+                if i <= start_i or entries[j][0] is not None:
+                    continue
+                s = entries[j][1]
+                if s:
+                    if valence < 0:
+                        s = -s
+                    if is_cap_diff and words[j].isupper():
+                        s += 0.733 if valence > 0 else -0.733
+                    if start_i == 1:
+                        s *= 0.95
+                    elif start_i == 2:
+                        s *= 0.9
+                    valence += s
+                valence = self.never_check(valence, words, entries, start_i, i)
+                if start_i == 2:
+                    valence = self.idioms_check(valence, words, i)
+            valence = self.least_check(valence, lower, entries, i)
+            sentiments.append(valence)
+
+        if 'but' in lower:
+            bi = lower.index('but')
+            for sidx, sentiment in enumerate(sentiments):
+                if sidx < bi:
+                    sentiments[sidx] = sentiment * 0.5
+                elif sidx > bi:
+                    sentiments[sidx] = sentiment * 1.5
+        return sentiments
+
+    @staticmethod
+    def never_check(valence, words, entries, start_i, i):
+        if start_i == 0:
+            if entries[i - 1][2]:
+                valence *= -0.74
+        elif start_i == 1:
+            if words[i - 2] == 'never' and words[i - 1] in ('so', 'this'):
+                valence *= 1.5
+            elif entries[i - 2][2]:
+                valence *= -0.74
+        else:
+            if (words[i - 3] == 'never' and words[i - 2] in ('so', 'this')) or words[i - 1] in ('so', 'this'):
+                valence *= 1.25
+            elif entries[i - 3][2]:
+                valence *= -0.74
+        return valence
+
+    def idioms_check(self, valence, words, i):
+        idioms = self.idioms
+        sequences = [f'{words[i - 1]} {words[i]}', f'{words[i - 2]} {words[i - 1]} {words[i]}',
+                     f'{words[i - 2]} {words[i - 1]}', f'{words[i - 3]} {words[i - 2]} {words[i - 1]}',
+                     f'{words[i - 3]} {words[i - 2]}']
+        for seq in sequences:
+            if seq in idioms:
+                valence = idioms[seq]
+                break
+        if len(words) - 1 > i:
+            seq = f'{words[i]} {words[i + 1]}'
+            if seq in idioms:
+                valence = idioms[seq]
+        if len(words) - 1 > i + 1:
+            seq = f'{words[i]} {words[i + 1]} {words[i + 2]}'
+            if seq in idioms:
+                valence = idioms[seq]
+        if sequences[4] in self.boosters or sequences[2] in self.boosters:
+            valence -= 0.293
+        return valence
+
+    @staticmethod
+    def least_check(valence, lower, entries, i):
+        if i > 1 and lower[i - 1] == 'least' and entries[i - 1][0] is None:
+            if lower[i - 2] != 'at' and lower[i - 2] != 'very':
+                valence *= -0.74
+        elif i > 0 and lower[i - 1] == 'least' and entries[i - 1][0] is None:
+            valence *= -0.74
+        return valence
+
+    @staticmethod
+    def score_valence(sentiments, text):
+        '''Returns the neg/neu/pos/compound dict, identical to nltk's score_valence'''
+        if not sentiments:
+            return {'neg': 0.0, 'neu': 0.0, 'pos': 0.0, 'compound': 0.0}
+        sum_s = float(sum(sentiments))
+        ep_count = min(text.count('!'), 4)
+        qm_count = text.count('?')
+        qm_amplifier = 0 if qm_count <= 1 else (qm_count * 0.18 if qm_count <= 3 else 0.96)
+        amplifier = ep_count * 0.292 + qm_amplifier
+        if sum_s > 0:
+            sum_s += amplifier
+        elif sum_s < 0:
+            sum_s -= amplifier
+        compound = sum_s / math.sqrt((sum_s * sum_s) + 15)
+
+        pos_sum, neg_sum, neu_count = 0.0, 0.0, 0
+        for score in sentiments:
+            if score > 0:
+                pos_sum += float(score) + 1
+            if score < 0:
+                neg_sum += float(score) - 1
+            if score == 0:
+                neu_count += 1
+        if pos_sum > math.fabs(neg_sum):
+            pos_sum += amplifier
+        elif pos_sum < math.fabs(neg_sum):
+            neg_sum -= amplifier
+        total = pos_sum + math.fabs(neg_sum) + neu_count
+        return {
+            'neg': round(math.fabs(neg_sum / total), 3),
+            'neu': round(math.fabs(neu_count / total), 3),
+            'pos': round(math.fabs(pos_sum / total), 3),
+            'compound': round(compound, 4),
+        }
+
+    def polarity_scores(self, text):
+        '''Drop-in replacement for SentimentIntensityAnalyzer.polarity_scores'''
+        return self.score_valence(self.valences(self.words(text)), text)
+
+    def score_tokens(self, tokens, text):
+        '''Returns the compound score for text from its already-split tokens'''
+        return self.polarity_tokens(tokens, text)['compound']
+
+    def polarity_tokens(self, tokens, text):
+        '''Returns the neg/neu/pos/compound dict for text from its already-split tokens'''
+        return self.score_valence(self.valences(self.words(text, tokens)), text)
+
+    def compound_batch(self, texts):
+        '''Returns the compound score for each text in a batch'''
+        words, valences, score = self.words, self.valences, self.score_valence
+        return [score(valences(words(text)), text)['compound'] for text in texts]
+
+
+class PatternScorer:
+    '''Pattern polarity/subjectivity scorer that consumes the shared token stream of a cleaned tweet.
+
+    Matches TextBlob(text, analyzer=PatternAnalyzer()).sentiment for text produced by
+    Tweet.clean, which only contains word characters and single spaces, so pattern's
+    tokenizer reduces to splitting '_' off word edges and rejoining word-only emoticons.
+    '''
+
+    def __init__(self, lexicon=None):
+        self.lexicon = pattern_sentiment if lexicon is None else lexicon
+
+    @staticmethod
+    def words(tokens):
+        '''Returns pattern's lowercase words for the token stream'''
+        words = []
+        for token in tokens:
+            if token[0] != '_' and token[-1] != '_':
+                words.append(token)
+                continue
+            core = token.strip('_')
+            if not core:
+                words.extend('_' * len(token))
+                continue
+            words.extend('_' * (len(token) - len(token.lstrip('_'))))
+            words.append(core)
+            words.extend('_' * (len(token) - len(token.rstrip('_'))))
+        joined = ' '.join(words)
+        if WORD_EMOTICONS.search(joined):
+            words = WORD_EMOTICONS.sub(lambda m: m.group(1).replace(' ', '') + m.group(2), joined).split()
+        return [w.lower() for w in words]
+
+    def score_tokens(self, tokens):
+        '''Returns (polarity, subjectivity) for the token stream'''
+        assessments = self.lexicon.assessments(((w, None) for w in self.words(tokens)), True)
+        if not assessments:
+            return 0.0, 0.0
+        polarity = sum(p for _, p, _, _ in assessments)
+        subjectivity = sum(s for _, _, s, _ in assessments)
+        return polarity / float(len(assessments)), subjectivity / float(len(assessments))
+
+
+@dataclass(frozen=True)
+class ScoringPolicy:
+    '''Dataclass for choosing the scorers each tweet pays for; the columns it skips are left pending (None)'''
+    columns: tuple = PATTERN_COLUMNS + VADER_COLUMNS
+    # Run VADER (always FastVader) first and Pattern only for tweets whose VADER score is ambiguous
+    cheap_first: bool = False
+    ambiguity: float = 0.05
+    conflict: float = 0.2
+
+    def needs_vader(self):
+        return self.cheap_first or any(column in self.columns for column in VADER_COLUMNS)
+
+    def vader_backend(self, configured):
+        '''Returns the VADER backend to score with: screening with nltk would cost more than the Pattern it saves'''
+        return 'fast' if self.cheap_first else configured
+
+    def needs_pattern(self, vader_scores=None):
+        if not any(column in self.columns for column in PATTERN_COLUMNS):
+            return False
+        return not self.cheap_first or vader_scores is None or self.ambiguous(vader_scores)
+
+    def ambiguous(self, vader_scores):
+        '''A VADER score is ambiguous near zero, or when the tweet is both clearly positive and negative'''
+        return (abs(vader_scores['compound']) <= self.ambiguity
+                or min(vader_scores['pos'], vader_scores['neg']) >= self.conflict)
+
+    @staticmethod
+    def from_env():
+        '''Returns the policy set by Scoring_Columns (comma-separated) and Scoring_Cheap_First'''
+        columns = os.getenv('Scoring_Columns')
+        columns = tuple(c.strip() for c in columns.split(',')) if columns else PATTERN_COLUMNS + VADER_COLUMNS
+        unknown = set(columns) - set(PATTERN_COLUMNS + VADER_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown score columns in Scoring_Columns: {", ".join(sorted(unknown))}')
+        return ScoringPolicy(
+            columns=columns,
+            cheap_first=os.getenv('Scoring_Cheap_First', '').lower() in ('1', 'true', 'yes'),
+            ambiguity=float(os.getenv('Scoring_Ambiguity', '0.05')),
+            conflict=float(os.getenv('Scoring_Conflict', '0.2')))
+
+
+FULL_SCORING = ScoringPolicy()
+
+
+@lru_cache(maxsize=None)
+def get_pattern_scorer():
+    '''Returns the shared PatternScorer, over the compiled lexicon if it has been built'''
+    return PatternScorer(load_pattern_lexicon())
+
+
+@lru_cache(maxsize=None)
+def get_vader_analyzer(backend='nltk'):
+    '''Returns the shared VADER analyzer for the backend ('nltk' or 'fast')'''
+    if backend == 'fast':
+        return FastVader(table=load_vader_table())
+    if backend == 'nltk':
+        return SentimentIntensityAnalyzer()
+    raise ValueError(f'Unknown VADER backend: {backend}')
+
+
+def reference_corpus(size=100000, seed=0):
+    '''Returns generated sentences exercising every VADER rule (boosters, negation, caps, idioms, but, least)'''
+    constants = VaderConstants()
+    lexicon = sorted(get_vader_analyzer('nltk').lexicon)
+    rng = random.Random(seed)
+    fillers = ['the', 'a', 'this', 'so', 'at', 'least', 'but', 'kind', 'of', 'sort', 'never', 'very',
+               'product', 'service', 'today', 'is', 'was', 'I', 'x']
+    vocab = (lexicon, sorted(constants.BOOSTER_DICT), sorted(constants.NEGATE), fillers,
+             sorted(w for idiom in constants.SPECIAL_CASE_IDIOMS for w in idiom.split()))
+    marks = ['', '', '', '!', '?', '.', ',', '!!', '?!?']
+    corpus = []
+    for _ in range(size):
+        words = []
+        for _ in range(rng.randint(1, 25)):
+            word = rng.choice(rng.choice(vocab))
+            if rng.random() < 0.1:
+                word = word.upper()
+            if rng.random() < 0.1:
+                word = rng.choice(marks) + word if rng.random() < 0.3 else word + rng.choice(marks)
+            words.append(word)
+        corpus.append(' '.join(words))
+    return corpus
+
+
+def validate_against_nltk(texts, fast=None):
+    '''Returns the largest absolute compound-score difference between FastVader and nltk over texts'''
+    fast = fast or get_vader_analyzer('fast')
+    reference = get_vader_analyzer('nltk')
+    return max((abs(fast.polarity_scores(t)['compound'] - reference.polarity_scores(t)['compound'])
+                for t in texts), default=0.0)
+
+
+def benchmark_vader(texts):
+    '''Returns tweets per second for the nltk and fast backends over texts'''
+    results = {}
+    for backend in ('nltk', 'fast'):
+        analyzer = get_vader_analyzer(backend)
+        start = time.perf_counter()
+        for text in texts:
+            analyzer.polarity_scores(text)['compound']
+        results[backend] = len(texts) / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == '__main__':
+    corpus = reference_corpus()
+    print(f'Max compound difference over {len(corpus)} texts: {validate_against_nltk(corpus):.2e}')
+    for backend, rate in benchmark_vader(corpus).items():
+        print(f'{backend}: {rate:,.0f} tweets/s')
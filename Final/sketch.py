@@ -0,0 +1,202 @@
+'''Trending terms per query and time bucket: a count-min sketch with a bounded top-K, mergeable and persisted'''
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+import numpy as np
+from scoring import tokenize
+from stats import normalize_query
+
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+TOP_K = 50
+BUCKET_SECONDS = int(os.getenv('Term_Bucket_Seconds', '3600'))
+STOPWORDS = frozenset('''
+a about after all also am an and any are as at be because been before being but by can could did do does
+doing don for from get got had has have having he her here him his how i if in into is it its just like me
+more most my no not now of off on one only or our out over rt she so some than that the their them then
+there these they this those to too up us very was we were what when where which who why will with would
+you your amp via im dont cant
+'''.split())
+
+
+def terms(text):
+    '''Returns the lowercase terms of a cleaned tweet, without stopwords and one-letter tokens'''
+    return [token for token in (token.lower() for token in tokenize(text))
+            if len(token) > 1 and token not in STOPWORDS and not token.isdigit()]
+
+
+def bucket_start(created_at, bucket_seconds=BUCKET_SECONDS):
+    return float(int(created_at // bucket_seconds) * bucket_seconds)
+
+
+class CountMinSketch:
+    '''Class for a count-min sketch: depth rows of width counters, each term counted once per row.
+
+    Estimates never undercount, and overcount by at most e / width of the total with
+    probability 1 - exp(-depth). Sketches of the same shape merge by adding their counters.
+    '''
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, counts=None):
+        self.width = width
+        self.depth = depth
+        self.counts = np.zeros((depth, width), dtype=np.uint32) if counts is None else counts
+
+    def indexes(self, items):
+        '''Returns the (depth, len(items)) counter indexes of the items, by double hashing one 64-bit digest'''
+        digests = np.array([int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'little')
+                            for item in items], dtype=np.uint64)
+        h1 = digests & np.uint64(0xFFFFFFFF)
+        h2 = (digests >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, items, weights=None):
+        '''Count the items, each weight times (once by default)'''
+        if not items:
+            return
+        weights = np.ones(len(items), dtype=np.uint32) if weights is None else np.asarray(weights, dtype=np.uint32)
+        for row, index in enumerate(self.indexes(items)):
+            np.add.at(self.counts[row], index, weights)
+
+    def estimates(self, items):
+        '''Returns the estimated count of each item'''
+        if not items:
+            return []
+        index = self.indexes(items)
+        return self.counts[np.arange(self.depth)[:, None], index].min(axis=0).tolist()
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Only sketches of the same width and depth can be merged')
+        self.counts += other.counts
+        return self
+
+    def to_bytes(self):
+        '''Returns the counters, zlib compressed (a sparse sketch shrinks to a few KB)'''
+        return zlib.compress(self.counts.tobytes(), 6)
+
+    @staticmethod
+    def from_bytes(data, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        counts = np.frombuffer(zlib.decompress(data), dtype=np.uint32).reshape(depth, width).copy()
+        return CountMinSketch(width, depth, counts)
+
+
+class TopK:
+    '''Class for the k terms with the highest estimated counts seen so far'''
+
+    def __init__(self, k=TOP_K, counts=None):
+        self.k = k
+        self.counts = counts or {}
+
+    def offer(self, term, estimate):
+        '''Keep the term if it is tracked already or beats the smallest tracked estimate'''
+        if term in self.counts or len(self.counts) < self.k:
+            self.counts[term] = estimate
+            return
+        smallest = min(self.counts, key=self.counts.get)
+        if estimate > self.counts[smallest]:
+            del self.counts[smallest]
+            self.counts[term] = estimate
+
+    def top(self, n=None):
+        '''Returns the (term, estimate) pairs, highest first'''
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class TermSketch:
+    '''Class for the term counts of one query and time bucket: a count-min sketch and its top-K terms'''
+
+    def __init__(self, query, bucket, sketch=None, top_k=None, total=0):
+        self.query = normalize_query(query)
+        self.bucket = bucket
+        self.sketch = sketch or CountMinSketch()
+        self.top_k = top_k or TopK()
+        self.total = total
+
+    def add(self, weighted_terms):
+        '''Count {term: weight} and refresh the top-K with the terms' new estimates'''
+        items = list(weighted_terms)
+        self.sketch.add(items, list(weighted_terms.values()))
+        self.total += sum(weighted_terms.values())
+        for term, estimate in zip(items, self.sketch.estimates(items)):
+            self.top_k.offer(term, estimate)
+
+    def update(self, tweets):
+        '''Count the terms of cleaned tweets, weighted by their multiplicity'''
+        weighted_terms = {}
+        for tweet in tweets:
+            for term in terms(tweet.text):
+                weighted_terms[term] = weighted_terms.get(term, 0) + tweet.multiplicity
+        self.add(weighted_terms)
+        return self
+
+    def merge(self, other):
+        '''Add another sketch (another worker's, or another bucket's) into this one'''
+        self.sketch.merge(other.sketch)
+        self.total += other.total
+        # The candidates are both top-K lists, re-estimated from the merged counters
+        candidates = list(set(self.top_k.counts) | set(other.top_k.counts))
+        merged = TopK(self.top_k.k)
+        for term, estimate in zip(candidates, self.sketch.estimates(candidates)):
+            merged.offer(term, estimate)
+        self.top_k = merged
+        return self
+
+    @staticmethod
+    def create_table(conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS term_sketches (Query TEXT, Bucket REAL, Sketch BLOB, Top TEXT, '
+                     'Total INTEGER, PRIMARY KEY (Query, Bucket))')
+
+    @staticmethod
+    def read(conn, query, bucket):
+        row = conn.execute('SELECT Sketch, Top, Total FROM term_sketches WHERE Query = ? AND Bucket = ?',
+                           (normalize_query(query), bucket)).fetchone()
+        if row is None:
+            return TermSketch(query, bucket)
+        return TermSketch(query, bucket, CountMinSketch.from_bytes(row[0]), TopK(counts=json.loads(row[1])), row[2])
+
+    def write(self, conn):
+        conn.execute('INSERT OR REPLACE INTO term_sketches (Query, Bucket, Sketch, Top, Total) VALUES (?, ?, ?, ?, ?)',
+                     (self.query, self.bucket, self.sketch.to_bytes(), json.dumps(self.top_k.counts), self.total))
+
+    @staticmethod
+    def record(query, tweets, db_path, bucket_seconds=BUCKET_SECONDS):
+        '''Add cleaned tweets to the stored sketches of the query's time buckets'''
+        with sqlite3.connect(db_path) as conn:
+            TermSketch.create_table(conn)
+            # Take the write lock before reading so concurrent batches of a bucket aren't lost
+            conn.execute('BEGIN IMMEDIATE')
+            # load's window ends at the newest bucket, so a tweet without a timestamp bucketed at the clock would
+            # hide every older one; it joins the batch's newest tweet instead (or the query's newest bucket)
+            latest = max((tweet.created_at for tweet in tweets if tweet.created_at is not None), default=None)
+            if latest is None:
+                latest = conn.execute('SELECT MAX(Bucket) FROM term_sketches WHERE Query = ?',
+                                      (normalize_query(query),)).fetchone()[0]
+            buckets = {}
+            for tweet in tweets:
+                created_at = tweet.created_at if tweet.created_at is not None else latest
+                bucket = bucket_start(created_at if created_at is not None else time.time(), bucket_seconds)
+                buckets.setdefault(bucket, []).append(tweet)
+            for bucket, bucket_tweets in buckets.items():
+                TermSketch.read(conn, query, bucket).update(bucket_tweets).write(conn)
+
+    @staticmethod
+    def load(query, db_path, window=None):
+        '''Returns the query's sketches of the window seconds up to its newest bucket (or all), merged into one'''
+        merged = TermSketch(query, None)
+        with sqlite3.connect(db_path) as conn:
+            try:
+                rows = conn.execute(
+                    'SELECT Sketch, Top, Total FROM term_sketches WHERE Query = ? AND Bucket >= '
+                    '(SELECT MAX(Bucket) FROM term_sketches WHERE Query = ?) - ?',
+                    (merged.query, merged.query, window if window is not None else float('inf'))).fetchall()
+            except sqlite3.OperationalError:
+                # Nothing has been recorded in this database yet
+                return merged
+        for sketch, top, total in rows:
+            merged.merge(TermSketch(query, None, CountMinSketch.from_bytes(sketch), TopK(counts=json.loads(top)),
+                                    total))
+        return merged
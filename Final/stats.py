@@ -0,0 +1,241 @@
+'''Constant-memory running statistics of the score columns, kept per search query'''
+import json
+import math
+import sqlite3
+import time
+from bisect import bisect_right, insort
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# Recent search only returns tweets from the last seven days
+COUNTED_WINDOW = 7 * 86400
+
+
+class RunningMoments:
+    '''Class for the weighted Welford mean and variance, with min and max'''
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def add(self, x, weight=1):
+        self.count += weight
+        delta = x - self.mean
+        self.mean += delta * weight / self.count
+        self.m2 += weight * delta * (x - self.mean)
+        self.minimum = x if self.minimum is None else min(self.minimum, x)
+        self.maximum = x if self.maximum is None else max(self.maximum, x)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'minimum': self.minimum, 'maximum': self.maximum}
+
+
+class P2Quantile:
+    '''Class for the P-square streaming estimate of one quantile (Jain & Chlamtac), using five markers'''
+
+    def __init__(self, p, heights=None, positions=None, desired=None):
+        self.p = p
+        self.heights = heights or []
+        self.positions = positions or [1, 2, 3, 4, 5]
+        self.desired = desired or [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            insort(q, x)
+            return
+        if x < q[0]:
+            q[0], k = x, 0
+        elif x >= q[4]:
+            q[4], k = x, 3
+        else:
+            k = bisect_right(q, x) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # Move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+    def to_dict(self):
+        return {'p': self.p, 'heights': self.heights, 'positions': self.positions, 'desired': self.desired}
+
+
+class FixedHistogram:
+    '''Class for counts over equal-width bins, clamping values outside the range into the end bins'''
+
+    def __init__(self, low=-1.0, high=1.0, bins=20, counts=None):
+        self.low = low
+        self.high = high
+        self.counts = counts or [0] * bins
+
+    def add(self, x, weight=1):
+        bins = len(self.counts)
+        index = int((x - self.low) / (self.high - self.low) * bins)
+        self.counts[min(max(index, 0), bins - 1)] += weight
+
+    @property
+    def edges(self):
+        width = (self.high - self.low) / len(self.counts)
+        return [self.low + i * width for i in range(len(self.counts) + 1)]
+
+    def to_dict(self):
+        return {'low': self.low, 'high': self.high, 'counts': self.counts}
+
+
+class ColumnStats:
+    '''Class for the moments, quantiles and histogram of one score column'''
+
+    def __init__(self, moments=None, quantiles=None, histogram=None, pending=0):
+        self.moments = moments or RunningMoments()
+        self.quantiles = quantiles or [P2Quantile(p) for p in QUANTILES]
+        self.histogram = histogram or FixedHistogram()
+        # Tweets whose score the scoring policy left pending; while any are, the statistics are partial
+        self.pending = pending
+
+    def add(self, x, weight=1):
+        self.moments.add(x, weight)
+        self.histogram.add(x, weight)
+        # P-square is unweighted, so a folded duplicate counts once per copy. record_query weights a
+        # tweet by its uncounted copies only, so this is one O(1) update per tweet fetched, never more
+        for quantile in self.quantiles:
+            for _ in range(weight):
+                quantile.add(x)
+
+    def summary(self):
+        return {'count': self.moments.count, 'pending': self.pending, 'mean': self.moments.mean,
+                'std': self.moments.std, 'min': self.moments.minimum, 'max': self.moments.maximum,
+                **{f'p{round(q.p * 100)}': q.value for q in self.quantiles}}
+
+    def to_dict(self):
+        return {'moments': self.moments.to_dict(), 'quantiles': [q.to_dict() for q in self.quantiles],
+                'histogram': self.histogram.to_dict(), 'pending': self.pending}
+
+    @staticmethod
+    def from_dict(data):
+        return ColumnStats(RunningMoments(**data['moments']), [P2Quantile(**q) for q in data['quantiles']],
+                           FixedHistogram(**data['histogram']), data.get('pending', 0))
+
+
+class QueryStats:
+    '''Class for the running statistics of every score column of one query'''
+
+    def __init__(self, query, columns, column_stats=None):
+        self.query = normalize_query(query)
+        self.columns = {column: (column_stats or {}).get(column) or ColumnStats() for column in columns}
+
+    def update(self, tweets):
+        '''Add scored tweets, weighted by their multiplicity'''
+        for tweet in tweets:
+            for column, column_stats in self.columns.items():
+                value = getattr(tweet, column.lower())
+                # Scores the scoring policy left pending can't be counted, only tallied, so the column reads as partial
+                if value is None:
+                    column_stats.pending += tweet.multiplicity
+                else:
+                    column_stats.add(value, tweet.multiplicity)
+
+    def summary(self):
+        return {column: column_stats.summary() for column, column_stats in self.columns.items()}
+
+    def to_json(self):
+        return json.dumps({column: column_stats.to_dict() for column, column_stats in self.columns.items()})
+
+    @staticmethod
+    def from_json(query, columns, text):
+        data = json.loads(text)
+        return QueryStats(query, columns, {column: ColumnStats.from_dict(data[column]) for column in data})
+
+    @staticmethod
+    def create_table(conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS query_stats (Query TEXT PRIMARY KEY, Stats TEXT, Updated REAL)')
+
+    @staticmethod
+    def read(conn, query, columns):
+        row = conn.execute('SELECT Stats FROM query_stats WHERE Query = ?', (normalize_query(query),)).fetchone()
+        return QueryStats.from_json(query, columns, row[0]) if row else QueryStats(query, columns)
+
+    def write(self, conn):
+        conn.execute('INSERT OR REPLACE INTO query_stats (Query, Stats, Updated) VALUES (?, ?, ?)',
+                     (self.query, self.to_json(), time.time()))
+
+    @staticmethod
+    def load(query, columns, db_path):
+        '''Returns the stored statistics of the query, or empty statistics'''
+        with sqlite3.connect(db_path) as conn:
+            try:
+                return QueryStats.read(conn, query, columns)
+            except sqlite3.OperationalError:
+                # Nothing has been recorded in this database yet
+                return QueryStats(query, columns)
+
+    @staticmethod
+    def record(query, columns, tweets, db_path):
+        '''Add scored tweets to the stored statistics of the query, and return them'''
+        with sqlite3.connect(db_path) as conn:
+            QueryStats.create_table(conn)
+            # Take the write lock before reading so concurrent updates of a query aren't lost
+            conn.execute('BEGIN IMMEDIATE')
+            stats = QueryStats.read(conn, query, columns)
+            stats.update(tweets)
+            stats.write(conn)
+        return stats
+
+
+def uncounted_ids(query, tweet_ids, db_path):
+    '''Returns the tweet ids the query hasn't counted yet, recording them as counted'''
+    new_ids = set()
+    now = time.time()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS counted_tweets (Query TEXT, Tweet_Id TEXT, Counted_At REAL, '
+                     'PRIMARY KEY (Query, Tweet_Id)) WITHOUT ROWID')
+        if 'Counted_At' not in [row[1] for row in conn.execute('PRAGMA table_info(counted_tweets)')]:
+            conn.execute('ALTER TABLE counted_tweets ADD COLUMN Counted_At REAL')
+            conn.execute('UPDATE counted_tweets SET Counted_At = ?', (now,))
+        conn.execute('CREATE INDEX IF NOT EXISTS counted_tweets_age ON counted_tweets (Counted_At)')
+        conn.execute('BEGIN IMMEDIATE')
+        # Ids counted longer ago than the search window can't be fetched again, so the table stays bounded
+        conn.execute('DELETE FROM counted_tweets WHERE Counted_At < ?', (now - COUNTED_WINDOW,))
+        for tweet_id in tweet_ids:
+            if conn.execute('INSERT OR IGNORE INTO counted_tweets (Query, Tweet_Id, Counted_At) VALUES (?, ?, ?)',
+                            (normalize_query(query), tweet_id, now)).rowcount:
+                new_ids.add(tweet_id)
+    return new_ids
+
+
+def normalize_query(query):
+    '''Returns the key queries are tracked under'''
+    return ' '.join(str(query or '').split())
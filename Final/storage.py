@@ -0,0 +1,404 @@
+'''Storage backends for the tweets table: a SQLite file, or a pooled SQLAlchemy database'''
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import closing
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from entities import create_tables as create_entity_tables, record as record_entities
+
+try:
+    import sqlalchemy
+    from sqlalchemy.pool import StaticPool
+except ImportError:
+    sqlalchemy = None
+
+# Columns of the tweets table; create_table adds any that an older database is missing
+SCHEMA = {'Text': 'TEXT', 'Sentiment': 'REAL', 'Sentiment_Magnitude': 'REAL', 'Sentiment_VADER': 'REAL',
+          'Multiplicity': 'INTEGER DEFAULT 1', 'Text_Hash': 'TEXT', 'Created_At': 'REAL'}
+# Order of the values in the rows passed to upsert_tweets
+ROW_COLUMNS = ['Text', 'Sentiment', 'Sentiment_Magnitude', 'Sentiment_VADER', 'Multiplicity', 'Text_Hash', 'Created_At']
+BATCH_SIZE = 500
+# Rows held in memory at a time by the streaming reads
+FETCH_SIZE = int(os.getenv('Fetch_Size', '1000'))
+DTYPES = {'REAL': np.float64, 'INTEGER': np.int64}
+
+
+def check_column(name):
+    '''Returns the name if it is a column of the tweets table (or its rowid), otherwise raises ValueError'''
+    if name not in SCHEMA and name != 'rowid':
+        raise ValueError(f'Unknown column: {name}')
+    return name
+
+
+def check_identifier(name):
+    if not name.isidentifier():
+        raise ValueError(f'Invalid table or column name: {name}')
+    return name
+
+
+def column_dtype(name):
+    '''Returns the NumPy dtype a column is read into: float64 (NULL as NaN), int64, or object for text'''
+    if name == 'rowid':
+        return np.int64
+    return DTYPES.get(SCHEMA[name].split()[0], object)
+
+
+def fetch_chunks(cursor, chunk_size=FETCH_SIZE):
+    '''Yield the rows of an executed cursor in lists of at most chunk_size'''
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def fetch_rows(cursor, chunk_size=FETCH_SIZE):
+    '''Yield the rows of an executed cursor one by one, fetching chunk_size at a time'''
+    for rows in fetch_chunks(cursor, chunk_size):
+        yield from rows
+
+
+def collapse(rows):
+    '''Returns one row per Text_Hash, the first of each, with the multiplicity of its repeats added in'''
+    merged = {}
+    for row in rows:
+        first = merged.get(row[5])
+        merged[row[5]] = tuple(row) if first is None else first[:4] + (first[4] + row[4],) + first[5:]
+    return list(merged.values())
+
+
+class StorageBackend(ABC):
+    '''Interface of the stores Database keeps tweets in'''
+    # Whether tweets are rows of the SQLite tweets table with its full-text index, entity tables and triggers,
+    # which search, entity counts, the time series and the live feed read directly
+    plain = False
+
+    @abstractmethod
+    def create_table(self):
+        '''Create the tweets table and its indexes if they don't exist'''
+
+    @abstractmethod
+    def upsert_tweets(self, rows, entities=None):
+        '''Insert rows (in ROW_COLUMNS order), adding to the multiplicity of stored duplicates, and link each
+        row to its entities if given'''
+
+    @abstractmethod
+    def update_columns(self, columns, rows):
+        '''Set the columns of many tweets in one transaction, given (row id, values...) rows'''
+
+    @abstractmethod
+    def update_where(self, column, value, condition_column, condition_value):
+        '''Set a column of the tweets whose condition column equals a value'''
+
+    @abstractmethod
+    def row_ids(self, hashes):
+        '''Returns {Text_Hash: row id} of the stored tweets with the given hashes, the row duplicates fold into'''
+
+    @abstractmethod
+    def read_results(self, columns):
+        '''Returns the given columns of every stored tweet, oldest first'''
+
+    @abstractmethod
+    def pending_rows(self, columns, limit=FETCH_SIZE):
+        '''Returns up to limit (row id, Text) rows with any of the columns pending (NULL)'''
+
+    @abstractmethod
+    def read_frames(self, columns, chunk_size=FETCH_SIZE):
+        '''Yield the given columns of every stored tweet as DataFrames of at most chunk_size rows, oldest first'''
+
+    @abstractmethod
+    def read_columns(self, columns, chunk_size=FETCH_SIZE):
+        '''Returns {column: NumPy array} of the given columns of every stored tweet, oldest first'''
+
+    @abstractmethod
+    def clear_table(self, table_name):
+        '''Delete every row of a table'''
+
+
+class SQLiteBackend(StorageBackend):
+    '''Class for storing tweets in a SQLite file, with full-text search triggers'''
+    plain = True
+
+    def __init__(self, db_path, timeout=30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=self.timeout)
+
+    def create_table(self):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS tweets (Text TEXT, Sentiment REAL, Sentiment_Magnitude REAL, Sentiment_VADER REAL)')
+            existing = {row[1] for row in cursor.execute('PRAGMA table_info(tweets)')}
+            for column, column_type in SCHEMA.items():
+                if column not in existing:
+                    cursor.execute(f'ALTER TABLE tweets ADD COLUMN {column} {column_type}')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tweets_text_hash ON tweets (Text_Hash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tweets_created_at ON tweets (Created_At)')
+            SQLiteBackend.create_fts(cursor)
+            SQLiteBackend.create_generation(cursor)
+            create_entity_tables(cursor)
+
+    @staticmethod
+    def create_generation(cursor):
+        '''Create the tweets_generation counter, which every deleted tweet advances.
+
+        Rowids start over once the table is cleared, so readers that remember a rowid (the
+        live feed) also remember the generation, and start again from the first row if it moved.
+        '''
+        cursor.executescript('''
+            CREATE TABLE IF NOT EXISTS tweets_generation (Id INTEGER PRIMARY KEY CHECK (Id = 0), Generation INTEGER);
+            INSERT OR IGNORE INTO tweets_generation (Id, Generation) VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS tweets_generation_delete AFTER DELETE ON tweets BEGIN
+                UPDATE tweets_generation SET Generation = Generation + 1 WHERE Id = 0;
+            END;
+        ''')
+
+    @staticmethod
+    def create_fts(cursor):
+        '''Create the tweets_fts full-text index over Text, kept in sync with tweets by triggers'''
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'tweets_fts'").fetchone()
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5("
+                           "Text, content='tweets', content_rowid='rowid')")
+        except sqlite3.OperationalError as exc:
+            print(f'Full-text search unavailable: {exc}')
+            return
+        cursor.executescript('''
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_insert AFTER INSERT ON tweets BEGIN
+                INSERT INTO tweets_fts (rowid, Text) VALUES (new.rowid, new.Text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_delete AFTER DELETE ON tweets BEGIN
+                INSERT INTO tweets_fts (tweets_fts, rowid, Text) VALUES ('delete', old.rowid, old.Text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_update AFTER UPDATE OF Text ON tweets BEGIN
+                INSERT INTO tweets_fts (tweets_fts, rowid, Text) VALUES ('delete', old.rowid, old.Text);
+                INSERT INTO tweets_fts (rowid, Text) VALUES (new.rowid, new.Text);
+            END;
+        ''')
+        if not exists:
+            # Index the rows stored before the index existed
+            cursor.execute("INSERT INTO tweets_fts (tweets_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def upsert(cursor, rows, entities=None):
+        '''Upsert rows through an open cursor, as part of the caller's transaction'''
+        hashes = [row[5] for row in rows]
+        # Repeats within the rows (e.g. several backfill chunks in one commit) fold like stored ones
+        rows = collapse(rows)
+        existing = set()
+        for i in range(0, len(rows), BATCH_SIZE):
+            chunk = [row[5] for row in rows[i:i + BATCH_SIZE]]
+            cursor.execute(
+                f'SELECT Text_Hash FROM tweets WHERE Text_Hash IN ({",".join("?" * len(chunk))})', chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+        cursor.executemany(
+            'UPDATE tweets SET Multiplicity = Multiplicity + ? WHERE rowid = '
+            '(SELECT rowid FROM tweets WHERE Text_Hash = ? LIMIT 1)',
+            [(row[4], row[5]) for row in rows if row[5] in existing])
+        cursor.executemany(
+            f'INSERT INTO tweets ({", ".join(ROW_COLUMNS)}) VALUES ({", ".join("?" * len(ROW_COLUMNS))})',
+            [row for row in rows if row[5] not in existing])
+        if entities:
+            record_entities(cursor, hashes, entities)
+
+    def upsert_tweets(self, rows, entities=None):
+        with self.connect() as conn:
+            # Take the write lock up front: a transaction that reads first can't wait out another writer
+            conn.execute('BEGIN IMMEDIATE')
+            SQLiteBackend.upsert(conn.cursor(), rows, entities)
+
+    @staticmethod
+    def bulk_update(cursor, columns, rows):
+        '''Set columns from (rowid, values...) rows, as one batched UPDATE keyed by rowid'''
+        # Measured faster in SQLite than staging into a temp table and running one UPDATE ... FROM join
+        assignments = ', '.join(f'{check_column(column)} = ?' for column in columns)
+        cursor.executemany(f'UPDATE tweets SET {assignments} WHERE rowid = ?', (row[1:] + row[:1] for row in rows))
+
+    def update_columns(self, columns, rows):
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            SQLiteBackend.bulk_update(conn.cursor(), columns, rows)
+
+    def update_where(self, column, value, condition_column, condition_value):
+        column, condition_column = check_column(column), check_column(condition_column)
+        with self.connect() as conn:
+            conn.execute(f'UPDATE tweets SET {column} = ? WHERE {condition_column} = ?', (value, condition_value))
+
+    def row_ids(self, hashes):
+        ids = {}
+        with closing(self.connect()) as conn:
+            for i in range(0, len(hashes), BATCH_SIZE):
+                chunk = hashes[i:i + BATCH_SIZE]
+                ids.update((text_hash, rowid) for rowid, text_hash in conn.execute(
+                    f'SELECT MIN(rowid), Text_Hash FROM tweets WHERE Text_Hash IN ({",".join("?" * len(chunk))}) '
+                    'GROUP BY Text_Hash', chunk))
+        return ids
+
+    def read_results(self, columns):
+        with self.connect() as conn:
+            return conn.execute(
+                f'SELECT {", ".join(map(check_identifier, columns))} FROM tweets ORDER BY rowid').fetchall()
+
+    def iter_rows(self, table_name='tweets', columns=None, chunk_size=FETCH_SIZE):
+        '''Yield the rows of a table (every column unless given), holding at most chunk_size in memory'''
+        selected = ', '.join(map(check_identifier, columns)) if columns else '*'
+        with closing(self.connect()) as conn:
+            yield from fetch_rows(conn.execute(f'SELECT {selected} FROM {check_identifier(table_name)}'), chunk_size)
+
+    def read_frames(self, columns, chunk_size=FETCH_SIZE):
+        '''Yield the given columns of the tweets table as DataFrames of at most chunk_size rows, oldest first'''
+        columns = [check_column(column) for column in columns]
+        with closing(self.connect()) as conn:
+            cursor = conn.execute(f'SELECT {", ".join(columns)} FROM tweets ORDER BY rowid')
+            for rows in fetch_chunks(cursor, chunk_size):
+                yield pd.DataFrame(rows, columns=columns)
+
+    def pending_rows(self, columns, limit=FETCH_SIZE):
+        pending = ' OR '.join(f'{check_column(column)} IS NULL' for column in columns)
+        with closing(self.connect()) as conn:
+            try:
+                return conn.execute(f'SELECT rowid, Text FROM tweets WHERE {pending} ORDER BY rowid LIMIT ?',
+                                    (limit,)).fetchall()
+            except sqlite3.OperationalError:
+                # No tweets table yet
+                return []
+
+    def read_columns(self, columns, chunk_size=FETCH_SIZE):
+        '''Returns {column: NumPy array} of the tweets table, filled chunk by chunk without a list of every row'''
+        columns = [check_column(column) for column in columns]
+        with closing(self.connect()) as conn:
+            # Count and read in one snapshot, so rows stored in between can't overrun the arrays
+            conn.execute('BEGIN')
+            count = conn.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+            arrays = {column: np.empty(count, dtype=column_dtype(column)) for column in columns}
+            cursor = conn.execute(f'SELECT {", ".join(columns)} FROM tweets ORDER BY rowid')
+            start = 0
+            for rows in fetch_chunks(cursor, chunk_size):
+                for i, column in enumerate(columns):
+                    arrays[column][start:start + len(rows)] = [row[i] for row in rows]
+                start += len(rows)
+            conn.rollback()
+        return arrays
+
+    def clear_table(self, table_name):
+        with self.connect() as conn:
+            conn.execute(f'DELETE FROM {check_identifier(table_name)}')
+
+
+class SQLAlchemyBackend(StorageBackend):
+    '''Class for storing tweets in any SQLAlchemy database, over a connection pool'''
+
+    def __init__(self, url, pool_size=5, max_overflow=10, batch_size=BATCH_SIZE):
+        if sqlalchemy is None:
+            raise ImportError('Database_URL needs SQLAlchemy (see special_dependencies.txt)')
+        self.batch_size = batch_size
+        options = {'pool_pre_ping': True}
+        parsed = sqlalchemy.engine.make_url(url)
+        if parsed.get_backend_name() == 'sqlite':
+            if parsed.database in (None, '', ':memory:'):
+                # Every pooled connection to :memory: would be a separate, empty database
+                options.update(poolclass=StaticPool, connect_args={'check_same_thread': False})
+        else:
+            options.update(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=3600)
+        self.engine = sqlalchemy.create_engine(url, **options)
+        self.metadata = sqlalchemy.MetaData()
+        self.tweets = sqlalchemy.Table(
+            'tweets', self.metadata,
+            sqlalchemy.Column('Id', sqlalchemy.Integer, primary_key=True, autoincrement=True),
+            sqlalchemy.Column('Text', sqlalchemy.Text),
+            sqlalchemy.Column('Sentiment', sqlalchemy.Float),
+            sqlalchemy.Column('Sentiment_Magnitude', sqlalchemy.Float),
+            sqlalchemy.Column('Sentiment_VADER', sqlalchemy.Float),
+            sqlalchemy.Column('Multiplicity', sqlalchemy.Integer, server_default='1'),
+            sqlalchemy.Column('Text_Hash', sqlalchemy.String(16), index=True),
+            sqlalchemy.Column('Created_At', sqlalchemy.Float, index=True),
+        )
+
+    def create_table(self):
+        self.metadata.create_all(self.engine)
+
+    def upsert_tweets(self, rows, entities=None):
+        # Entity tables, like the full-text index, are kept in SQLite databases only
+        tweets = self.tweets
+        rows = collapse(rows)
+        with self.engine.begin() as conn:
+            hashes = [row[5] for row in rows]
+            existing = set()
+            for i in range(0, len(hashes), self.batch_size):
+                query = sqlalchemy.select(tweets.c.Text_Hash).where(tweets.c.Text_Hash.in_(hashes[i:i + self.batch_size]))
+                existing.update(row[0] for row in conn.execute(query))
+            updates = [{'weight': row[4], 'hash': row[5]} for row in rows if row[5] in existing]
+            if updates:
+                conn.execute(tweets.update().where(tweets.c.Text_Hash == sqlalchemy.bindparam('hash'))
+                             .values(Multiplicity=tweets.c.Multiplicity + sqlalchemy.bindparam('weight')), updates)
+            inserts = [dict(zip(ROW_COLUMNS, row)) for row in rows if row[5] not in existing]
+            for i in range(0, len(inserts), self.batch_size):
+                # One multi-row INSERT ... VALUES (...), (...) statement per batch
+                conn.execute(tweets.insert().values(inserts[i:i + self.batch_size]))
+
+    def update_columns(self, columns, rows):
+        columns = [check_column(column) for column in columns]
+        statement = self.tweets.update().where(self.tweets.c.Id == sqlalchemy.bindparam('row_id')).values(
+            {column: sqlalchemy.bindparam(f'new_{column}') for column in columns})
+        params = [{'row_id': row[0], **{f'new_{column}': value for column, value in zip(columns, row[1:])}}
+                  for row in rows]
+        with self.engine.begin() as conn:
+            for i in range(0, len(params), self.batch_size):
+                conn.execute(statement, params[i:i + self.batch_size])
+
+    def update_where(self, column, value, condition_column, condition_value):
+        column, condition_column = check_column(column), check_column(condition_column)
+        with self.engine.begin() as conn:
+            conn.execute(self.tweets.update().where(self.tweets.c[condition_column] == condition_value)
+                         .values({column: value}))
+
+    def row_ids(self, hashes):
+        tweets = self.tweets
+        ids = {}
+        with self.engine.connect() as conn:
+            for i in range(0, len(hashes), self.batch_size):
+                query = sqlalchemy.select(sqlalchemy.func.min(tweets.c.Id), tweets.c.Text_Hash).where(
+                    tweets.c.Text_Hash.in_(hashes[i:i + self.batch_size])).group_by(tweets.c.Text_Hash)
+                ids.update((text_hash, row_id) for row_id, text_hash in conn.execute(query))
+        return ids
+
+    def read_results(self, columns):
+        query = sqlalchemy.select(*[self.tweets.c[column] for column in columns]).order_by(self.tweets.c.Id)
+        with self.engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(query)]
+
+    def pending_rows(self, columns, limit=FETCH_SIZE):
+        pending = sqlalchemy.or_(*[self.tweets.c[check_column(column)].is_(None) for column in columns])
+        query = sqlalchemy.select(self.tweets.c.Id, self.tweets.c.Text).where(pending).order_by(
+            self.tweets.c.Id).limit(limit)
+        with self.engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(query)]
+
+    def read_frames(self, columns, chunk_size=FETCH_SIZE):
+        columns = [check_column(column) for column in columns]
+        query = sqlalchemy.select(*[self.tweets.c[column] for column in columns]).order_by(self.tweets.c.Id)
+        with self.engine.connect() as conn:
+            # yield_per streams the result instead of buffering every row
+            for rows in conn.execution_options(yield_per=chunk_size).execute(query).partitions():
+                yield pd.DataFrame([tuple(row) for row in rows], columns=columns)
+
+    def read_columns(self, columns, chunk_size=FETCH_SIZE):
+        frames = list(self.read_frames(columns, chunk_size))
+        return {column: np.concatenate([frame[column].to_numpy(dtype=column_dtype(column)) for frame in frames])
+                if frames else np.empty(0, dtype=column_dtype(column)) for column in columns}
+
+    def clear_table(self, table_name):
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(f'DELETE FROM {check_identifier(table_name)}'))
+
+
+@lru_cache(maxsize=None)
+def sqlalchemy_backend(url):
+    '''Returns the backend (and its connection pool) shared by every caller of a database URL'''
+    return SQLAlchemyBackend(url, int(os.getenv('Database_Pool_Size', '5')),
+                             int(os.getenv('Database_Max_Overflow', '10')))
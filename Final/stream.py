@@ -0,0 +1,168 @@
+'''Real-time ingestion from the filtered stream, scored and stored in micro-batches'''
+import argparse
+import os
+import random
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass, field
+import requests
+from dedup import Deduplicator
+from main import Database, Tweet, TwitterAPI, parse_created_at, record_query
+
+
+def store_batch(items, query, db_path=None):
+    '''Clean, deduplicate, score and store API tweet objects, and add them to the query's stats, alerts and terms'''
+    fetched = [Tweet(text=item.get('text', ''), created_at=parse_created_at(item.get('created_at')),
+                     tweet_id=item.get('id')) for item in items]
+    for tweet in fetched:
+        tweet.clean()
+    deduplicator = Deduplicator()
+    tweets = deduplicator.dedupe(fetched)
+    for tweet in tweets:
+        tweet.analyze()
+    Database.store_tweets(tweets, db_path)
+    record_query(query, fetched, deduplicator, db_path)
+    return tweets
+
+
+@dataclass
+class StreamConfig:
+    '''Dataclass for configuring stream ingestion'''
+    batch_size: int = 100
+    max_wait: float = 1.0
+    backoff_initial: float = 0.25
+    backoff_max: float = 16.0
+    http_backoff_initial: float = 5.0
+    http_backoff_max: float = 320.0
+    rate_limit_backoff_initial: float = 60.0
+    # A rate limit window is 15 minutes, so waiting longer than one never helps
+    rate_limit_backoff_max: float = 900.0
+    max_reconnects: int = None
+    report_every: int = 10
+    query: str = 'stream'
+
+
+@dataclass
+class StreamMetrics:
+    '''Dataclass for stream ingestion throughput and lag'''
+    started: float = field(default_factory=time.perf_counter)
+    tweets: int = 0
+    duplicates: int = 0
+    batches: int = 0
+    reconnects: int = 0
+    lags: deque = field(default_factory=lambda: deque(maxlen=10000))
+
+    @property
+    def throughput(self):
+        elapsed = time.perf_counter() - self.started
+        return self.tweets / elapsed if elapsed else 0.0
+
+    def lag_percentile(self, pct):
+        if len(self.lags) < 2:
+            return self.lags[0] if self.lags else 0.0
+        return statistics.quantiles(self.lags, n=100, method='inclusive')[pct - 1]
+
+    def summary(self):
+        return (f'{self.tweets} tweets ({self.duplicates} duplicates) in {self.batches} batches, '
+                f'{self.throughput:.1f} tweets/s, '
+                f'lag p50={self.lag_percentile(50):.3f}s p95={self.lag_percentile(95):.3f}s, '
+                f'{self.reconnects} reconnects')
+
+
+class StreamIngestor:
+    '''Class for consuming the filtered stream with reconnects and flushing scored micro-batches'''
+
+    def __init__(self, config=None, sleep=time.sleep):
+        self.config = config or StreamConfig()
+        self.metrics = StreamMetrics()
+        self.sleep = sleep
+        self.batch = []
+        self.batch_started = None
+
+    def connect(self):
+        '''Returns a generator over a single stream connection'''
+        encoded_keys = TwitterAPI.encode_api_keys(os.getenv('Key_Twitter'), os.getenv('Secret_Key_Twitter'))
+        bearer_token = TwitterAPI.get_bearer_token(encoded_keys)
+        if not bearer_token:
+            raise requests.ConnectionError('Failed to obtain Bearer Token.')
+        return TwitterAPI.stream_tweets(bearer_token)
+
+    def backoff(self, attempt, error):
+        '''Returns the delay before the next reconnect, following Twitter's reconnect guidance'''
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status == 429:
+            delay = min(self.config.rate_limit_backoff_initial * 2 ** attempt, self.config.rate_limit_backoff_max)
+        elif status is not None:
+            delay = min(self.config.http_backoff_initial * 2 ** attempt, self.config.http_backoff_max)
+        else:
+            delay = min(self.config.backoff_initial * 2 ** attempt, self.config.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def tweets(self):
+        '''Yield tweets (and None heartbeats) across reconnects'''
+        attempt = 0
+        while True:
+            try:
+                for item in self.connect():
+                    attempt = 0
+                    yield item
+                error = None
+            except requests.RequestException as exc:
+                error = exc
+                print(f'Stream disconnected: {exc}')
+            if self.config.max_reconnects is not None and self.metrics.reconnects >= self.config.max_reconnects:
+                return
+            self.metrics.reconnects += 1
+            self.sleep(self.backoff(attempt, error))
+            attempt += 1
+
+    def add(self, item):
+        '''Add a streamed tweet to the current batch, flushing if it is full or too old'''
+        if item is not None:
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch.append(item)
+        if len(self.batch) >= self.config.batch_size or (
+                self.batch and time.monotonic() - self.batch_started >= self.config.max_wait):
+            self.flush()
+
+    def flush(self):
+        '''Clean, score and store the current batch in one transaction'''
+        if not self.batch:
+            return
+        tweets = store_batch(self.batch, self.config.query)
+        self.metrics.duplicates += len(self.batch) - len(tweets)
+        now = time.time()
+        self.metrics.lags.extend(now - parse_created_at(item['created_at'])
+                                 for item in self.batch if item.get('created_at'))
+        self.metrics.tweets += len(self.batch)
+        self.metrics.batches += 1
+        self.batch = []
+        if self.config.report_every and self.metrics.batches % self.config.report_every == 0:
+            print(self.metrics.summary())
+
+    def run(self, max_tweets=None):
+        '''Ingest until the stream ends or max_tweets have been stored'''
+        Database.create_table()
+        try:
+            for item in self.tweets():
+                self.add(item)
+                if max_tweets and self.metrics.tweets + len(self.batch) >= max_tweets:
+                    break
+        finally:
+            self.flush()
+        return self.metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--max-wait', type=float, default=1.0, help='Seconds before a partial batch is flushed')
+    parser.add_argument('--max-tweets', type=int, default=None)
+    parser.add_argument('--query', default='stream', help='Query the running statistics are kept under')
+    args = parser.parse_args()
+
+    config = StreamConfig(batch_size=args.batch_size, max_wait=args.max_wait, query=args.query)
+    metrics = StreamIngestor(config).run(args.max_tweets)
+    print(metrics.summary())
@@ -0,0 +1,74 @@
+'''Array-backed result table: numeric columns in a NumPy structured array, text in one contiguous buffer'''
+import numpy as np
+import pandas as pd
+from payload import PRECISION
+from storage import column_dtype
+
+TEXT_COLUMN = 'Text'
+
+
+class ResultTable:
+    '''Class for a read-only table of result rows, sliced without copying the dataset.
+
+    Range slices are views of the same arrays; boolean and index selections gather only the
+    selected rows' numbers and text offsets, and every selection shares the one text buffer.
+    '''
+
+    def __init__(self, columns, values, text, starts, ends):
+        self.columns = list(columns)
+        self.values = values
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+
+    @staticmethod
+    def from_rows(columns, rows):
+        '''Returns a table of (Text, numbers...) row tuples, storing NULL scores as NaN'''
+        columns = list(columns)
+        text_index = columns.index(TEXT_COLUMN)
+        numeric = [(i, column) for i, column in enumerate(columns) if i != text_index]
+        dtype = np.dtype([(column, column_dtype(column)) for _, column in numeric])
+        fills = {column: np.nan if dtype[column].kind == 'f' else 0 for _, column in numeric}
+        encoded = []
+        records = []
+        for row in rows:
+            encoded.append((row[text_index] or '').encode('utf-8'))
+            records.append(tuple(fills[column] if row[i] is None else row[i] for i, column in numeric))
+        values = np.array(records, dtype=dtype)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=offsets[1:])
+        text = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return ResultTable(columns, values, text, offsets[:-1], offsets[1:])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+        '''Returns a column by name, or the rows selected by a slice, boolean mask or index array'''
+        if isinstance(key, str):
+            return self.texts() if key == TEXT_COLUMN else self.values[key]
+        if isinstance(key, slice):
+            return ResultTable(self.columns, self.values[key], self.text, self.starts[key], self.ends[key])
+        key = np.asarray(key)
+        return ResultTable(self.columns, self.values[key], self.text, self.starts[key], self.ends[key])
+
+    def texts(self):
+        '''Returns the text of each row, decoded from the shared buffer'''
+        buffer = memoryview(self.text)
+        return [str(buffer[start:end], 'utf-8') for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    def nbytes(self):
+        return self.values.nbytes + self.text.nbytes + self.starts.nbytes + self.ends.nbytes
+
+    def payload(self, precision=PRECISION):
+        '''Returns the rows as {"columns": [...], "arrays": [column values, ...]}, with floats rounded'''
+        arrays = []
+        for column in self.columns:
+            values = self[column]
+            if column != TEXT_COLUMN and precision is not None and values.dtype.kind == 'f':
+                values = values.round(precision)
+            arrays.append(values)
+        return {'columns': self.columns, 'arrays': arrays}
+
+    def frame(self):
+        return pd.DataFrame({column: self[column] for column in self.columns}, columns=self.columns)
@@ -0,0 +1,67 @@
+'''Sentiment-over-time series, min/max downsampled in SQL to a fixed point budget'''
+import sqlite3
+import pandas as pd
+
+# Most points a series sends to the browser, whatever the time span
+POINT_BUDGET = 2000
+
+
+def visible_range(relayout_data):
+    '''Returns the (start, end) epoch seconds of a zoomed time axis, or None when the axis is autoranged'''
+    if not relayout_data or relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        bounds = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        bounds = relayout_data['xaxis.range']
+    else:
+        return None
+    return tuple(pd.Timestamp(bound).timestamp() for bound in bounds)
+
+
+def query_series(db_path, column, time_range=None, width=1000, point_budget=POINT_BUDGET):
+    '''Returns the points, bucket means and min/max envelope of a score column over a time range'''
+    if not column.isidentifier():
+        raise ValueError(f'Invalid column name: {column}')
+    where = f'Created_At IS NOT NULL AND {column} IS NOT NULL'
+    with sqlite3.connect(db_path) as conn:
+        try:
+            bounds = conn.execute(f'SELECT MIN(Created_At), MAX(Created_At) FROM tweets WHERE {where}').fetchone()
+        except sqlite3.OperationalError:
+            # No tweets table with timestamps yet
+            return empty_series()
+        time_range = time_range or bounds
+        if time_range[0] is None:
+            return empty_series()
+        start, end = time_range
+        params = {'start': start, 'end': end}
+        where += ' AND Created_At BETWEEN :start AND :end'
+        count = conn.execute(f'SELECT COUNT(*) FROM tweets WHERE {where}', params).fetchone()[0]
+        if count <= point_budget:
+            points = pd.read_sql_query(
+                f'SELECT Created_At, {column} AS Value FROM tweets WHERE {where} ORDER BY Created_At', conn, params=params)
+            return {'points': points, 'mean': empty_frame(), 'envelope': empty_frame(), 'count': count}
+        # A bucket per pixel, with a mean and a min and a max point each
+        buckets = max(1, min(width, point_budget // 3))
+        params['width'] = (end - start) / buckets or 1.0
+        params['last'] = buckets - 1
+        bucket = 'MIN(CAST((Created_At - :start) / :width AS INTEGER), :last)'
+        mean = pd.read_sql_query(
+            f'SELECT {bucket} AS Bucket, SUM({column} * Multiplicity) * 1.0 / SUM(Multiplicity) AS Value '
+            f'FROM tweets WHERE {where} GROUP BY Bucket ORDER BY Bucket', conn, params=params)
+        mean['Created_At'] = start + (mean['Bucket'] + 0.5) * params['width']
+        # SQLite returns the Created_At of the row holding a bare MIN()/MAX()
+        extremes = [pd.read_sql_query(
+            f'SELECT {bucket} AS Bucket, {aggregate}({column}) AS Value, Created_At '
+            f'FROM tweets WHERE {where} GROUP BY Bucket', conn, params=params) for aggregate in ('MIN', 'MAX')]
+    envelope = pd.concat(extremes).drop_duplicates().sort_values(['Created_At', 'Value'], ignore_index=True)
+    return {'points': empty_frame(), 'mean': mean[['Created_At', 'Value']], 'envelope': envelope[['Created_At', 'Value']],
+            'count': count}
+
+
+def empty_frame():
+    return pd.DataFrame({'Created_At': pd.Series(dtype=float), 'Value': pd.Series(dtype=float)})
+
+
+def empty_series():
+    return {'points': empty_frame(), 'mean': empty_frame(), 'envelope': empty_frame(), 'count': 0}
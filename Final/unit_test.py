@@ -1,5 +1,41 @@
+import csv
+import gzip
+import json
+import marshal
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import main  # The name of the file you provided
+import mock_twitter
+import load_test
+import scoring
+import lexicon
+import profiling
+import stream
+import backfill
+import dedup
+import cache
+import stats
+import alerts
+import sketch
+import timeseries
+import live
+import payload
+import window
+import table
+import storage
+import compact
+import rescore
+import scheduler
+import numpy as np
 from unittest.mock import patch, MagicMock
 
 class TestTweet(unittest.TestCase):
@@ -46,6 +82,1537 @@ class TestDatabase(unittest.TestCase):
         main.Database.store_in_database(tweet_data)
         mock_cursor.executemany.assert_called()
 
+
+class TestMockTwitter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock_twitter.MockTwitterServer(mock_twitter.MockTwitterConfig(rate_limit=3))
+        self.client = self.server.app.test_client()
+        self.token = self.client.post('/oauth2/token', headers={'Authorization': 'Basic a2V5OnNlY3JldA=='},
+                                      data={'grant_type': 'client_credentials'}).get_json()['access_token']
+
+    def search(self, **params):
+        return self.client.get('/2/tweets/search/recent', query_string=params,
+                               headers={'Authorization': f'Bearer {self.token}'})
+
+    def test_pagination(self):
+        first = self.search(query='football', max_results=10).get_json()
+        second = self.search(query='football', max_results=10, next_token=first['meta']['next_token']).get_json()
+        self.assertEqual(len(first['data']), 10)
+        self.assertLess(int(second['data'][0]['id']), int(first['data'][-1]['id']))
+
+    def test_rate_limit_headers(self):
+        responses = [self.search(query='football') for _ in range(4)]
+        self.assertEqual(responses[0].headers['x-rate-limit-remaining'], '2')
+        self.assertEqual(responses[-1].status_code, 429)
+
+    def test_search_tweets_against_base_url(self):
+        base_url = main.TwitterAPI.base_url
+        try:
+            main.TwitterAPI.base_url = self.server.start()
+            token = main.TwitterAPI.get_bearer_token('a2V5OnNlY3JldA==')
+            tweets = main.TwitterAPI.search_tweets(token, 'football', 10)
+        finally:
+            self.server.stop()
+            main.TwitterAPI.base_url = base_url
+        self.assertEqual(len(tweets), 10)
+        self.assertTrue(all('football' in t for t in tweets))
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_run_against_mock(self):
+        with patch('builtins.print'):
+            report = load_test.run_against_mock(total_requests=4, concurrency=2)
+        self.assertEqual(report.total_requests, 4)
+        self.assertEqual(report.errors, {})
+        self.assertEqual(len(report.latencies['update_results']), 2)
+        self.assertGreater(report.requests_per_second, 0)
+
+    def test_percentile(self):
+        self.assertEqual(load_test.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(load_test.percentile(list(range(1, 101)), 95), 95)
+
+
+class TestFastVader(unittest.TestCase):
+
+    def test_matches_nltk_compound(self):
+        corpus = scoring.reference_corpus(size=5000, seed=1)
+        self.assertLessEqual(scoring.validate_against_nltk(corpus), 1e-6)
+
+    def test_polarity_scores_match_nltk(self):
+        text = "The service was NOT great, but the food was VERY good!! :)"
+        fast = scoring.get_vader_analyzer('fast').polarity_scores(text)
+        reference = scoring.get_vader_analyzer('nltk').polarity_scores(text)
+        self.assertEqual(fast, reference)
+
+    def test_compound_batch(self):
+        texts = ["I love it", "I hate it", "it is a table"]
+        analyzer = scoring.get_vader_analyzer('fast')
+        self.assertEqual(analyzer.compound_batch(texts), [analyzer.polarity_scores(t)['compound'] for t in texts])
+
+    @patch("main.Tweet.vader_backend", "fast")
+    def test_selectable_backend(self):
+        self.assertEqual(main.Tweet.analyze_sentiment_vader("I love it"), 0.6369)
+
+    def test_analyze_uses_selected_backend(self):
+        for backend in ('nltk', 'fast'):
+            with patch("main.Tweet.vader_backend", backend), \
+                    patch("main.get_vader_analyzer", wraps=scoring.get_vader_analyzer) as analyzer:
+                tweet = main.Tweet(text="I love it")
+                tweet.analyze(scoring.FULL_SCORING)
+                self.assertEqual(tweet.sentiment_vader, 0.6369)
+                analyzer.assert_called_with(backend)
+        self.assertEqual(main.Tweet.vader_backend, os.getenv('VADER_Backend', 'fast'))
+
+
+class TestSharedTokenStream(unittest.TestCase):
+
+    def assert_matches_separate_analyzers(self, text):
+        separate = main.Tweet(text)
+        separate.clean()
+        separate.analyze_sentiment()
+        separate.sentiment_vader = main.Tweet.analyze_sentiment_vader(separate.text)
+        shared = main.Tweet(text)
+        shared.clean()
+        shared.analyze()
+        self.assertEqual(shared, separate)
+
+    def test_matches_mock_corpus(self):
+        for tweet in mock_twitter.MockTwitterServer().generate_tweets('football')[:200]:
+            self.assert_matches_separate_analyzers(tweet['text'])
+
+    def test_matches_tokenizer_edge_cases(self):
+        for text in ["not _good_ at all", "X D so happy", "o _ O wow", "__ really not bad", "", "never so great"]:
+            self.assert_matches_separate_analyzers(text)
+
+    def test_get_tweet_sentiments(self):
+        result = main.TwitterAPI.get_tweet_sentiments(["I love it @user", "I hate it #sad"])
+        self.assertEqual([row[0] for row in result], ["I love it", "I hate it"])
+        self.assertGreater(result[0][3], 0)
+        self.assertLess(result[1][3], 0)
+
+
+class TestStreamIngestor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = main.Database.db_path
+        main.Database.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+
+    def tearDown(self):
+        main.Database.db_path = self.db_path
+        self.tmp_dir.cleanup()
+
+    @patch.dict(os.environ, {'Key_Twitter': 'key', 'Secret_Key_Twitter': 'secret'})
+    def test_run_reconnects_and_stores_batches(self):
+        server = mock_twitter.MockTwitterServer(mock_twitter.MockTwitterConfig(stream_limit=25, stream_rate=0))
+        base_url = main.TwitterAPI.base_url
+        try:
+            main.TwitterAPI.base_url = server.start()
+            config = stream.StreamConfig(batch_size=10, max_reconnects=1, report_every=0)
+            metrics = stream.StreamIngestor(config, sleep=lambda delay: None).run()
+        finally:
+            server.stop()
+            main.TwitterAPI.base_url = base_url
+        self.assertEqual((metrics.tweets, metrics.batches, metrics.reconnects), (50, 5, 1))
+        with sqlite3.connect(main.Database.db_path) as conn:
+            rows, total = conn.execute('SELECT COUNT(*), SUM(Multiplicity) FROM tweets').fetchone()
+        self.assertEqual(total, 50)
+        self.assertGreater(metrics.duplicates, 0)
+        self.assertLessEqual(rows, len(mock_twitter.TEMPLATES))
+        self.assertGreaterEqual(metrics.lag_percentile(95), 0)
+
+    def test_flush_on_time_window(self):
+        main.Database.create_table()
+        ingestor = stream.StreamIngestor(stream.StreamConfig(batch_size=100, max_wait=0, report_every=0))
+        ingestor.add({'text': 'I love it'})
+        ingestor.add(None)
+        self.assertEqual((ingestor.metrics.batches, ingestor.batch), (1, []))
+
+    def test_rate_limit_backoff(self):
+        ingestor = stream.StreamIngestor()
+        error = MagicMock(response=MagicMock(status_code=429))
+        self.assertGreaterEqual(ingestor.backoff(0, error), 30)
+        self.assertLessEqual(ingestor.backoff(0, None), 0.25)
+        self.assertLessEqual(ingestor.backoff(30, error), ingestor.config.rate_limit_backoff_max)
+
+    @patch('main.requests.get')
+    def test_malformed_stream_lines_are_skipped(self, get):
+        get.return_value.__enter__.return_value.iter_lines.return_value = [
+            b'{"data": {"text": "first"}}', b'', b'{"data": {"te', b'[1]', b'{"data": {"text": "last"}}']
+        self.assertEqual(list(main.TwitterAPI.stream_tweets('token')), [{'text': 'first'}, None, {'text': 'last'}])
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        self.archive = os.path.join(self.tmp_dir.name, 'archive.jsonl')
+        self.write_archive(range(30))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_archive(self, ids):
+        with open(self.archive, 'a', encoding='utf-8') as f:
+            for i in ids:
+                f.write(json.dumps({'data': {'id': str(i), 'text': f'tweet {i} I love it'}}) + '\n')
+
+    def stored_count(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute('SELECT SUM(Multiplicity) FROM tweets').fetchone()[0]
+
+    def run_backfill(self):
+        with patch('builtins.print'):
+            backfill.Backfill(self.archive, self.db_path, chunk_size=10, commit_every=1, workers=1).run()
+
+    def test_compact_storage_is_rejected(self):
+        with patch.object(main.Database, 'storage_format', 'compact'), self.assertRaises(ValueError):
+            self.run_backfill()
+        self.assertFalse(os.path.exists(self.db_path))
+
+    def test_resumes_after_crash(self):
+        commit = backfill.Backfill.commit
+        calls = []
+
+        def crash_on_second_commit(self, conn, rows, offset, records):
+            calls.append(offset)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            commit(self, conn, rows, offset, records)
+
+        with patch.object(backfill.Backfill, 'commit', crash_on_second_commit):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_backfill()
+        self.assertEqual(self.stored_count(), 10)
+        self.run_backfill()
+        self.assertEqual(self.stored_count(), 30)
+
+    def test_picks_up_appended_rows(self):
+        self.run_backfill()
+        self.write_archive(range(30, 35))
+        self.run_backfill()
+        self.assertEqual(self.stored_count(), 35)
+
+    def test_repeats_across_chunks_of_one_commit_fold(self):
+        os.remove(self.archive)
+        with open(self.archive, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps({'data': {'id': str(i), 'text': 'same tweet'}}) + '\n' for i in range(4))
+        with patch('builtins.print'):
+            backfill.Backfill(self.archive, self.db_path, chunk_size=1, commit_every=4, workers=1).run()
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT Text, Multiplicity FROM tweets').fetchall(), [('same tweet', 4)])
+
+    def test_read_csv_chunks(self):
+        path = os.path.join(self.tmp_dir.name, 'archive.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'text'])
+            writer.writerows([[1, 'multi\nline'], [2, 'second'], [3, 'third']])
+        chunks = list(backfill.read_chunks(path, chunk_size=2))
+        self.assertEqual([texts for _, texts, _ in chunks], [['multi\nline', 'second'], ['third']])
+        self.assertEqual([texts for _, texts, _ in backfill.read_chunks(path, offset=chunks[0][0])], [['third']])
+
+    def test_jsonl_offsets_count_bytes(self):
+        path = os.path.join(self.tmp_dir.name, 'archive.jsonl')
+        lines = [json.dumps({'text': text}, ensure_ascii=False) + '\n' for text in ['café', '', 'naïve 😀', 'last']]
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(lines[:1] + ['\n'] + lines[2:])
+        chunks = list(backfill.read_chunks(path, chunk_size=2))
+        self.assertEqual(chunks[-1][0], os.path.getsize(path))
+        self.assertEqual([texts for _, texts, _ in backfill.read_chunks(path, offset=chunks[0][0])], [['last']])
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def clean_tweets(self, texts):
+        tweets = [main.Tweet(text=t) for t in texts]
+        for tweet in tweets:
+            tweet.clean()
+        return tweets
+
+    def test_exact_duplicates(self):
+        tweets = self.clean_tweets(["RT @brand I love it!", "I love it", "i LOVE it #ad", "I hate it"])
+        unique = dedup.Deduplicator(threshold=1.0).dedupe(tweets)
+        self.assertEqual([(t.text, t.multiplicity) for t in unique], [("RT   I love it", 1), ("I love it", 2), ("I hate it", 1)])
+
+    def test_near_duplicates_with_threshold(self):
+        tweets = self.clean_tweets(["Win a free phone today click here 1234", "Win a free phone today click here 5678",
+                                    "Completely unrelated text about football"])
+        self.assertEqual(len(dedup.Deduplicator(threshold=0.9).dedupe(list(tweets))), 3)
+        unique = dedup.Deduplicator(threshold=0.6).dedupe(tweets)
+        self.assertEqual([t.multiplicity for t in unique], [2, 1])
+
+    def test_store_tweets_merges_with_stored_rows(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            main.Database.create_table(db_path)
+            main.Database.store_tweets([main.Tweet('I love it', multiplicity=2)], db_path)
+            main.Database.store_tweets([main.Tweet('i love  it'), main.Tweet('I hate it')], db_path)
+            with sqlite3.connect(db_path) as conn:
+                rows = conn.execute('SELECT Text, Multiplicity FROM tweets ORDER BY rowid').fetchall()
+        self.assertEqual(rows, [('I love it', 3), ('I hate it', 1)])
+
+    def test_create_table_migrates_old_schema(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            with sqlite3.connect(db_path) as conn:
+                conn.execute('CREATE TABLE tweets (Text TEXT, Sentiment REAL, Sentiment_Magnitude REAL, Sentiment_VADER REAL)')
+                conn.execute("INSERT INTO tweets VALUES ('old', 0, 0, 0)")
+            main.Database.create_table(db_path)
+            with sqlite3.connect(db_path) as conn:
+                self.assertEqual(conn.execute('SELECT Multiplicity FROM tweets').fetchone(), (1,))
+
+class TestFullTextSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+        main.Database.store_tweets([main.Tweet('battery life is great', 0.8), main.Tweet('the battery died again', -0.5),
+                                    main.Tweet('battery battery battery', 0.1), main.Tweet('great screen', 0.8)],
+                                   self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_fts_query_quotes_terms(self):
+        self.assertEqual(main.Database.fts_query('battery "great screen" bat* OR'),
+                         '"battery" "great screen" "bat"* "OR"')
+        self.assertEqual(main.Database.fts_query('  '), '')
+
+    def test_search_joins_scores(self):
+        rows = main.Database.search_text('battery great', db_path=self.db_path)
+        self.assertEqual(rows, [('battery life is great', 0.8, 0.0, 0.0, 1)])
+        self.assertEqual(len(main.Database.search_text('"battery died"', db_path=self.db_path)), 1)
+        self.assertEqual(len(main.Database.search_text('bat*', db_path=self.db_path)), 3)
+
+    def test_bm25_ranking(self):
+        rows = main.Database.search_text('battery', rank=True, db_path=self.db_path)
+        self.assertEqual(rows[0][0], 'battery battery battery')
+
+    def test_index_follows_deletes_and_updates(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE tweets SET Text = 'screen cracked' WHERE Text = 'the battery died again'")
+        self.assertEqual(len(main.Database.search_text('battery', db_path=self.db_path)), 2)
+        self.assertEqual(len(main.Database.search_text('cracked', db_path=self.db_path)), 1)
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.clear_table('tweets')
+        self.assertEqual(main.Database.search_text('screen', db_path=self.db_path), [])
+
+    def test_existing_rows_are_indexed(self):
+        db_path = os.path.join(self.tmp_dir.name, 'old.db')
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('CREATE TABLE tweets (Text TEXT, Sentiment REAL, Sentiment_Magnitude REAL, Sentiment_VADER REAL)')
+            conn.execute("INSERT INTO tweets VALUES ('old battery', 0, 0, 0)")
+        main.Database.create_table(db_path)
+        self.assertEqual(len(main.Database.search_text('battery', db_path=db_path)), 1)
+
+    def test_filter_results_callback(self):
+        with patch.object(main.Database, 'db_path', self.db_path):
+            fig, data = main.filter_results('great', ['bm25'])
+        self.assertEqual({row['Text'] for row in payload.records(data)}, {'battery life is great', 'great screen'})
+        self.assertEqual(fig.data[0].x.tolist(), [0.8, 0.8])
+
+class TestEntities(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def store(self, *texts):
+        tweets = [main.Tweet(text) for text in texts]
+        for tweet in tweets:
+            tweet.clean()
+            tweet.analyze()
+        main.Database.store_tweets(tweets, self.db_path)
+        return tweets
+
+    def entity(self, kind, value):
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute('SELECT Tweets, Sentiment_Sum, Sentiment_Count FROM entities WHERE Kind = ? AND Value = ?',
+                                (kind, value)).fetchone()
+
+    def test_extract_before_clean(self):
+        tweet = main.Tweet('Hi @Bob, see https://x.com/a#frag. #Great #great day!')
+        tweet.clean()
+        self.assertEqual(tweet.entities, (('mention', 'bob'), ('url', 'https://x.com/a#frag'), ('hashtag', 'great')))
+        self.assertEqual(tweet.text.split(), ['Hi', 'see', 'day'])
+
+    def test_counts_follow_tweets(self):
+        love, hate = self.store('I love it #phone @shop', 'I hate it #phone #battery')
+        self.store('I love it #phone @shop')
+        tweets, total, count = self.entity('hashtag', 'phone')
+        self.assertEqual((tweets, count), (3, 3))
+        self.assertAlmostEqual(total, 2 * love.sentiment_vader + hate.sentiment_vader)
+        self.assertEqual(main.Database.top_entities(db_path=self.db_path),
+                         [('phone', 3, total / 3), ('battery', 1, hate.sentiment_vader)])
+        self.assertEqual(main.Database.top_entities('mention', db_path=self.db_path)[0][:2], ('shop', 2))
+        # Rescoring a tweet moves the means of its entities
+        with sqlite3.connect(self.db_path) as conn:
+            rowid = conn.execute("SELECT rowid FROM tweets WHERE Text LIKE 'I hate%'").fetchone()[0]
+        main.Database.bulk_update(['Sentiment_VADER'], [(rowid, None)], self.db_path)
+        self.assertEqual(self.entity('hashtag', 'battery'), (1, 0.0, 0))
+        self.assertEqual(main.Database.top_entities(db_path=self.db_path), [('phone', 3, love.sentiment_vader)])
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.clear_table('tweets')
+            fig = main.update_hashtags(None, None)
+        self.assertEqual(self.entity('hashtag', 'phone'), (0, 0.0, 0))
+        self.assertEqual(main.Database.top_entities(db_path=self.db_path), [])
+        self.assertEqual(len(fig.data[0].y), 0)
+
+    def test_folded_duplicates_keep_their_own_entities(self):
+        tweets = [main.Tweet(text) for text in ('I love it #happy', 'I love it #sad', 'I love it')]
+        for tweet in tweets:
+            tweet.clean()
+        love, = dedup.Deduplicator().dedupe(tweets)
+        love.analyze()
+        main.Database.store_tweets([love], self.db_path)
+        self.assertEqual(sorted(main.Database.top_entities(db_path=self.db_path)),
+                         [('happy', 1, love.sentiment_vader), ('sad', 1, love.sentiment_vader)])
+        # A copy folding into the stored row only credits its own entities, not the row's whole multiplicity
+        self.store('I love it #sad')
+        self.assertEqual(self.entity('hashtag', 'happy'), (1, love.sentiment_vader, 1))
+        self.assertEqual(self.entity('hashtag', 'sad')[0::2], (2, 2))
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT Multiplicity FROM tweets').fetchall(), [(4,)])
+            rowid = conn.execute('SELECT rowid FROM tweets').fetchone()[0]
+        main.Database.bulk_update(['Sentiment_VADER'], [(rowid, None)], self.db_path)
+        self.assertEqual(self.entity('hashtag', 'sad'), (2, 0.0, 0))
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.clear_table('tweets')
+        self.assertEqual(self.entity('hashtag', 'happy'), (0, 0.0, 0))
+
+    def test_top_query_uses_index(self):
+        with sqlite3.connect(self.db_path) as conn:
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT Value FROM entities WHERE Kind = ? AND '
+                                'Mean_Sentiment IS NOT NULL ORDER BY Mean_Sentiment DESC', ('hashtag',)).fetchall()
+        self.assertIn('idx_entities_kind_mean', plan[0][-1])
+        with self.assertRaises(ValueError):
+            main.Database.top_entities('cashtag', db_path=self.db_path)
+
+    def test_backfill_links_entities(self):
+        archive = os.path.join(self.tmp_dir.name, 'archive.jsonl')
+        with open(archive, 'w', encoding='utf-8') as f:
+            for i in range(3):
+                f.write(json.dumps({'data': {'id': str(i), 'text': f'tweet {i} I love it #launch'}}) + '\n')
+        with patch('builtins.print'):
+            backfill.Backfill(archive, self.db_path, chunk_size=10, workers=1).run()
+        self.assertEqual(self.entity('hashtag', 'launch')[0], 3)
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.caches = main.TwitterAPI.search_cache, main.TwitterAPI.token_cache
+        main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = cache.TTLCache(60), cache.TTLCache(60)
+
+    def tearDown(self):
+        main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = self.caches
+
+    def test_ttl_expiry(self):
+        now = [0.0]
+        ttl_cache = cache.TTLCache(ttl=10, clock=lambda: now[0])
+        compute = MagicMock(side_effect=[1, 2])
+        self.assertEqual([ttl_cache.get('k', compute), ttl_cache.get('k', compute)], [1, 1])
+        now[0] = 11
+        self.assertEqual(ttl_cache.get('k', compute), 2)
+        self.assertEqual(compute.call_count, 2)
+
+    def test_concurrent_misses_share_one_call(self):
+        ttl_cache = cache.TTLCache(ttl=10)
+        release = threading.Event()
+        compute = MagicMock(side_effect=lambda: release.wait(5) and 'value')
+        with ThreadPoolExecutor(8) as pool:
+            futures = [pool.submit(ttl_cache.get, 'k', compute) for _ in range(8)]
+            while ttl_cache.coalesced < 7:
+                time.sleep(0.001)
+            release.set()
+            self.assertEqual({f.result() for f in futures}, {'value'})
+        self.assertEqual(compute.call_count, 1)
+
+    def test_failures_are_not_cached(self):
+        ttl_cache = cache.TTLCache(ttl=10)
+        compute = MagicMock(side_effect=[ValueError('down'), None, 'ok'])
+        with self.assertRaises(ValueError):
+            ttl_cache.get('k', compute)
+        self.assertIsNone(ttl_cache.get('k', compute, cache_if=lambda v: v is not None))
+        self.assertEqual([ttl_cache.get('k', compute), ttl_cache.get('k', compute)], ['ok', 'ok'])
+
+    def test_repeat_searches_reuse_response_and_token(self):
+        server = mock_twitter.MockTwitterServer()
+        base_url = main.TwitterAPI.base_url
+        try:
+            main.TwitterAPI.base_url = server.start()
+            tokens = {main.TwitterAPI.get_bearer_token('a2V5OnNlY3JldA==') for _ in range(3)}
+            first = main.TwitterAPI.search_tweets(tokens.pop(), 'football', 10)
+            second = main.TwitterAPI.search_tweets('unused', ' football ', 10)
+            other = main.TwitterAPI.search_tweets('unused', 'football', 20)
+        finally:
+            server.stop()
+            main.TwitterAPI.base_url = base_url
+        self.assertEqual(first, second)
+        self.assertEqual(other, [])
+        self.assertEqual(tokens, set())
+        # One token request, one search, and one unauthorized search with the bad token
+        self.assertEqual(server.request_count, 3)
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_moments_and_quantiles(self):
+        rng = random.Random(1)
+        values = [max(-1.0, min(1.0, rng.gauss(0.1, 0.4))) for _ in range(5000)]
+        column_stats = stats.ColumnStats()
+        for value in values:
+            column_stats.add(value)
+        summary = column_stats.summary()
+        self.assertAlmostEqual(summary['mean'], np.mean(values), places=9)
+        self.assertAlmostEqual(summary['std'], np.std(values, ddof=1), places=9)
+        for pct in (5, 50, 95):
+            self.assertAlmostEqual(summary[f'p{pct}'], np.percentile(values, pct), delta=0.03)
+        self.assertEqual(sum(column_stats.histogram.counts), len(values))
+
+    def test_multiplicity_weights(self):
+        weighted, repeated = stats.ColumnStats(), stats.ColumnStats()
+        for value, weight in [(0.5, 3), (-0.2, 1), (0.9, 2), (0.0, 4), (-0.7, 1)]:
+            weighted.add(value, weight)
+            for _ in range(weight):
+                repeated.add(value)
+        for key, value in repeated.summary().items():
+            self.assertAlmostEqual(weighted.summary()[key], value)
+
+    def test_record_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            self.assertEqual(stats.QueryStats.load('football', main.SCORE_COLUMNS, db_path).summary()['Sentiment']['count'], 0)
+            stats.QueryStats.record('football', main.SCORE_COLUMNS, [main.Tweet('a', 0.5, 0.1, 0.2, multiplicity=2)], db_path)
+            stats.QueryStats.record(' football ', main.SCORE_COLUMNS, [main.Tweet('b', -0.5, 0.3, 0.4)], db_path)
+            summary = stats.QueryStats.load('football', main.SCORE_COLUMNS, db_path).summary()
+            with patch.object(main.Database, 'db_path', db_path):
+                cards = main.update_summary(None, None, 'football')
+        self.assertEqual(summary['Sentiment']['count'], 3)
+        self.assertAlmostEqual(summary['Sentiment']['mean'], 0.5 / 3)
+        self.assertAlmostEqual(summary['Sentiment_VADER']['max'], 0.4)
+        self.assertEqual(len(cards), 3)
+
+    def test_refetched_tweets_are_counted_once(self):
+        items = [{'id': '1', 'text': 'I love it #a'}, {'id': '2', 'text': 'I love it #b'}, {'id': '3', 'text': 'meh'}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            main.Database.create_table(db_path)
+            for _ in range(3):
+                stream.store_batch(items, 'football', db_path)
+            counts = [stats.QueryStats.load('football', main.SCORE_COLUMNS, db_path).summary()['Sentiment']['count']]
+            total = sketch.TermSketch.load('football', db_path).total
+            # A new copy of a counted tweet adds one, and tweets without ids always count
+            stream.store_batch(items + [{'id': '4', 'text': 'I love it'}, {'text': 'meh'}], 'football', db_path)
+            counts.append(stats.QueryStats.load('football', main.SCORE_COLUMNS, db_path).summary()['Sentiment']['count'])
+            self.assertEqual(stats.QueryStats.load('other', main.SCORE_COLUMNS, db_path).summary()['Sentiment']['count'], 0)
+        self.assertEqual(counts, [3, 5])
+        self.assertEqual(total, 3)
+
+    def test_counted_ids_are_pruned_after_the_search_window(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            with patch.object(stats.time, 'time', return_value=1700000000):
+                first = stats.uncounted_ids('q', ['1', '2'], db_path)
+                again = stats.uncounted_ids('q', ['1', '2', '3'], db_path)
+            with patch.object(stats.time, 'time', return_value=1700000000 + stats.COUNTED_WINDOW + 1):
+                later = stats.uncounted_ids('q', ['4'], db_path)
+            with sqlite3.connect(db_path) as conn:
+                rows = conn.execute('SELECT Tweet_Id FROM counted_tweets').fetchall()
+        self.assertEqual((first, again, later), ({'1', '2'}, {'3'}, {'4'}))
+        self.assertEqual(rows, [('4',)])
+
+    def test_constant_size(self):
+        query_stats = stats.QueryStats('q', main.SCORE_COLUMNS)
+        query_stats.update([main.Tweet('a', i / 1000, 0.2, -i / 1000) for i in range(1000)])
+        size = len(query_stats.to_json())
+        query_stats.update([main.Tweet('a', i / 10000, 0.2, -i / 10000) for i in range(10000)])
+        self.assertLess(len(query_stats.to_json()), size * 1.1)
+
+class TestAlerts(unittest.TestCase):
+
+    config = alerts.AlertConfig(cusum=True)
+
+    def stream(self, seed=0):
+        rng = random.Random(seed)
+        means = [0.3] * 1000 + [-0.3] * 200 + [0.3] * 300
+        return [main.Tweet('t', sentiment_vader=rng.gauss(mean, 0.4), created_at=1700000000 + i)
+                for i, mean in enumerate(means)]
+
+    def test_drop_opens_and_closes_alerts(self):
+        events = alerts.QueryAlerts('q', self.config).update(self.stream())
+        ewma = [(kind, at - 1700000000) for detector, kind, _, at, *_ in events if detector == 'ewma']
+        self.assertEqual([kind for kind, _ in ewma], ['open', 'close'])
+        self.assertTrue(1000 <= ewma[0][1] < 1030)
+        self.assertIn(('cusum', 'open'), [event[:2] for event in events])
+        self.assertTrue(all(event[2] < 0 for event in events if event[1] == 'open'))
+
+    def test_newest_first_batches_are_detected_in_time_order(self):
+        tweets = self.stream()
+        events = alerts.QueryAlerts('q', self.config).update(tweets[::-1])
+        self.assertEqual(events, alerts.QueryAlerts('q', self.config).update(tweets))
+
+    def test_hysteresis_and_pending_scores(self):
+        config = alerts.AlertConfig(baseline_alpha=1e-12, level_alpha=0.5, threshold=3.0, clear=1.0)
+        detector = alerts.EwmaDetector(count=10 ** 12, mean=0.0, variance=1.0, level=0.0)
+        se = (0.5 / 1.5) ** 0.5
+        # Each score moves the level halfway to it, to z = -2, -5, -2 and -0.5
+        events = [detector.add(x * se, config) for x in (-4, -8, 1, 1)]
+        self.assertEqual([[(kind, round(z, 6)) for _, kind, z in step] for step in events],
+                         [[], [('open', -5.0)], [], [('close', -0.5)]])
+        self.assertAlmostEqual(detector.peak, 5.0)
+        self.assertEqual(alerts.QueryAlerts('q', config).update([main.Tweet('t')]), [])
+
+    def test_record_persists_state_and_alerts(self):
+        tweets = self.stream()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            self.assertEqual(alerts.QueryAlerts.recent(db_path), [])
+            # Batches recorded one by one open the same alerts as one pass over the stream
+            for i in range(0, len(tweets), 100):
+                alerts.QueryAlerts.record(' q ', tweets[i:i + 100], db_path, self.config)
+            recent = alerts.QueryAlerts.recent(db_path)
+            with patch.object(main.Database, 'db_path', db_path):
+                items = main.update_alerts(None, None)
+        expected = [event for event in alerts.QueryAlerts('q', self.config).update(tweets) if event[1] == 'open']
+        self.assertEqual(len(recent), len(expected))
+        self.assertEqual({alert['Query'] for alert in recent}, {'q'})
+        self.assertTrue(all(alert['Closed_At'] for alert in recent))
+        self.assertEqual(len(items), len(recent))
+
+    @patch.dict(os.environ, {'Alert_Direction': 'sideways'})
+    def test_config_from_env(self):
+        with self.assertRaises(ValueError):
+            alerts.AlertConfig.from_env()
+        with patch.dict(os.environ, {'Alert_Direction': 'both', 'Alert_Threshold': '4', 'Alert_Cusum': 'yes'}):
+            config = alerts.AlertConfig.from_env()
+        self.assertEqual((config.direction, config.threshold, config.cusum), ('both', 4.0, True))
+        self.assertEqual(config.deviation(-5.0), 5.0)
+
+class TestTermSketch(unittest.TestCase):
+
+    def corpus(self, seed=0, size=2000):
+        rng = random.Random(seed)
+        words = [f'word{i}' for i in range(500)]
+        # Zipf-like: a few heavy terms over a long tail
+        weights = [1 / (i + 1) for i in range(len(words))]
+        return [main.Tweet(' '.join(rng.choices(words, weights, k=8)) + ' the and', created_at=1700000000 + i)
+                for i in range(size)]
+
+    def exact(self, tweets):
+        return Counter(term for tweet in tweets for term in sketch.terms(tweet.text))
+
+    def test_estimates_bound_and_top_terms(self):
+        tweets = self.corpus()
+        terms = sketch.TermSketch('q', 0).update(tweets)
+        exact = self.exact(tweets)
+        self.assertNotIn('the', exact)
+        estimates = dict(zip(exact, terms.sketch.estimates(list(exact))))
+        self.assertTrue(all(estimates[term] >= count for term, count in exact.items()))
+        self.assertLessEqual(max(estimates[term] - count for term, count in exact.items()),
+                             np.e / sketch.SKETCH_WIDTH * terms.total * 2)
+        self.assertEqual([term for term, _ in terms.top_k.top(10)], [term for term, _ in exact.most_common(10)])
+        self.assertEqual(terms.total, sum(exact.values()))
+
+    def test_merge_matches_single_pass(self):
+        tweets = self.corpus()
+        whole = sketch.TermSketch('q', 0).update(tweets)
+        merged = sketch.TermSketch('q', 0).update(tweets[:700]).merge(sketch.TermSketch('q', 0).update(tweets[700:]))
+        self.assertTrue(np.array_equal(merged.sketch.counts, whole.sketch.counts))
+        self.assertEqual(merged.top_k.top(10), whole.top_k.top(10))
+        with self.assertRaises(ValueError):
+            merged.sketch.merge(sketch.CountMinSketch(width=64))
+
+    def test_record_by_bucket_and_load(self):
+        tweets = self.corpus(size=300)
+        tweets[-1].multiplicity = 1000
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            self.assertEqual(sketch.TermSketch.load('q', db_path).total, 0)
+            for i in range(0, len(tweets), 50):
+                sketch.TermSketch.record('q', tweets[i:i + 50], db_path, bucket_seconds=100)
+            with sqlite3.connect(db_path) as conn:
+                buckets, size = conn.execute('SELECT COUNT(*), MAX(LENGTH(Sketch)) FROM term_sketches').fetchone()
+            everything = sketch.TermSketch.load(' q ', db_path)
+            recent = sketch.TermSketch.load('q', db_path, window=100)
+            with patch.object(main.Database, 'db_path', db_path):
+                fig = main.update_trending(None, None, 'q')
+        self.assertEqual(buckets, 3)
+        self.assertLess(size, sketch.SKETCH_WIDTH * sketch.SKETCH_DEPTH)
+        self.assertEqual(everything.total, sum(self.exact(tweets).values()) + 999 * 8)
+        self.assertEqual(recent.total, sum(len(sketch.terms(t.text)) * t.multiplicity for t in tweets[100:]))
+        heavy = tweets[-1].text.split()[0]
+        self.assertEqual(everything.top_k.top(1)[0][0], heavy)
+        self.assertEqual(fig.data[0].y[0], heavy)
+
+    def test_unstamped_tweets_do_not_move_the_window(self):
+        tweets = self.corpus(size=100)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            sketch.TermSketch.record('q', tweets[:50] + [main.Tweet('unstamped')], db_path, bucket_seconds=100)
+            sketch.TermSketch.record('q', [main.Tweet('alone')], db_path, bucket_seconds=100)
+            recent = sketch.TermSketch.load('q', db_path, window=100)
+        self.assertEqual(recent.total, sum(len(sketch.terms(t.text)) for t in tweets[:50]) + 2)
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+        rng = random.Random(0)
+        self.tweets = [main.Tweet(f'tweet {i}', rng.uniform(-0.9, 0.9), 0.5, 0.0, created_at=1.7e9 + 60 * i)
+                       for i in range(10000)]
+        self.tweets[1234].sentiment, self.tweets[8765].sentiment = -1.0, 1.0
+        main.Database.store_tweets(self.tweets, self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_downsampled_under_budget(self):
+        series = timeseries.query_series(self.db_path, 'Sentiment', width=400, point_budget=900)
+        self.assertEqual(series['count'], 10000)
+        self.assertEqual(len(series['points']), 0)
+        self.assertLessEqual(len(series['mean']) + len(series['envelope']), 900)
+        self.assertEqual(series['envelope']['Value'].min(), -1.0)
+        self.assertEqual(series['envelope']['Value'].max(), 1.0)
+        self.assertEqual(series['envelope'].loc[series['envelope']['Value'].idxmin(), 'Created_At'], 1.7e9 + 60 * 1234)
+        self.assertTrue(series['envelope']['Created_At'].is_monotonic_increasing)
+
+    def test_zoom_returns_raw_points_of_visible_range(self):
+        relayout = {'xaxis.range[0]': '2023-11-14 22:28:20', 'xaxis.range[1]': '2023-11-15 02:13:20'}
+        time_range = timeseries.visible_range(relayout)
+        self.assertEqual(time_range, (1.7e9 + 60 * 15, 1.7e9 + 60 * 240))
+        series = timeseries.query_series(self.db_path, 'Sentiment', time_range, point_budget=900)
+        self.assertEqual(len(series['points']), 226)
+        self.assertEqual(series['points']['Value'].tolist()[:2], [t.sentiment for t in self.tweets[15:17]])
+        self.assertIsNone(timeseries.visible_range({'xaxis.autorange': True}))
+        self.assertIsNone(timeseries.visible_range({'autosize': True}))
+
+    def test_figure_and_missing_timestamps(self):
+        fig = main.timeseries_figure(timeseries.query_series(self.db_path, 'Sentiment_VADER'), 'Sentiment_VADER', None)
+        self.assertEqual([trace.name for trace in fig.data], ['envelope', 'mean'])
+        with self.assertRaises(ValueError):
+            timeseries.query_series(self.db_path, 'Sentiment; DROP TABLE tweets')
+        empty = timeseries.query_series(os.path.join(self.tmp_dir.name, 'missing.db'), 'Sentiment')
+        self.assertEqual(empty['count'], 0)
+
+    def test_callback_plots_scored_tweets_without_filling_pending_ones(self):
+        main.Database.bulk_update(['Sentiment'], [(rowid, None) for rowid in range(1, 101)], self.db_path)
+        with patch.object(main.Database, 'db_path', self.db_path), \
+                patch.object(main.dash, 'ctx', MagicMock(triggered_id=None)):
+            fig = main.update_timeseries(None, 'Sentiment', None, 500)
+        self.assertIn('9900 tweets', fig.layout.title.text)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM tweets WHERE Sentiment IS NULL').fetchone()[0], 100)
+
+class TestLiveFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+        main.Database.store_tweets([main.Tweet('already here', 0.1)], self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_each_client_gets_only_new_rows(self):
+        feed = live.LiveFeed(batch_limit=2)
+        first = feed.register(self.db_path)
+        main.Database.store_tweets([main.Tweet('one', 0.5), main.Tweet('two', -0.5), main.Tweet('three')], self.db_path)
+        second = feed.register(self.db_path)
+        main.Database.store_tweets([main.Tweet('four', 0.2)], self.db_path)
+        self.assertEqual([row[0] for row in feed.poll(first, self.db_path)], ['one', 'two'])
+        self.assertEqual([row[0] for row in feed.poll(first, self.db_path)], ['three', 'four'])
+        self.assertEqual(feed.poll(first, self.db_path), [])
+        self.assertEqual([row[0] for row in feed.poll(second, self.db_path)], ['four'])
+        self.assertEqual(feed.poll('unknown', self.db_path), [])
+
+    def test_cleared_table_restarts_cursor(self):
+        feed = live.LiveFeed()
+        main.Database.store_tweets([main.Tweet('one'), main.Tweet('two')], self.db_path)
+        client = feed.register(self.db_path)
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.clear_table('tweets')
+        main.Database.store_tweets([main.Tweet('fresh')], self.db_path)
+        self.assertEqual([row[0] for row in feed.poll(client, self.db_path)], ['fresh'])
+
+    def test_refill_as_large_as_the_cleared_table_is_delivered(self):
+        feed = live.LiveFeed()
+        main.Database.store_tweets([main.Tweet(f'old {i}') for i in range(4)], self.db_path)
+        client = feed.register(self.db_path)
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.clear_table('tweets')
+        main.Database.store_tweets([main.Tweet(f'new {i}') for i in range(6)], self.db_path)
+        self.assertEqual([row[0] for row in feed.poll(client, self.db_path)], [f'new {i}' for i in range(6)])
+        self.assertEqual(feed.poll(client, self.db_path), [])
+
+    def test_live_callbacks(self):
+        with patch.object(main.Database, 'db_path', self.db_path), patch.object(main, 'live_feed', live.LiveFeed()):
+            disabled, client, fig, data = main.toggle_live(['live'], None)
+            with self.assertRaises(main.dash.exceptions.PreventUpdate):
+                main.live_update(1, client)
+            main.Database.store_tweets([main.Tweet('new', 0.5, multiplicity=3)], self.db_path)
+            (points, traces, _), table_patch = main.live_update(2, client)
+        self.assertFalse(disabled)
+        self.assertEqual((len(fig.data), data), (1, []))
+        self.assertEqual((points, traces), ({'x': [[0.5]], 'y': [[3]]}, [0]))
+        operation = table_patch.to_plotly_json()['operations'][0]
+        self.assertEqual(operation['operation'], 'Extend')
+        self.assertEqual(operation['params']['value'][0]['Text'], 'new')
+
+class TestPayload(unittest.TestCase):
+
+    def test_columnar_round_trip(self):
+        df = main.pd.DataFrame({'Text': ['a', 'b'], 'Sentiment': [0.123456789, -0.5], 'Multiplicity': [1, 2]})
+        table = payload.columnar(df, precision=3)
+        self.assertEqual(table, {'columns': ['Text', 'Sentiment', 'Multiplicity'],
+                                 'data': [['a', 0.123, 1], ['b', -0.5, 2]]})
+        self.assertEqual(payload.records(table), [{'Text': 'a', 'Sentiment': 0.123, 'Multiplicity': 1},
+                                                  {'Text': 'b', 'Sentiment': -0.5, 'Multiplicity': 2}])
+
+    def test_responses_are_compressed(self):
+        client = main.app.server.test_client()
+        plain = client.get('/_dash-layout')
+        compressed = client.get('/_dash-layout', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertLess(len(compressed.data), len(plain.data) / 3)
+        self.assertEqual(json.loads(gzip.decompress(compressed.data)), plain.get_json())
+
+    def test_benchmark(self):
+        results = payload.benchmark(rows=200, repeat=1)
+        self.assertLess(results['split + round(4) + json']['bytes'], results['records + json']['bytes'])
+
+class TestRollingWindow(unittest.TestCase):
+
+    columns = ['Text', 'Sentiment']
+
+    def test_evicts_oldest_rows_by_count(self):
+        spilled = []
+        results = window.RollingWindow(self.columns, max_rows=3, max_bytes=None, spill=spilled.extend)
+        results.extend((f't{i}', i / 10) for i in range(5))
+        self.assertEqual(results.frame()['Text'].tolist(), ['t2', 't3', 't4'])
+        self.assertEqual(spilled, [('t0', 0.0), ('t1', 0.1)])
+        self.assertEqual(results.footprint()['evicted'], 2)
+        self.assertEqual(results.memory_bytes, sum(results.size(row) for row in results.rows))
+
+    def test_evicts_by_bytes(self):
+        results = window.RollingWindow(self.columns, max_rows=None, max_bytes=2000)
+        results.extend(('x' * 100, 0.0) for _ in range(100))
+        self.assertLessEqual(results.memory_bytes, 2000)
+        self.assertEqual(len(results) + results.evicted, 100)
+        # The budget reserves what the snapshot of the rows takes, besides the rows themselves
+        results.table()
+        self.assertEqual(results.footprint()['snapshot_bytes'],
+                         results.memory_bytes - sum(window.row_size(row) for row in results.rows))
+        results.replace([('y', 0.5)])
+        self.assertEqual((len(results), results.evicted), (1, 0))
+
+    def test_evicted_rows_spill_to_archive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = window.JsonlArchive(os.path.join(tmp_dir, 'spill.jsonl'), self.columns)
+            results = window.RollingWindow(self.columns, max_rows=2, spill=archive)
+            results.extend([('a', 0.1), ('b', 0.2), ('c', 0.3)])
+            self.assertEqual([row[0] for row in archive.read() + list(results.rows)], ['a', 'b', 'c'])
+            chunks = list(backfill.read_chunks(archive.path))
+        self.assertEqual(chunks[0][1], ['a'])
+
+    def test_export_reads_spilled_rows_from_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.object(main.Database, 'db_path', os.path.join(tmp_dir, 'tweets.db')):
+            main.Database.create_table()
+            tweets = [main.Tweet(f'tweet {i}', i / 10) for i in range(5)]
+            main.Database.store_tweets(tweets)
+            results = window.RollingWindow(main.RESULT_COLUMNS, max_rows=2)
+            results.extend((t.text, t.sentiment, t.sentiment_magnitude, t.sentiment_vader, t.multiplicity) for t in tweets)
+            with patch.object(main, 'results', results):
+                csv_string = main.export_data(1)['content']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(csv_string.count('tweet '), 5)
+        self.assertEqual(csv_string.splitlines()[:2], [','.join(main.RESULT_COLUMNS), 'tweet 0,0.0,0.0,0.0,1'])
+
+class TestResultTable(unittest.TestCase):
+
+    rows = [('café good', 0.5, 0.6, 0.4, 2), ('bad', -0.5, 0.6, None, 1), ('', 0.0, 0.0, 0.0, 1),
+            ('great \U0001f600', 0.8, 0.75, 0.6, 3)]
+
+    def setUp(self):
+        self.table = table.ResultTable.from_rows(main.RESULT_COLUMNS, self.rows)
+
+    def test_columns(self):
+        self.assertEqual(self.table['Text'], [row[0] for row in self.rows])
+        self.assertEqual(self.table['Multiplicity'].tolist(), [2, 1, 1, 3])
+        self.assertTrue(np.isnan(self.table['Sentiment_VADER'][1]))
+        self.assertEqual(self.table.text.nbytes, sum(len(row[0].encode('utf-8')) for row in self.rows))
+
+    def test_slices_share_buffers(self):
+        page = self.table[1:3]
+        self.assertEqual(page['Text'], ['bad', ''])
+        self.assertTrue(np.shares_memory(page.values, self.table.values))
+        self.assertTrue(np.shares_memory(page['Sentiment'], self.table['Sentiment']))
+        selected = self.table[self.table['Sentiment'] > 0]
+        self.assertEqual(selected['Text'], ['café good', 'great \U0001f600'])
+        self.assertIs(selected.text, self.table.text)
+        self.assertEqual(len(self.table[2:2]), 0)
+
+    def test_payload(self):
+        data = self.table[0:2].payload(precision=1)
+        self.assertEqual(payload.records(data)[0], {'Text': 'café good', 'Sentiment': 0.5,
+                                                    'Sentiment_Magnitude': 0.6, 'Sentiment_VADER': 0.4,
+                                                    'Multiplicity': 2})
+        encoded = json.loads(main.dash._utils.to_json(data))
+        self.assertEqual(encoded['arrays'][3], [0.4, None])
+        self.assertEqual(self.table.frame().shape, (4, 5))
+
+    def test_window_table_and_pagination(self):
+        results = window.RollingWindow(main.RESULT_COLUMNS, max_rows=3)
+        results.extend(self.rows)
+        snapshot = results.table()
+        self.assertIs(results.table(), snapshot)
+        self.assertEqual(snapshot['Text'][0], 'bad')
+        with patch.object(main, 'results', results):
+            fig, data = main.paginate('Sentiment_VADER', [1, 3])
+        self.assertEqual([row['Text'] for row in payload.records(data)], ['', 'great \U0001f600'])
+        self.assertEqual(list(fig.data[0].x), [0.0, 0.6])
+        # Pages past the first fill their pending scores as they are shown, in the rows, the snapshot and the
+        # stored tweets
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.object(main.Database, 'db_path',
+                                                                     os.path.join(tmp_dir, 'tweets.db')):
+            main.Database.create_table()
+            main.Database.store_tweets([main.Tweet(*row) for row in self.rows])
+            with patch.object(main, 'results', results), patch.object(main.Tweet, 'vader_backend', 'fast'):
+                _, data = main.paginate('Sentiment_VADER', [0, 1])
+            stored = main.Database.read_results()
+        self.assertIsNotNone(payload.records(data)[0]['Sentiment_VADER'])
+        self.assertIsNotNone(results.rows[0][3])
+        self.assertIs(results.table(), snapshot)
+        self.assertFalse(np.isnan(snapshot['Sentiment_VADER'][0]))
+        self.assertEqual(stored[1], results.rows[0])
+        results.extend([('new', 0.1, 0.1, 0.1, 1)])
+        self.assertIsNot(results.table(), snapshot)
+
+class TestStorageBackends(unittest.TestCase):
+
+    rows = [('I love it', 0.5, 0.6, 0.7, 1, 'h1', 1.7e9), ('I hate it', -0.8, 0.9, -0.6, 2, 'h2', None)]
+
+    def check_backend(self, backend):
+        backend.create_table()
+        backend.upsert_tweets(self.rows)
+        backend.upsert_tweets([('I love it', 0.5, 0.6, 0.7, 3, 'h1', 1.7e9), ('new', 0.0, 0.0, 0.0, 1, 'h3', None)])
+        self.assertEqual(backend.read_results(['Text', 'Multiplicity']), [('I love it', 4), ('I hate it', 2), ('new', 1)])
+        backend.upsert_tweets([('again', 0.0, 0.0, 0.0, 1, 'h4', None), ('again', 0.0, 0.0, 0.0, 2, 'h4', None)])
+        self.assertEqual(backend.read_results(['Text', 'Multiplicity'])[3:], [('again', 3)])
+        frames = list(backend.read_frames(['Text', 'Multiplicity'], chunk_size=3))
+        self.assertEqual([len(frame) for frame in frames], [3, 1])
+        self.assertEqual([tuple(row) for frame in frames for row in frame.itertuples(index=False)],
+                         backend.read_results(['Text', 'Multiplicity']))
+        backend.update_columns(['Sentiment', 'Sentiment_VADER'], [(2, 0.1, 0.2), (3, 0.3, 0.4)])
+        self.assertEqual(backend.read_results(['Sentiment', 'Sentiment_VADER']),
+                         [(0.5, 0.7), (0.1, 0.2), (0.3, 0.4), (0.0, 0.0)])
+        arrays = backend.read_columns(['Sentiment', 'Multiplicity'], chunk_size=3)
+        self.assertEqual((arrays['Sentiment'].tolist(), arrays['Multiplicity'].dtype), ([0.5, 0.1, 0.3, 0.0], np.int64))
+        self.assertEqual(backend.row_ids(['h3', 'h1', 'missing']), {'h1': 1, 'h3': 3})
+        backend.update_where('Sentiment', 0.9, 'Text', 'new')
+        self.assertEqual([row[0] for row in backend.read_results(['Sentiment'])], [0.5, 0.1, 0.9, 0.0])
+        with self.assertRaises(ValueError):
+            backend.update_columns(['Bogus'], [(1, 0.0)])
+        with self.assertRaises(ValueError):
+            backend.clear_table('tweets; DROP TABLE tweets')
+        backend.clear_table('tweets')
+        self.assertEqual(backend.read_results(['Text']), [])
+
+    def test_backends_implement_the_interface(self):
+        with self.assertRaises(TypeError):
+            storage.StorageBackend()
+
+        class Partial(storage.StorageBackend):
+            def create_table(self):
+                pass
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.check_backend(storage.SQLiteBackend(os.path.join(tmp_dir, 'tweets.db')))
+
+    def test_concurrent_sqlite_writers_wait_for_the_lock(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backend = storage.SQLiteBackend(os.path.join(tmp_dir, 'tweets.db'))
+            backend.create_table()
+            batches = [[(f't{i}-{j}', 0.0, 0.0, 0.0, 1, f'{i}-{j}', None) for j in range(50)] for i in range(16)]
+            with ThreadPoolExecutor(8) as pool:
+                list(pool.map(backend.upsert_tweets, batches))
+            self.assertEqual(len(backend.read_results(['Text'])), 800)
+
+    @unittest.skipIf(storage.sqlalchemy is None, 'SQLAlchemy is not installed')
+    def test_sqlalchemy_backend_on_file_and_memory(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_backend = storage.SQLAlchemyBackend(f"sqlite:///{os.path.join(tmp_dir, 'tweets.db')}")
+            self.check_backend(file_backend)
+            file_backend.engine.dispose()
+        self.check_backend(storage.SQLAlchemyBackend('sqlite://'))
+
+    @unittest.skipIf(storage.sqlalchemy is None, 'SQLAlchemy is not installed')
+    def test_sqlalchemy_inserts_multi_row_values(self):
+        backend = storage.SQLAlchemyBackend('sqlite://', batch_size=2)
+        backend.create_table()
+        statements = []
+        storage.sqlalchemy.event.listen(backend.engine, 'before_cursor_execute',
+                                        lambda conn, cursor, statement, *args: statements.append(statement))
+        backend.upsert_tweets([(f't{i}', 0.0, 0.0, 0.0, 1, f'h{i}', None) for i in range(5)])
+        inserts = [statement for statement in statements if statement.startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(inserts[0].count('(?, ?, ?, ?, ?, ?, ?)'), 2)
+
+    @unittest.skipIf(storage.sqlalchemy is None, 'SQLAlchemy is not installed')
+    def test_database_url_selects_backend(self):
+        with patch.object(main.Database, 'url', 'sqlite://'):
+            self.assertIsInstance(main.Database.backend(), storage.SQLAlchemyBackend)
+            self.assertIs(main.Database.backend(), main.Database.backend())
+            main.Database.create_table()
+            main.Database.store_tweets([main.Tweet('pooled', 0.25)])
+            self.assertEqual(main.Database.read_results(), [('pooled', 0.25, 0.0, 0.0, 1)])
+            self.assertIsInstance(main.Database.backend('other.db'), storage.SQLiteBackend)
+            # The legacy store and update paths use the pool too
+            main.Database.store_in_database([('legacy', 0.5, 0.5, 0.5)])
+            main.Database.update_records('Sentiment', -0.5, 'Text', 'legacy')
+            self.assertEqual(main.Database.read_results()[1], ('legacy', -0.5, 0.5, 0.5, 1))
+            # Features reading the SQLite tweets table are off, and hidden from the dashboard
+            self.assertFalse(main.Database.plain())
+            self.assertEqual(main.Database.search_text('legacy'), [])
+            self.assertEqual(main.Database.read_columns(['Sentiment'])['Sentiment'].tolist(), [0.25, -0.5])
+        config = main.DashboardConfig('Sentiment', 10, 100, table_features=False)
+        layout = main.generate_layout(config)
+        hidden = {'display': 'none'}
+        self.assertEqual([layout[component_id].style for component_id in ('hashtag-sentiment', 'sentiment-timeseries')],
+                         [hidden, hidden])
+        self.assertIsNone(getattr(layout['sentiment-histogram'], 'style', None))
+
+
+class TestCompactStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_trained_dictionary_shrinks_texts(self):
+        texts = [row[0] for row in compact.sample_rows(1000)]
+        trained = compact.TextCodec.train(texts[:500])
+        untrained = compact.TextCodec(compact.CODEC)
+        for text in texts[500:] + ['', 'naïve café 🚀']:
+            self.assertEqual(trained.decompress(trained.compress(text)), text)
+        trained_size = sum(len(trained.compress(text)) for text in texts[500:])
+        untrained_size = sum(len(untrained.compress(text)) for text in texts[500:])
+        self.assertLess(trained_size, untrained_size * 0.6)
+        self.assertLess(trained_size, sum(len(text.encode('utf-8')) for text in texts[500:]) * 0.4)
+
+    def test_backend_folds_duplicates_and_quantizes_scores(self):
+        backend = compact.CompactBackend(self.db_path, precision=2)
+        backend.create_table()
+        backend.upsert_tweets([('I love it', 0.123456, 0.6, None, 1, 'h1', 1.7e9), ('I hate it', -0.8, 0.9, -0.6, 2, 'h2', None)])
+        backend.upsert_tweets([('I love it', 0.123456, 0.6, None, 1, 'h1', 1.7e9), ('new', 0.0, 0.0, 0.0, 1, 'h3', None),
+                               ('I love it', 0.123456, 0.6, None, 2, 'h1', 1.7e9)])
+        self.assertEqual(backend.read_results(['Text', 'Sentiment', 'Sentiment_VADER', 'Multiplicity']),
+                         [('I love it', 0.12, None, 4), ('I hate it', -0.8, -0.6, 2), ('new', 0.0, 0.0, 1)])
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT Sentiment FROM tweets_compact ORDER BY rowid').fetchall(),
+                             [(12,), (-80,), (0,)])
+        backend.update_columns(['Sentiment_VADER'], [(1, 0.456)])
+        arrays = backend.read_columns(['Sentiment_VADER', 'Multiplicity'])
+        np.testing.assert_allclose(arrays['Sentiment_VADER'], [0.46, -0.6, 0.0])
+        np.testing.assert_array_equal(arrays['Multiplicity'], [4, 2, 1])
+        with self.assertRaises(ValueError):
+            backend.read_columns(['Text'])
+        # The first precision sticks to the database
+        self.assertEqual(compact.CompactBackend(self.db_path, precision=4).read_results(['Sentiment'])[0], (0.12,))
+        with self.assertRaises(ValueError):
+            backend.clear_table('tweets; DROP TABLE tweets')
+        backend.clear_table('tweets')
+        self.assertEqual(backend.read_results(['Text']), [])
+
+    def test_dictionary_is_trained_once_enough_tweets_arrive(self):
+        backend = compact.CompactBackend(self.db_path)
+        backend.create_table()
+        rows = compact.sample_rows(compact.MIN_TRAINING_TEXTS + 10)
+        backend.upsert_tweets(rows[:10])
+        backend.upsert_tweets(rows[10:])
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT Dict_Id, COUNT(*) FROM tweets_compact GROUP BY Dict_Id').fetchall(),
+                             [(0, 10), (1, compact.MIN_TRAINING_TEXTS)])
+        self.assertEqual([row[0] for row in compact.CompactBackend(self.db_path).read_results(['Text'])],
+                         [row[0] for row in rows])
+        frames = compact.CompactBackend(self.db_path).read_frames(['Text', 'Sentiment'], chunk_size=50)
+        self.assertEqual([text for frame in frames for text in frame['Text']], [row[0] for row in rows])
+
+    def test_storage_format_selects_backend(self):
+        with patch.object(main.Database, 'storage_format', 'compact'):
+            self.assertIsInstance(main.Database.backend(self.db_path), compact.CompactBackend)
+            main.Database.create_table(self.db_path)
+            main.Database.store_tweets([main.Tweet('compact', 0.25)], self.db_path)
+            self.assertEqual(main.Database.read_results(self.db_path), [('compact', 0.25, 0.0, 0.0, 1)])
+            with patch.object(main.Database, 'db_path', self.db_path):
+                main.Database.update_records('Sentiment_VADER', 0.5, 'Text', 'compact')
+                main.Database.update_records('Multiplicity', 3, 'Sentiment', 0.25)
+            self.assertEqual(main.Database.read_results(self.db_path), [('compact', 0.25, 0.0, 0.5, 3)])
+            self.assertEqual(main.Database.backend(self.db_path).row_ids([dedup.text_hash('compact')]),
+                             {dedup.text_hash('compact'): 1})
+        self.assertIsInstance(main.Database.backend(self.db_path), storage.SQLiteBackend)
+
+    def test_plain_table_features_are_off_under_compact_storage(self):
+        with patch.object(main.Database, 'storage_format', 'compact'), \
+                patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.create_table()
+            main.Database.store_tweets([main.Tweet('compact #tag', 0.25)])
+            self.assertFalse(main.Database.plain())
+            self.assertEqual(main.Database.search_text('compact'), [])
+            self.assertEqual(main.Database.top_entities(), [])
+            self.assertEqual(main.Database.read_columns(['Sentiment'])['Sentiment'].tolist(), [0.25])
+            self.assertEqual(main.filter_results('compact', [])[1]['arrays'][0], [])
+            self.assertEqual(main.toggle_live(['live'], None)[0], True)
+            self.assertRaises(main.dash.exceptions.PreventUpdate, main.live_update, 1, 'client')
+            with patch.object(main.dash, 'ctx', MagicMock(triggered_id=None)):
+                self.assertEqual(main.update_timeseries(None, 'Sentiment', None, 500).data, ())
+            with self.assertRaises(ValueError):
+                rescore.Rescore(self.db_path)
+
+    def test_benchmark_reports_every_layout(self):
+        results = compact.benchmark(600)
+        self.assertEqual(list(results), ['plain', 'plain, no text indexes', f'compact ({compact.CODEC})'])
+        self.assertLess(results[f'compact ({compact.CODEC})']['bytes'], results['plain, no text indexes']['bytes'])
+        self.assertTrue(all(result['insert'] > 0 and result['read'] > 0 for result in results.values()))
+
+
+class TestRescore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+        # Stored with placeholder scores, as if scored by an older analyzer
+        main.Database.store_tweets([main.Tweet(f'tweet {i} I love it' if i % 2 else f'tweet {i} awful')
+                                    for i in range(25)], self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def scores(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute('SELECT Text, Sentiment, Sentiment_VADER FROM tweets ORDER BY rowid').fetchall()
+
+    def expected(self, text):
+        tweet = main.Tweet(text)
+        tweet.analyze()
+        return tweet.sentiment, tweet.sentiment_vader
+
+    def test_update_records_rejects_unknown_columns(self):
+        with patch.object(main.Database, 'db_path', self.db_path):
+            main.Database.update_records('Sentiment', 0.5, 'Text', 'tweet 0 awful')
+            with self.assertRaises(ValueError):
+                main.Database.update_records('Sentiment = 1; --', 0.5, 'Text', 'x')
+        self.assertEqual(self.scores()[0][1], 0.5)
+
+    def test_bulk_update(self):
+        main.Database.bulk_update(['Sentiment', 'Sentiment_VADER'], [(1, 0.25, -0.25), (3, 0.75, 0.5)], self.db_path)
+        scores = self.scores()
+        self.assertEqual([scores[0][1:], scores[1][1:], scores[2][1:]], [(0.25, -0.25), (0.0, 0.0), (0.75, 0.5)])
+        with self.assertRaises(ValueError):
+            main.Database.bulk_update(['rowid; DROP TABLE tweets'], [(1, 0)], self.db_path)
+
+    def test_pending_rescore_fills_only_null_columns(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('UPDATE tweets SET Sentiment = NULL, Sentiment_Magnitude = NULL WHERE rowid IN (2, 4)')
+        with patch('builtins.print'):
+            job = rescore.Rescore(self.db_path, columns=['Sentiment', 'Sentiment_Magnitude'], workers=1, pending=True)
+            job.run()
+        self.assertEqual(job.rows, 2)
+        scores = self.scores()
+        self.assertEqual(scores[1][1], self.expected(scores[1][0])[0])
+        self.assertEqual(scores[0][1], 0.0)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertIsNone(conn.execute('SELECT * FROM rescore_progress').fetchone())
+
+    def test_rescore_resumes_after_crash(self):
+        commit = rescore.Rescore.commit
+        calls = []
+
+        def crash_on_second_commit(job, conn, scored, last_rowid):
+            calls.append(last_rowid)
+            if len(calls) == 2:
+                raise RuntimeError('worker killed')
+            commit(job, conn, scored, last_rowid)
+
+        with patch('builtins.print'), patch.object(rescore.Rescore, 'commit', crash_on_second_commit):
+            with self.assertRaises(RuntimeError):
+                rescore.Rescore(self.db_path, chunk_size=10, workers=1).run()
+        self.assertEqual(sum(1 for _, sentiment, _ in self.scores() if sentiment), 10)
+        with patch('builtins.print'):
+            job = rescore.Rescore(self.db_path, chunk_size=10, workers=1)
+            job.run()
+        self.assertEqual((job.rows, job.resumed_rows), (25, 10))
+        self.assertEqual([row[1:] for row in self.scores()], [self.expected(row[0]) for row in self.scores()])
+
+    def test_completed_run_starts_over_next_time(self):
+        with patch('builtins.print'):
+            rescore.Rescore(self.db_path, chunk_size=10, workers=1).run()
+            main.Database.bulk_update(['Sentiment'], [(1, 0.5)], self.db_path)
+            job = rescore.Rescore(self.db_path, chunk_size=10, workers=1)
+            job.run()
+        self.assertEqual((job.rows, job.resumed_rows), (25, 0))
+        self.assertEqual(self.scores()[0][1:], self.expected(self.scores()[0][0]))
+
+class TestStreamingReads(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        main.Database.create_table(self.db_path)
+        main.Database.store_tweets([main.Tweet(f'tweet {i}', i / 10, 0.5, -i / 10, i + 1) for i in range(7)],
+                                   self.db_path)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('UPDATE tweets SET Sentiment_VADER = NULL WHERE rowid = 3')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_rows_are_fetched_in_chunks(self):
+        cursor = sqlite3.connect(self.db_path).execute('SELECT Text FROM tweets')
+        self.assertEqual([len(rows) for rows in storage.fetch_chunks(cursor, 3)], [3, 3, 1])
+        self.assertEqual(main.Database.get_table_data(self.db_path, 'tweets')[0][:2], ('tweet 0', 0.0))
+        rows = main.Database.iter_table_data(self.db_path, 'tweets', ['Text', 'Multiplicity'], chunk_size=2)
+        self.assertEqual(next(rows), ('tweet 0', 1))
+        self.assertEqual(len(list(rows)), 6)
+        with self.assertRaises(ValueError):
+            list(main.Database.iter_table_data(self.db_path, 'tweets; DROP TABLE tweets'))
+
+    def test_read_columns_into_arrays(self):
+        arrays = main.Database.read_columns(['Text', 'Sentiment_VADER', 'Multiplicity'], 3, self.db_path)
+        self.assertEqual(arrays['Text'].dtype, object)
+        self.assertEqual(arrays['Multiplicity'].dtype, np.int64)
+        np.testing.assert_array_equal(arrays['Multiplicity'], np.arange(1, 8))
+        self.assertTrue(np.isnan(arrays['Sentiment_VADER'][2]))
+        self.assertAlmostEqual(np.nansum(arrays['Sentiment_VADER']), -1.9)
+        with self.assertRaises(ValueError):
+            main.Database.read_columns(['Sentiment; --'], db_path=self.db_path)
+
+    def test_read_frames(self):
+        frames = list(main.Database.read_frames(['Text', 'Sentiment'], 4, self.db_path))
+        self.assertEqual([len(frame) for frame in frames], [4, 3])
+        self.assertEqual(list(frames[1].columns), ['Text', 'Sentiment'])
+        self.assertEqual(frames[1]['Text'].iloc[0], 'tweet 4')
+
+    def test_show_all_records_streams_every_table(self):
+        with patch('builtins.print') as mock_print:
+            main.Database.show_all_records(self.db_path, chunk_size=2)
+        printed = [call.args[0] for call in mock_print.call_args_list]
+        self.assertIn('Records from table tweets:', printed)
+        self.assertEqual(sum(1 for line in printed if isinstance(line, tuple) and len(line) == 7), 7)
+
+
+class TestScoringPolicy(unittest.TestCase):
+
+    def test_only_requested_columns_are_scored(self):
+        tweet = main.Tweet('I love this phone')
+        tweet.analyze(scoring.ScoringPolicy(columns=('Sentiment_VADER',)))
+        self.assertIsNone(tweet.sentiment)
+        self.assertIsNone(tweet.sentiment_magnitude)
+        self.assertGreater(tweet.sentiment_vader, 0)
+        tweet.fill_pending()
+        full = main.Tweet('I love this phone')
+        full.analyze(scoring.FULL_SCORING)
+        self.assertEqual((tweet.sentiment, tweet.sentiment_magnitude, tweet.sentiment_vader),
+                         (full.sentiment, full.sentiment_magnitude, full.sentiment_vader))
+
+    def test_cheap_first_runs_pattern_only_when_ambiguous(self):
+        policy = scoring.ScoringPolicy(cheap_first=True)
+        clear, neutral, mixed = main.Tweet('I love love love this'), main.Tweet('the phone'), main.Tweet(
+            'great camera but awful battery')
+        for tweet in (clear, neutral, mixed):
+            tweet.analyze(policy)
+        self.assertIsNone(clear.sentiment)
+        self.assertIsNotNone(neutral.sentiment)
+        self.assertIsNotNone(mixed.sentiment)
+        self.assertTrue(all(t.sentiment_vader is not None for t in (clear, neutral, mixed)))
+        # Screening only saves time with FastVader, so it is used whatever VADER_Backend says
+        with patch.object(main.Tweet, 'vader_backend', 'nltk'), \
+                patch.object(main.Tweet, 'score_vader', autospec=True, side_effect=main.Tweet.score_vader) as score:
+            main.Tweet('the phone').analyze(policy)
+            main.Tweet('the phone').analyze(scoring.FULL_SCORING)
+        self.assertEqual([call.args[2] for call in score.call_args_list], ['fast', 'nltk'])
+
+    def test_policy_from_env(self):
+        with patch.dict(os.environ, {'Scoring_Columns': 'Sentiment_VADER', 'Scoring_Cheap_First': 'true'}):
+            policy = scoring.ScoringPolicy.from_env()
+        self.assertEqual(policy, scoring.ScoringPolicy(columns=('Sentiment_VADER',), cheap_first=True))
+        with patch.dict(os.environ, {'Scoring_Columns': 'Sentiment,Bogus'}):
+            with self.assertRaises(ValueError):
+                scoring.ScoringPolicy.from_env()
+
+    def test_pending_columns_are_stored_as_null_and_filled_on_demand(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'tweets.db')
+            main.Database.create_table(db_path)
+            tweets = [main.Tweet(f'tweet {i} I love it') for i in range(7)]
+            for tweet in tweets:
+                tweet.analyze(scoring.ScoringPolicy(columns=('Sentiment_VADER',)))
+            main.Database.store_tweets(tweets, db_path)
+            stats = main.QueryStats('q', main.SCORE_COLUMNS)
+            stats.update(tweets)
+            self.assertEqual(stats.summary()['Sentiment']['count'], 0)
+            self.assertEqual(stats.summary()['Sentiment']['pending'], 7)
+            cards = main.summary_cards(stats.summary())
+            self.assertEqual(len(cards), 3)
+            self.assertIn('partial: 7 pending', str(cards[0]))
+            with sqlite3.connect(db_path) as conn:
+                self.assertEqual(conn.execute('SELECT COUNT(*) FROM tweets WHERE Sentiment IS NULL').fetchone()[0], 7)
+            self.assertEqual(main.Database.fill_pending(db_path=db_path, chunk_size=3), 7)
+            self.assertEqual(main.Database.fill_pending(db_path=db_path), 0)
+            with sqlite3.connect(db_path) as conn:
+                self.assertEqual(conn.execute('SELECT MIN(Sentiment) FROM tweets').fetchone()[0], 0.5)
+            self.assertEqual(main.Database.fill_pending(db_path=os.path.join(tmp_dir, 'empty.db')), 0)
+
+    def test_fill_pending_goes_through_the_configured_backend(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backends = [compact.CompactBackend(os.path.join(tmp_dir, 'compact.db'))]
+            if storage.sqlalchemy is not None:
+                backends.append(storage.SQLAlchemyBackend(f"sqlite:///{os.path.join(tmp_dir, 'pooled.db')}"))
+            for backend in backends:
+                tweets = [main.Tweet(f'tweet {i} I love it') for i in range(5)]
+                for tweet in tweets:
+                    tweet.analyze(scoring.ScoringPolicy(columns=('Sentiment_VADER',)))
+                with patch.object(main.Database, 'backend', lambda db_path=None: backend):
+                    main.Database.create_table()
+                    main.Database.store_tweets(tweets)
+                    self.assertEqual(main.Database.fill_pending(chunk_size=2), 5)
+                    self.assertEqual(main.Database.fill_pending(), 0)
+                    self.assertEqual({row[1] for row in main.Database.read_results()}, {0.5})
+                getattr(backend, 'engine', MagicMock()).dispose()
+
+
+class TestCompiledLexicons(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        lexicon.build(cls.tmp_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_mapped_vader_matches_nltk(self):
+        table = lexicon.load_vader_table(self.tmp_dir.name)
+        self.assertIsInstance(table.keys, np.memmap)
+        fast = scoring.FastVader(table=table)
+        self.assertEqual(scoring.validate_against_nltk(scoring.reference_corpus(2000), fast), 0.0)
+
+    def test_mapped_pattern_matches_textblob(self):
+        scorer = scoring.PatternScorer(lexicon.load_pattern_lexicon(self.tmp_dir.name))
+        texts = scoring.reference_corpus(500) + ['not very good', 'really not bad', 'xd so good', 'never happy',
+                                                 'not a good idea', 'extremely badly designed', '']
+        for text in texts:
+            tweet = main.Tweet(text)
+            tweet.clean()
+            self.assertEqual(scorer.score_tokens(scoring.tokenize(tweet.text)),
+                             scoring.PatternScorer().score_tokens(scoring.tokenize(tweet.text)), tweet.text)
+
+    def test_unbuilt_lexicons_fall_back_to_dicts(self):
+        missing = os.path.join(self.tmp_dir.name, 'missing')
+        self.assertIsNone(lexicon.load_vader_table(missing))
+        self.assertIsNone(lexicon.load_pattern_lexicon(missing))
+
+
+class TestCallbackProfiler(unittest.TestCase):
+
+    export_request = {'output': 'download-dataframe-csv.data',
+                      'outputs': {'id': 'download-dataframe-csv', 'property': 'data'},
+                      'inputs': [{'id': 'export-button', 'property': 'n_clicks', 'value': 1}],
+                      'changedPropIds': ['export-button.n_clicks'], 'state': []}
+
+    def setUp(self):
+        self.client = main.app.server.test_client()
+        self.headers = {'Authorization': 'Bearer secret'}
+
+    def tearDown(self):
+        main.profiler.disarm_all()
+
+    def test_routes_need_the_admin_token(self):
+        with patch.object(main.profiler, 'token', None):
+            self.assertEqual(self.client.get('/admin/profile', headers=self.headers).status_code, 404)
+        with patch.object(main.profiler, 'token', 'secret'):
+            self.assertEqual(self.client.get('/admin/profile').status_code, 401)
+            self.assertEqual(self.client.get('/admin/profile', headers={'Authorization': 'Bearer wrong'}).status_code,
+                             401)
+            status = self.client.get('/admin/profile', headers=self.headers).get_json()
+        self.assertIn('export_data', status['callbacks'])
+
+    def test_armed_callback_is_profiled_for_its_runs_then_restored(self):
+        original = main.app.callback_map['download-dataframe-csv.data']['callback']
+        with patch.object(main.profiler, 'token', 'secret'):
+            response = self.client.post('/admin/profile', headers=self.headers,
+                                        json={'callback': 'export_data', 'runs': 2, 'tracemalloc': True})
+            self.assertEqual(response.status_code, 201)
+            report_id = response.get_json()['id']
+            self.assertIsNot(main.app.callback_map['download-dataframe-csv.data']['callback'], original)
+            self.assertEqual(self.client.post('/admin/profile', headers=self.headers,
+                                              json={'callback': 'export_data'}).status_code, 400)
+            self.assertEqual(self.client.post('/admin/profile', headers=self.headers,
+                                              json={'callback': 'missing'}).status_code, 404)
+            for _ in range(3):
+                self.assertEqual(self.client.post('/_dash-update-component', json=self.export_request).status_code,
+                                 200)
+            self.assertIs(main.app.callback_map['download-dataframe-csv.data']['callback'], original)
+            self.assertFalse(tracemalloc.is_tracing())
+            status = self.client.get('/admin/profile', headers=self.headers).get_json()
+            report = next(r for r in status['reports'] if r['id'] == report_id)
+            self.assertEqual((report['completed'], len(report['seconds'])), (2, 2))
+            download = self.client.get(f'/admin/profile/{report_id}/pstats', headers=self.headers)
+            self.assertIn(f'export_data-{report_id}.pstats', download.headers['Content-Disposition'])
+            stats = marshal.loads(download.data)
+            self.assertTrue(any(function == 'export_data' for _, _, function in stats))
+            self.assertIn('Run 2:', self.client.get(f'/admin/profile/{report_id}/tracemalloc',
+                                                    headers=self.headers).get_data(as_text=True))
+            self.assertEqual(self.client.get(f'/admin/profile/{report_id}/collapsed',
+                                             headers=self.headers).status_code, 200)
+            self.assertEqual(self.client.get(f'/admin/profile/{report_id}/other',
+                                             headers=self.headers).status_code, 404)
+
+    def test_sampler_collapses_stacks_below_the_root(self):
+        def slow_leaf():
+            time.sleep(0.05)
+
+        counts = Counter()
+        with profiling.StackSampler(threading.get_ident(), sys._getframe(), 0.001, counts):
+            slow_leaf()
+        self.assertTrue(counts)
+        stack = counts.most_common(1)[0][0]
+        self.assertTrue(stack.startswith('slow_leaf (unit_test.py:'), stack)
+
+
+class TestQueryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'tweets.db')
+        self.now = 1000.0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def clock(self):
+        return self.now
+
+    def test_load_config(self):
+        path = os.path.join(self.tmp_dir.name, 'tracked.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'budget': 30, 'queries': ['plain', {'query': 'acme', 'interval': 60, 'priority': 2}]}, f)
+        config = scheduler.SchedulerConfig.load(path)
+        self.assertEqual(config.budget, 30)
+        self.assertEqual([(q.query, q.interval, q.priority) for q in config.queries],
+                         [('plain', 300.0, 1.0), ('acme', 60, 2)])
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'queries': [{'query': 'acme', 'priority': 0}]}, f)
+        with self.assertRaises(ValueError):
+            scheduler.SchedulerConfig.load(path)
+
+    def test_token_bucket(self):
+        bucket = scheduler.TokenBucket(rate=0.5, capacity=2, clock=self.clock)
+        self.assertEqual([bucket.take() for _ in range(3)], [True, True, False])
+        self.assertAlmostEqual(bucket.wait_time(), 2.0)
+        self.now += 2
+        self.assertTrue(bucket.take())
+
+    def test_scarce_budget_is_shared_by_priority(self):
+        queries = [scheduler.TrackedQuery(name, interval=1, priority=priority)
+                   for name, priority in (('high', 3), ('mid', 2), ('low', 1))]
+        config = scheduler.SchedulerConfig(queries=queries, budget=60, window=60, burst=1, jitter=0)
+        calls = Counter()
+        job = scheduler.QueryScheduler(config, self.db_path, clock=self.clock, seed=0)
+        with patch.object(main.TwitterAPI, 'fetch_page', lambda token, query, *args: calls.update([query]) or ([], None)), \
+                patch.object(job, 'token', lambda: 'token'):
+            for _ in range(60):
+                self.now += 1
+                self.assertEqual(len(job.run_once()), 1)
+        self.assertEqual(sum(calls.values()), 60)
+        self.assertEqual((calls['high'], calls['mid'], calls['low']), (30, 20, 10))
+        status = job.status()
+        self.assertEqual(status['low']['refreshes'], 10)
+        self.assertGreater(status['low']['overdue'], status['high']['overdue'])
+
+    @patch.dict(os.environ, {'Key_Twitter': 'key', 'Secret_Key_Twitter': 'secret'})
+    def test_refreshes_fetch_incrementally_and_persist(self):
+        server = mock_twitter.MockTwitterServer(mock_twitter.MockTwitterConfig(corpus_size=30))
+        base_url, caches = main.TwitterAPI.base_url, (main.TwitterAPI.search_cache, main.TwitterAPI.token_cache)
+        config = scheduler.SchedulerConfig(queries=[scheduler.TrackedQuery('acme', interval=60, max_tweets=10)])
+        try:
+            main.TwitterAPI.base_url = server.start()
+            main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = cache.TTLCache(60), cache.TTLCache(60)
+            main.Database.create_table(self.db_path)
+            job = scheduler.QueryScheduler(config, self.db_path, clock=self.clock, seed=0)
+            self.assertEqual(job.run_once(), [])
+            self.now += 60
+            self.assertEqual(len(job.run_once()), 1)
+            query = job.queries['acme']
+            self.assertEqual((query.tweets, query.since_id), (10, '1700000000000000000'))
+            self.now += 120
+            job.run_once()
+            self.assertEqual((query.refreshes, query.tweets), (2, 10))
+        finally:
+            server.stop()
+            main.TwitterAPI.base_url = base_url
+            main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = caches
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT SUM(Multiplicity) FROM tweets').fetchone()[0], 10)
+        self.assertEqual(job.status()['acme']['staleness'], 0.0)
+        restarted = scheduler.QueryScheduler(config, self.db_path, clock=self.clock)
+        self.assertEqual((restarted.queries['acme'].since_id, restarted.queries['acme'].refreshes),
+                         ('1700000000000000000', 2))
+
+    @patch.dict(os.environ, {'Key_Twitter': 'key', 'Secret_Key_Twitter': 'secret'})
+    def test_refresh_pages_back_to_since_id_across_the_budget(self):
+        server = mock_twitter.MockTwitterServer(mock_twitter.MockTwitterConfig(corpus_size=30))
+        base_url, caches = main.TwitterAPI.base_url, (main.TwitterAPI.search_cache, main.TwitterAPI.token_cache)
+        since_id = str(1700000000000000000 - 25)
+        config = scheduler.SchedulerConfig(queries=[scheduler.TrackedQuery('acme', interval=60, max_tweets=10,
+                                                                           since_id=since_id)],
+                                           budget=2, window=120, burst=2)
+        try:
+            main.TwitterAPI.base_url = server.start()
+            main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = cache.TTLCache(60), cache.TTLCache(60)
+            main.Database.create_table(self.db_path)
+            job = scheduler.QueryScheduler(config, self.db_path, clock=self.clock, seed=0)
+            self.now += 60
+            self.assertEqual(len(job.run_once()), 1)
+            query = job.queries['acme']
+            # The budget ran out two pages in, so since_id holds until the older tweets are fetched too
+            self.assertEqual((query.tweets, query.since_id, query.next_token), (20, since_id, '20'))
+            restarted = scheduler.QueryScheduler(config, self.db_path, clock=self.clock)
+            self.assertEqual(restarted.queries['acme'].next_token, '20')
+            self.now += 120
+            self.assertEqual(len(job.run_once()), 1)
+            self.assertEqual((query.tweets, query.since_id, query.next_token), (25, '1700000000000000000', None))
+        finally:
+            server.stop()
+            main.TwitterAPI.base_url = base_url
+            main.TwitterAPI.search_cache, main.TwitterAPI.token_cache = caches
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute('SELECT SUM(Multiplicity) FROM tweets').fetchone()[0], 25)
+
+
 # ... You can add more tests for other methods and classes
 
 if __name__ == "__main__":
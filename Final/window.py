@@ -0,0 +1,137 @@
+'''Memory-bounded working set of recent result rows, spilling the oldest rows when full'''
+import json
+import os
+import sys
+import threading
+from collections import deque
+from itertools import islice
+import numpy as np
+import pandas as pd
+from storage import column_dtype
+from table import TEXT_COLUMN, ResultTable
+
+DEFAULT_MAX_ROWS = int(os.getenv('Window_Max_Rows', '10000'))
+DEFAULT_MAX_BYTES = int(os.getenv('Window_Max_Bytes', str(64 * 1024 * 1024)))
+
+
+def row_size(row):
+    '''Returns the bytes a row tuple and its values occupy'''
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+class RollingWindow:
+    '''Class for a ring buffer of the most recent rows, bounded by row count and bytes'''
+
+    def __init__(self, columns, max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES, spill=None):
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        # spill(rows) receives evicted rows; reads beyond the window go to the database (see export_data)
+        self.spill = spill
+        self.text_index = self.columns.index(TEXT_COLUMN)
+        self.numeric = [(i, column) for i, column in enumerate(self.columns) if i != self.text_index]
+        # Besides its tuple, a row takes a record and two text offsets in the snapshot table() builds
+        self.record_bytes = np.dtype([(column, column_dtype(column)) for _, column in self.numeric]).itemsize + 16
+        self.lock = threading.Lock()
+        self.rows = deque()
+        self.sizes = deque()
+        self.memory_bytes = 0
+        self.evicted = 0
+        # Array-backed copy of the rows, built on the first read after they change
+        self.snapshot = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def over_budget(self):
+        return ((self.max_rows is not None and len(self.rows) > self.max_rows) or
+                (self.max_bytes is not None and self.memory_bytes > self.max_bytes))
+
+    def extend(self, rows):
+        '''Append rows, evicting (and spilling) the oldest ones past the budget'''
+        with self.lock:
+            self.push(rows)
+
+    def replace(self, rows):
+        '''Swap the contents for a new set of rows'''
+        with self.lock:
+            self.rows.clear()
+            self.sizes.clear()
+            self.memory_bytes = self.evicted = 0
+            self.push(rows)
+
+    def size(self, row):
+        '''Returns the bytes a row takes in the window and in its snapshot'''
+        return row_size(row) + self.record_bytes + len((row[self.text_index] or '').encode('utf-8'))
+
+    def push(self, rows):
+        self.snapshot = None
+        evicted = []
+        for row in rows:
+            row = tuple(row)
+            size = self.size(row)
+            self.rows.append(row)
+            self.sizes.append(size)
+            self.memory_bytes += size
+            while self.rows and self.over_budget():
+                evicted.append(self.rows.popleft())
+                self.memory_bytes -= self.sizes.popleft()
+        self.evicted += len(evicted)
+        if evicted and self.spill:
+            self.spill(evicted)
+
+    def frame(self, start=0, end=None):
+        '''Returns rows [start:end) of the window as a DataFrame'''
+        with self.lock:
+            rows = list(islice(self.rows, start, end))
+        return pd.DataFrame(rows, columns=self.columns)
+
+    def fill(self, start, end, fill):
+        '''Replace rows [start:end) with fill(row), patching the snapshot instead of rebuilding it, and return the
+        rows that changed'''
+        changed = []
+        with self.lock:
+            for i in range(start, min(end, len(self.rows))):
+                row = tuple(fill(self.rows[i]))
+                if row == self.rows[i]:
+                    continue
+                changed.append(row)
+                size = self.size(row)
+                self.memory_bytes += size - self.sizes[i]
+                self.rows[i], self.sizes[i] = row, size
+                if self.snapshot is not None:
+                    for j, column in self.numeric:
+                        self.snapshot.values[column][i] = np.nan if row[j] is None else row[j]
+        return changed
+
+    def table(self):
+        '''Returns the window as a ResultTable, whose slices and masks don't copy the rows'''
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = ResultTable.from_rows(self.columns, self.rows)
+            return self.snapshot
+
+    def footprint(self):
+        snapshot = self.snapshot
+        return {'rows': len(self.rows), 'bytes': self.memory_bytes,
+                'snapshot_bytes': snapshot.nbytes() if snapshot is not None else 0, 'evicted': self.evicted,
+                'max_rows': self.max_rows, 'max_bytes': self.max_bytes}
+
+
+class JsonlArchive:
+    '''Class for spilling evicted rows to a JSONL archive that backfill.py can load again'''
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+
+    def __call__(self, rows):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                record = dict(zip(self.columns, row))
+                record['text'] = record.pop('Text', '')
+                f.write(json.dumps(record) + '\n')
+
+    def read(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return [tuple(json.loads(line).get(c if c != 'Text' else 'text') for c in self.columns) for line in f]
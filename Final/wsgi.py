@@ -8,5 +8,6 @@ if project_home not in sys.path:
 # need to pass the flask app as "application" for WSGI to work
 # for a dash app, that is at app.server
 # see https://plot.ly/dash/deployment
-from main import app
+from main import Database, app
+Database.create_table()
 application = app.server
\ No newline at end of file
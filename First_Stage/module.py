@@ -241,15 +241,14 @@ class Dashboard:
         conn = sqlite3.connect('tweets.db')
         cursor = conn.cursor()
         offset = page_current * page_size
-        query = f'SELECT * FROM tweets LIMIT {page_size} OFFSET {offset}'
-        cursor.execute(query)
-        data = cursor.fetchall()
-        conn.close()
-
-        # Convert the paginated data to a DataFrame
         columns = ['Text', 'Sentiment', 'Sentiment_Magnitude']
-        paginated_data = [dict(zip(columns, row)) for row in data]
-        df = pd.DataFrame(paginated_data)
+        cursor.execute(f'SELECT {", ".join(columns)} FROM tweets LIMIT ? OFFSET ?', (page_size, offset))
+
+        # Convert the paginated data to a DataFrame, fetching it in chunks rather than all at once
+        chunks = iter(lambda: cursor.fetchmany(500), [])
+        df = pd.concat([pd.DataFrame(rows, columns=columns) for rows in chunks] or [pd.DataFrame(columns=columns)],
+                       ignore_index=True)
+        conn.close()
 
         # Clean the tweet text and perform sentiment analysis on the tweet text
         cleaned_data = Actions.clean_tweet_text(df.to_dict('records'))